@@ -0,0 +1,196 @@
+"""move the account configuration columns to the account_config table
+
+Revision ID: 3f7a9c2d5b18
+Revises: 8c4d1e6f2a93
+Create Date: 2026-10-17 16:45:31.270893
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f7a9c2d5b18'
+down_revision = '8c4d1e6f2a93'
+branch_labels = None
+depends_on = None
+
+
+# NOTE: The stored procedures which read or write the moved columns
+# must be replaced before the columns are dropped. Their downgraded
+# versions are identical to those defined in revision d7f09a1ecd05.
+
+INSERT_ACCOUNT_UPDATE_SIGNAL_SQL = r"""
+CREATE OR REPLACE FUNCTION insert_account_update_signal(
+    INOUT a account,
+    p_current_ts timestamp with time zone
+) AS $$
+DECLARE
+    c account_config%ROWTYPE;
+BEGIN
+    a.last_heartbeat_ts := p_current_ts;
+    a.pending_account_update := false;
+
+    -- A missing `account_config` row means that all the
+    -- configuration columns have their default values.
+    SELECT * INTO c
+    FROM account_config
+    WHERE debtor_id = a.debtor_id AND creditor_id = a.creditor_id;
+
+    INSERT INTO account_update_signal (
+        debtor_id, creditor_id, last_change_seqnum, last_change_ts, principal, interest,
+        interest_rate, last_interest_rate_change_ts, last_transfer_number,
+        last_transfer_committed_at, last_config_ts, last_config_seqnum, creation_date,
+        negligible_amount, config_data, config_flags, debtor_info_iri,
+        debtor_info_content_type, debtor_info_sha256, inserted_at
+    )
+    VALUES (
+        a.debtor_id, a.creditor_id, a.last_change_seqnum, a.last_change_ts, a.principal, a.interest,
+        a.interest_rate, a.last_interest_rate_change_ts, a.last_transfer_number,
+        a.last_transfer_committed_at, a.last_config_ts, a.last_config_seqnum, a.creation_date,
+        a.negligible_amount, coalesce(c.config_data, ''), a.config_flags, c.debtor_info_iri,
+        c.debtor_info_content_type, c.debtor_info_sha256, a.last_change_ts
+    );
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+OLD_INSERT_ACCOUNT_UPDATE_SIGNAL_SQL = r"""
+CREATE OR REPLACE FUNCTION insert_account_update_signal(
+    INOUT a account,
+    p_current_ts timestamp with time zone
+) AS $$
+BEGIN
+    a.last_heartbeat_ts := p_current_ts;
+    a.pending_account_update := false;
+
+    INSERT INTO account_update_signal (
+        debtor_id, creditor_id, last_change_seqnum, last_change_ts, principal, interest,
+        interest_rate, last_interest_rate_change_ts, last_transfer_number,
+        last_transfer_committed_at, last_config_ts, last_config_seqnum, creation_date,
+        negligible_amount, config_data, config_flags, debtor_info_iri,
+        debtor_info_content_type, debtor_info_sha256, inserted_at
+    )
+    VALUES (
+        a.debtor_id, a.creditor_id, a.last_change_seqnum, a.last_change_ts, a.principal, a.interest,
+        a.interest_rate, a.last_interest_rate_change_ts, a.last_transfer_number,
+        a.last_transfer_committed_at, a.last_config_ts, a.last_config_seqnum, a.creation_date,
+        a.negligible_amount, a.config_data, a.config_flags, a.debtor_info_iri,
+        a.debtor_info_content_type, a.debtor_info_sha256, a.last_change_ts
+    );
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+LOCK_OR_CREATE_ACCOUNT_SQL = r"""
+CREATE OR REPLACE FUNCTION lock_or_create_account(
+    p_debtor_id bigint,
+    p_creditor_id bigint,
+    p_current_ts timestamp with time zone
+) RETURNS account AS $$
+DECLARE
+    a account%ROWTYPE;
+    creation_date date := (p_current_ts AT TIME ZONE 'UTC')::date;
+    t0 timestamp with time zone := '1970-01-01T00:00:00+00:00';
+BEGIN
+    SELECT * INTO a
+    FROM account
+    WHERE debtor_id = p_debtor_id AND creditor_id = p_creditor_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        INSERT INTO account (
+            debtor_id, creditor_id, creation_date, last_change_seqnum, last_change_ts, principal,
+            interest_rate, interest, last_interest_rate_change_ts, last_config_ts,
+            last_config_seqnum, last_transfer_number, last_transfer_committed_at,
+            negligible_amount, config_flags, {config_data_column}status_flags, total_locked_amount,
+            pending_transfers_count, last_transfer_id, previous_interest_rate, last_heartbeat_ts,
+            last_interest_capitalization_ts, last_deletion_attempt_ts, pending_account_update
+        )
+        VALUES (
+            p_debtor_id, p_creditor_id, creation_date, 0, p_current_ts, 0,
+            0.0, 0.0, t0, t0,
+            0, 0, t0,
+            0.0, 0, {config_data_value}0, 0,
+            0, (creation_date - '1970-01-01'::date)::bigint << 40, 0.0, p_current_ts,
+            t0, t0, false
+        )
+        ON CONFLICT DO NOTHING
+        RETURNING * INTO a;
+
+        IF NOT FOUND THEN
+            -- The account has been created by a concurrent transaction.
+            RAISE EXCEPTION 'concurrent account creation' USING ERRCODE = 'serialization_failure';
+        END IF;
+
+        a := insert_account_update_signal(a, p_current_ts);
+    END IF;
+
+    IF a.status_flags & 1 != 0 THEN
+        a.status_flags := a.status_flags & ~1;
+        a.last_change_seqnum := increment_seqnum(a.last_change_seqnum);
+        a.last_change_ts := greatest(a.last_change_ts, p_current_ts);
+        a := insert_account_update_signal(a, p_current_ts);
+    END IF;
+
+    RETURN a;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+CONFIG_COLUMNS = 'debtor_id, creditor_id, config_data, debtor_info_iri, debtor_info_content_type, debtor_info_sha256'
+
+
+def upgrade():
+    op.create_table('account_config',
+    sa.Column('debtor_id', sa.BigInteger(), nullable=False),
+    sa.Column('creditor_id', sa.BigInteger(), nullable=False),
+    sa.Column('config_data', sa.String(), nullable=False),
+    sa.Column('debtor_info_iri', sa.String(), nullable=True),
+    sa.Column('debtor_info_content_type', sa.String(), nullable=True),
+    sa.Column('debtor_info_sha256', sa.LargeBinary(), nullable=True),
+    sa.CheckConstraint('debtor_info_sha256 IS NULL OR octet_length(debtor_info_sha256) = 32'),
+    sa.ForeignKeyConstraint(['debtor_id', 'creditor_id'], ['account.debtor_id', 'account.creditor_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('debtor_id', 'creditor_id'),
+    comment='Contains the rarely changed, and potentially big, configuration columns of accounts. Keeping them out of the `account` table makes the frequent updates of `account` table rows cheaper, and allows them to be done as HOT (heap-only tuple) updates more often. A missing row means that all the columns have their default values.'
+    )
+    op.execute(sa.text(
+        f'INSERT INTO account_config ({CONFIG_COLUMNS}) '
+        f'SELECT {CONFIG_COLUMNS} FROM account '
+        "WHERE config_data != '' OR debtor_info_iri IS NOT NULL "
+        'OR debtor_info_content_type IS NOT NULL OR debtor_info_sha256 IS NOT NULL'
+    ))
+    op.execute(sa.text(INSERT_ACCOUNT_UPDATE_SIGNAL_SQL))
+    op.execute(sa.text(LOCK_OR_CREATE_ACCOUNT_SQL.format(config_data_column='', config_data_value='')))
+
+    # NOTE: The check constraint on `debtor_info_sha256` is dropped
+    # together with the column.
+    op.drop_column('account', 'debtor_info_sha256')
+    op.drop_column('account', 'debtor_info_content_type')
+    op.drop_column('account', 'debtor_info_iri')
+    op.drop_column('account', 'config_data')
+
+
+def downgrade():
+    op.add_column('account', sa.Column('config_data', sa.String(), server_default='', nullable=False))
+    op.alter_column('account', 'config_data', server_default=None)
+    op.add_column('account', sa.Column('debtor_info_iri', sa.String(), nullable=True))
+    op.add_column('account', sa.Column('debtor_info_content_type', sa.String(), nullable=True))
+    op.add_column('account', sa.Column('debtor_info_sha256', sa.LargeBinary(), nullable=True))
+    op.create_check_constraint(
+        'account_debtor_info_sha256_check',
+        'account',
+        'debtor_info_sha256 IS NULL OR octet_length(debtor_info_sha256) = 32',
+    )
+    op.execute(sa.text(
+        'UPDATE account SET '
+        'config_data = c.config_data, '
+        'debtor_info_iri = c.debtor_info_iri, '
+        'debtor_info_content_type = c.debtor_info_content_type, '
+        'debtor_info_sha256 = c.debtor_info_sha256 '
+        'FROM account_config c '
+        'WHERE account.debtor_id = c.debtor_id AND account.creditor_id = c.creditor_id'
+    ))
+    op.execute(sa.text(OLD_INSERT_ACCOUNT_UPDATE_SIGNAL_SQL))
+    op.execute(sa.text(LOCK_OR_CREATE_ACCOUNT_SQL.format(config_data_column='config_data, ', config_data_value="'', ")))
+    op.drop_table('account_config')
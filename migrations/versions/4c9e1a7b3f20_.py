@@ -0,0 +1,257 @@
+"""make the stored procedures use the same float arithmetic as Python
+
+Revision ID: 4c9e1a7b3f20
+Revises: e2b84f1d7a06
+Create Date: 2026-10-17 21:14:08.172903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c9e1a7b3f20'
+down_revision = 'e2b84f1d7a06'
+branch_labels = None
+depends_on = None
+
+
+# NOTE: The functions defined here must do exactly the same thing as
+# their Python counterparts in `swpt_accounts/models.py`. In
+# particular:
+#
+# 1) Casting a `double precision` to `numeric` keeps only 15
+#    significant digits, while `Decimal.from_float` is exact.
+#
+# 2) `extract(epoch FROM interval)` may round twice, while
+#    `timedelta.total_seconds()` divides the exact number of
+#    microseconds by 10**6.
+#
+# 3) psycopg2 receives `real` values as text, and Python converts
+#    them to the nearest `float`. This is not the same as casting
+#    `real` to `double precision`.
+
+UPGRADE_SQL = r"""
+CREATE FUNCTION float_to_numeric(p_value double precision) RETURNS numeric AS $$
+DECLARE
+    m double precision := p_value;
+    n integer := 0;
+    result numeric;
+BEGIN
+    -- Multiplying and dividing by 2 does not lose precision.
+    WHILE m != trunc(m) LOOP
+        m := m * 2.0;
+        n := n + 1;
+    END LOOP;
+    WHILE abs(m) >= 9007199254740992.0 LOOP
+        m := m / 2.0;
+        n := n - 1;
+    END LOOP;
+
+    result := m::bigint;
+    FOR i IN 1..n LOOP
+        result := result * 0.5;
+    END LOOP;
+    FOR i IN 1..-n LOOP
+        result := result * 2;
+    END LOOP;
+
+    RETURN result;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+
+CREATE FUNCTION to_microseconds(p_ts timestamp with time zone) RETURNS bigint AS $$
+    SELECT
+        extract(epoch FROM date_trunc('minute', p_ts AT TIME ZONE 'UTC'))::bigint * 1000000
+        + extract(microseconds FROM p_ts AT TIME ZONE 'UTC')::bigint
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE FUNCTION calc_seconds(
+    p_from_ts timestamp with time zone,
+    p_to_ts timestamp with time zone
+) RETURNS double precision AS $$
+    SELECT (to_microseconds(p_to_ts) - to_microseconds(p_from_ts))::double precision / 1000000.0::double precision
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE FUNCTION calc_k(p_interest_rate real) RETURNS double precision AS $$
+    SELECT calc_k(p_interest_rate::text::double precision)
+$$ LANGUAGE sql STABLE;
+
+
+CREATE OR REPLACE FUNCTION calc_current_balance(a account, p_current_ts timestamp with time zone) RETURNS numeric AS $$
+DECLARE
+    current_balance numeric := a.principal;
+    passed_seconds double precision;
+BEGIN
+    IF a.creditor_id != 0 THEN
+        current_balance := current_balance + float_to_numeric(a.interest);
+        IF current_balance > 0 THEN
+            passed_seconds := greatest(0.0, calc_seconds(a.last_change_ts, p_current_ts));
+            current_balance := current_balance * float_to_numeric(exp(calc_k(a.interest_rate) * passed_seconds));
+        END IF;
+    END IF;
+
+    RETURN current_balance;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+CREATE OR REPLACE FUNCTION calc_due_interest(
+    a account,
+    p_amount bigint,
+    p_due_ts timestamp with time zone,
+    p_current_ts timestamp with time zone
+) RETURNS double precision AS $$
+DECLARE
+    end_ts timestamp with time zone := greatest(p_due_ts, p_current_ts);
+    interest_rate_change_ts timestamp with time zone := least(a.last_interest_rate_change_ts, end_ts);
+    t double precision := calc_seconds(p_due_ts, end_ts);
+    t1 double precision := greatest(calc_seconds(p_due_ts, interest_rate_change_ts), 0.0);
+    t2 double precision := least(calc_seconds(interest_rate_change_ts, end_ts), t);
+BEGIN
+    RETURN p_amount * (exp(calc_k(a.previous_interest_rate) * t1 + calc_k(a.interest_rate) * t2) - 1.0);
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+CREATE OR REPLACE FUNCTION calc_status_code(
+    pt prepared_transfer,
+    p_committed_amount bigint,
+    p_expendable_amount numeric,
+    p_interest_rate real,
+    p_current_ts timestamp with time zone
+) RETURNS text AS $$
+DECLARE
+    demurrage_seconds double precision;
+    is_reserved boolean;
+BEGIN
+    IF p_committed_amount != 0 THEN
+        IF p_current_ts > pt.deadline THEN
+            RETURN 'TERMINATED';
+        END IF;
+
+        IF p_interest_rate < pt.min_interest_rate THEN
+            RETURN 'TERMINATED';
+        END IF;
+
+        IF p_committed_amount > p_expendable_amount + pt.locked_amount THEN
+            IF p_committed_amount > pt.locked_amount THEN
+                is_reserved := false;
+            ELSIF pt.sender_creditor_id = 0 THEN
+                is_reserved := true;
+            ELSE
+                demurrage_seconds := greatest(0.0, calc_seconds(pt.prepared_at, p_current_ts));
+                is_reserved := (
+                    p_committed_amount::double precision
+                    <= pt.locked_amount::double precision * exp(calc_k(pt.demurrage_rate) * demurrage_seconds)
+                );
+            END IF;
+
+            IF NOT is_reserved THEN
+                RETURN 'INSUFFICIENT_AVAILABLE_AMOUNT';
+            END IF;
+        END IF;
+    END IF;
+
+    RETURN 'OK';
+END;
+$$ LANGUAGE plpgsql STABLE;
+"""
+
+DOWNGRADE_SQL = r"""
+CREATE OR REPLACE FUNCTION calc_current_balance(a account, p_current_ts timestamp with time zone) RETURNS numeric AS $$
+DECLARE
+    current_balance numeric := a.principal;
+    passed_seconds double precision;
+BEGIN
+    IF a.creditor_id != 0 THEN
+        current_balance := current_balance + a.interest::numeric;
+        IF current_balance > 0 THEN
+            passed_seconds := greatest(0.0, extract(epoch FROM p_current_ts - a.last_change_ts)::double precision);
+            current_balance := current_balance * exp(calc_k(a.interest_rate) * passed_seconds)::numeric;
+        END IF;
+    END IF;
+
+    RETURN current_balance;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION calc_due_interest(
+    a account,
+    p_amount bigint,
+    p_due_ts timestamp with time zone,
+    p_current_ts timestamp with time zone
+) RETURNS double precision AS $$
+DECLARE
+    end_ts timestamp with time zone := greatest(p_due_ts, p_current_ts);
+    interest_rate_change_ts timestamp with time zone := least(a.last_interest_rate_change_ts, end_ts);
+    t double precision := extract(epoch FROM end_ts - p_due_ts)::double precision;
+    t1 double precision := greatest(extract(epoch FROM interest_rate_change_ts - p_due_ts)::double precision, 0.0);
+    t2 double precision := least(extract(epoch FROM end_ts - interest_rate_change_ts)::double precision, t);
+BEGIN
+    RETURN p_amount * (exp(calc_k(a.previous_interest_rate) * t1 + calc_k(a.interest_rate) * t2) - 1.0);
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION calc_status_code(
+    pt prepared_transfer,
+    p_committed_amount bigint,
+    p_expendable_amount numeric,
+    p_interest_rate real,
+    p_current_ts timestamp with time zone
+) RETURNS text AS $$
+DECLARE
+    demurrage_seconds double precision;
+    is_reserved boolean;
+BEGIN
+    IF p_committed_amount != 0 THEN
+        IF p_current_ts > pt.deadline THEN
+            RETURN 'TERMINATED';
+        END IF;
+
+        IF p_interest_rate < pt.min_interest_rate THEN
+            RETURN 'TERMINATED';
+        END IF;
+
+        IF p_committed_amount > p_expendable_amount + pt.locked_amount THEN
+            IF p_committed_amount > pt.locked_amount THEN
+                is_reserved := false;
+            ELSIF pt.sender_creditor_id = 0 THEN
+                is_reserved := true;
+            ELSE
+                demurrage_seconds := greatest(0.0, extract(epoch FROM p_current_ts - pt.prepared_at)::double precision);
+                is_reserved := (
+                    p_committed_amount::double precision
+                    <= pt.locked_amount::double precision * exp(calc_k(pt.demurrage_rate) * demurrage_seconds)
+                );
+            END IF;
+
+            IF NOT is_reserved THEN
+                RETURN 'INSUFFICIENT_AVAILABLE_AMOUNT';
+            END IF;
+        END IF;
+    END IF;
+
+    RETURN 'OK';
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+DROP FUNCTION calc_k(real);
+DROP FUNCTION calc_seconds(timestamp with time zone, timestamp with time zone);
+DROP FUNCTION to_microseconds(timestamp with time zone);
+DROP FUNCTION float_to_numeric(double precision);
+"""
+
+
+def upgrade():
+    op.execute(sa.text(UPGRADE_SQL))
+
+
+def downgrade():
+    op.execute(sa.text(DOWNGRADE_SQL))
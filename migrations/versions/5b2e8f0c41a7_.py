@@ -0,0 +1,46 @@
+"""notify the request processors about newly queued requests
+
+Revision ID: 5b2e8f0c41a7
+Revises: d7f09a1ecd05
+Create Date: 2026-10-17 11:03:52.118206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e8f0c41a7'
+down_revision = 'd7f09a1ecd05'
+branch_labels = None
+depends_on = None
+
+
+# NOTE: The name of the notification channel is the name of the
+# table. Postgres collapses identical notifications sent from the same
+# transaction into one, so a single notification is delivered per
+# transaction, no matter how many rows have been inserted.
+
+QUEUE_TABLES = ['transfer_request', 'finalization_request', 'pending_balance_change']
+
+
+def upgrade():
+    op.execute(sa.text("""
+CREATE FUNCTION notify_queue_insert() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify(TG_TABLE_NAME, '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""))
+    for table_name in QUEUE_TABLES:
+        op.execute(sa.text(
+            f'CREATE TRIGGER {table_name}_notify AFTER INSERT ON {table_name} '
+            f'FOR EACH STATEMENT EXECUTE PROCEDURE notify_queue_insert()'
+        ))
+
+
+def downgrade():
+    for table_name in QUEUE_TABLES:
+        op.execute(sa.text(f'DROP TRIGGER {table_name}_notify ON {table_name}'))
+    op.execute(sa.text('DROP FUNCTION notify_queue_insert()'))
@@ -0,0 +1,84 @@
+"""optionally hash-partition the signal tables by debtor_id
+
+Revision ID: a6d3e0b7c952
+Revises: 3f7a9c2d5b18
+Create Date: 2026-10-17 18:02:14.655130
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d3e0b7c952'
+down_revision = '3f7a9c2d5b18'
+branch_labels = None
+depends_on = None
+
+
+# NOTE: The signal tables are partitioned only if the configuration
+# variable APP_SIGNAL_TABLE_PARTITIONS is bigger than 1 at the time of
+# the upgrade. Changing the variable later has no effect on already
+# partitioned (or not partitioned) tables. Postgres does not allow
+# converting a table to a partitioned table, so the rows are copied.
+
+# For each signal table, the name of its auto-incremented column (if any).
+SIGNAL_TABLES = {
+    'rejected_transfer_signal': 'signal_id',
+    'prepared_transfer_signal': 'signal_id',
+    'finalized_transfer_signal': None,
+    'account_transfer_signal': None,
+    'account_update_signal': 'signal_id',
+    'account_purge_signal': None,
+    'rejected_config_signal': 'signal_id',
+    'pending_balance_change_signal': 'change_id',
+}
+
+
+def _is_partitioned(table_name):
+    relkind = op.get_bind().execute(
+        sa.text('SELECT relkind FROM pg_class WHERE oid = CAST(:table_name AS regclass)'),
+        table_name=table_name,
+    ).scalar()
+    return relkind == 'p'
+
+
+def _replace_table(table_name, serial_column, partitions):
+    old_table_name = f'{table_name}_old'
+    op.execute(f'ALTER TABLE {table_name} RENAME TO {old_table_name}')
+    op.execute(f'ALTER INDEX {table_name}_pkey RENAME TO {old_table_name}_pkey')
+
+    if partitions > 1:
+        op.execute(
+            f'CREATE TABLE {table_name} (LIKE {old_table_name} INCLUDING ALL) '
+            f'PARTITION BY HASH (debtor_id)'
+        )
+        for remainder in range(partitions):
+            op.execute(
+                f'CREATE TABLE {table_name}_{remainder} PARTITION OF {table_name} '
+                f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})'
+            )
+    else:
+        op.execute(f'CREATE TABLE {table_name} (LIKE {old_table_name} INCLUDING ALL)')
+
+    if serial_column is not None:
+        # The sequence would be dropped together with the old table,
+        # unless it is owned by the new one.
+        op.execute(f'ALTER SEQUENCE {table_name}_{serial_column}_seq OWNED BY {table_name}.{serial_column}')
+
+    op.execute(f'INSERT INTO {table_name} SELECT * FROM {old_table_name}')
+    op.execute(f'DROP TABLE {old_table_name}')
+
+
+def upgrade():
+    partitions = current_app.config['APP_SIGNAL_TABLE_PARTITIONS']
+    if partitions > 1:
+        for table_name, serial_column in SIGNAL_TABLES.items():
+            _replace_table(table_name, serial_column, partitions)
+
+
+def downgrade():
+    for table_name, serial_column in SIGNAL_TABLES.items():
+        if _is_partitioned(table_name):
+            _replace_table(table_name, serial_column, 1)
@@ -0,0 +1,605 @@
+"""stored procedures for processing queued requests
+
+Revision ID: d7f09a1ecd05
+Revises: bbcd77f71465
+Create Date: 2026-10-17 09:12:40.411527
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7f09a1ecd05'
+down_revision = 'bbcd77f71465'
+branch_labels = None
+depends_on = None
+
+
+# NOTE: The functions defined here must do exactly the same thing as
+# their Python counterparts in `swpt_accounts/procedures.py`. When
+# changing one of them, do not forget to change the other, and to run
+# the parity tests.
+
+UPGRADE_SQL = r"""
+CREATE FUNCTION calc_k(p_interest_rate double precision) RETURNS double precision AS $$
+    SELECT ln(1.0 + p_interest_rate / 100.0) / 31557600.0
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE FUNCTION increment_seqnum(p_seqnum integer) RETURNS integer AS $$
+    SELECT CASE WHEN p_seqnum = 2147483647 THEN -2147483648 ELSE p_seqnum + 1 END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE FUNCTION contain_principal_overflow(p_value numeric) RETURNS bigint AS $$
+    SELECT (CASE
+        WHEN p_value <= -9223372036854775808 THEN -9223372036854775807
+        WHEN p_value > 9223372036854775807 THEN 9223372036854775807
+        ELSE p_value
+    END)::bigint
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE FUNCTION calc_current_balance(a account, p_current_ts timestamp with time zone) RETURNS numeric AS $$
+DECLARE
+    current_balance numeric := a.principal;
+    passed_seconds double precision;
+BEGIN
+    IF a.creditor_id != 0 THEN
+        current_balance := current_balance + a.interest::numeric;
+        IF current_balance > 0 THEN
+            passed_seconds := greatest(0.0, extract(epoch FROM p_current_ts - a.last_change_ts)::double precision);
+            current_balance := current_balance * exp(calc_k(a.interest_rate) * passed_seconds)::numeric;
+        END IF;
+    END IF;
+
+    RETURN current_balance;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE FUNCTION calc_due_interest(
+    a account,
+    p_amount bigint,
+    p_due_ts timestamp with time zone,
+    p_current_ts timestamp with time zone
+) RETURNS double precision AS $$
+DECLARE
+    end_ts timestamp with time zone := greatest(p_due_ts, p_current_ts);
+    interest_rate_change_ts timestamp with time zone := least(a.last_interest_rate_change_ts, end_ts);
+    t double precision := extract(epoch FROM end_ts - p_due_ts)::double precision;
+    t1 double precision := greatest(extract(epoch FROM interest_rate_change_ts - p_due_ts)::double precision, 0.0);
+    t2 double precision := least(extract(epoch FROM end_ts - interest_rate_change_ts)::double precision, t);
+BEGIN
+    RETURN p_amount * (exp(calc_k(a.previous_interest_rate) * t1 + calc_k(a.interest_rate) * t2) - 1.0);
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE FUNCTION calc_status_code(
+    pt prepared_transfer,
+    p_committed_amount bigint,
+    p_expendable_amount numeric,
+    p_interest_rate real,
+    p_current_ts timestamp with time zone
+) RETURNS text AS $$
+DECLARE
+    demurrage_seconds double precision;
+    is_reserved boolean;
+BEGIN
+    IF p_committed_amount != 0 THEN
+        IF p_current_ts > pt.deadline THEN
+            RETURN 'TERMINATED';
+        END IF;
+
+        IF p_interest_rate < pt.min_interest_rate THEN
+            RETURN 'TERMINATED';
+        END IF;
+
+        IF p_committed_amount > p_expendable_amount + pt.locked_amount THEN
+            IF p_committed_amount > pt.locked_amount THEN
+                is_reserved := false;
+            ELSIF pt.sender_creditor_id = 0 THEN
+                is_reserved := true;
+            ELSE
+                demurrage_seconds := greatest(0.0, extract(epoch FROM p_current_ts - pt.prepared_at)::double precision);
+                is_reserved := (
+                    p_committed_amount::double precision
+                    <= pt.locked_amount::double precision * exp(calc_k(pt.demurrage_rate) * demurrage_seconds)
+                );
+            END IF;
+
+            IF NOT is_reserved THEN
+                RETURN 'INSUFFICIENT_AVAILABLE_AMOUNT';
+            END IF;
+        END IF;
+    END IF;
+
+    RETURN 'OK';
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE FUNCTION save_account(a account) RETURNS void AS $$
+    UPDATE account
+    SET
+        last_change_seqnum = a.last_change_seqnum,
+        last_change_ts = a.last_change_ts,
+        principal = a.principal,
+        interest = a.interest,
+        last_transfer_number = a.last_transfer_number,
+        last_transfer_committed_at = a.last_transfer_committed_at,
+        status_flags = a.status_flags,
+        total_locked_amount = a.total_locked_amount,
+        pending_transfers_count = a.pending_transfers_count,
+        last_transfer_id = a.last_transfer_id,
+        last_heartbeat_ts = a.last_heartbeat_ts,
+        pending_account_update = a.pending_account_update
+    WHERE debtor_id = a.debtor_id AND creditor_id = a.creditor_id
+$$ LANGUAGE sql;
+
+
+CREATE FUNCTION insert_account_update_signal(
+    INOUT a account,
+    p_current_ts timestamp with time zone
+) AS $$
+BEGIN
+    a.last_heartbeat_ts := p_current_ts;
+    a.pending_account_update := false;
+
+    INSERT INTO account_update_signal (
+        debtor_id, creditor_id, last_change_seqnum, last_change_ts, principal, interest,
+        interest_rate, last_interest_rate_change_ts, last_transfer_number,
+        last_transfer_committed_at, last_config_ts, last_config_seqnum, creation_date,
+        negligible_amount, config_data, config_flags, debtor_info_iri,
+        debtor_info_content_type, debtor_info_sha256, inserted_at
+    )
+    VALUES (
+        a.debtor_id, a.creditor_id, a.last_change_seqnum, a.last_change_ts, a.principal, a.interest,
+        a.interest_rate, a.last_interest_rate_change_ts, a.last_transfer_number,
+        a.last_transfer_committed_at, a.last_config_ts, a.last_config_seqnum, a.creation_date,
+        a.negligible_amount, a.config_data, a.config_flags, a.debtor_info_iri,
+        a.debtor_info_content_type, a.debtor_info_sha256, a.last_change_ts
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE FUNCTION insert_account_transfer_signal(
+    INOUT a account,
+    p_coordinator_type text,
+    p_other_creditor_id bigint,
+    p_committed_at timestamp with time zone,
+    p_acquired_amount bigint,
+    p_transfer_note_format text,
+    p_transfer_note text,
+    p_principal bigint,
+    p_current_ts timestamp with time zone
+) AS $$
+BEGIN
+    -- We do not send notifications for transfers from/to the
+    -- debtor's account, nor for negligible transfers.
+    IF a.creditor_id != 0 AND NOT (
+            0 < p_acquired_amount AND p_acquired_amount::double precision <= a.negligible_amount) THEN
+        a.last_transfer_number := a.last_transfer_number + 1;
+        a.last_transfer_committed_at := p_committed_at;
+
+        INSERT INTO account_transfer_signal (
+            debtor_id, creditor_id, creation_date, transfer_number, coordinator_type,
+            committed_at, acquired_amount, other_creditor_id, transfer_note_format,
+            transfer_note, principal, previous_transfer_number, inserted_at
+        )
+        VALUES (
+            a.debtor_id, a.creditor_id, a.creation_date, a.last_transfer_number, p_coordinator_type,
+            p_committed_at, p_acquired_amount, p_other_creditor_id, p_transfer_note_format,
+            p_transfer_note, p_principal, a.last_transfer_number - 1, p_current_ts
+        );
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE FUNCTION apply_account_change(
+    INOUT a account,
+    p_principal_delta numeric,
+    p_interest_delta double precision,
+    p_current_ts timestamp with time zone
+) AS $$
+DECLARE
+    principal_possibly_overflown numeric := a.principal + p_principal_delta;
+    new_principal bigint := contain_principal_overflow(principal_possibly_overflown);
+BEGIN
+    a.interest := (calc_current_balance(a, p_current_ts) - a.principal)::double precision + p_interest_delta;
+
+    IF new_principal != principal_possibly_overflown THEN
+        a.status_flags := a.status_flags | 2;
+    END IF;
+
+    a.principal := new_principal;
+    a.last_change_seqnum := increment_seqnum(a.last_change_seqnum);
+    a.last_change_ts := greatest(a.last_change_ts, p_current_ts);
+    a.pending_account_update := true;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE FUNCTION lock_or_create_account(
+    p_debtor_id bigint,
+    p_creditor_id bigint,
+    p_current_ts timestamp with time zone
+) RETURNS account AS $$
+DECLARE
+    a account%ROWTYPE;
+    creation_date date := (p_current_ts AT TIME ZONE 'UTC')::date;
+    t0 timestamp with time zone := '1970-01-01T00:00:00+00:00';
+BEGIN
+    SELECT * INTO a
+    FROM account
+    WHERE debtor_id = p_debtor_id AND creditor_id = p_creditor_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        INSERT INTO account (
+            debtor_id, creditor_id, creation_date, last_change_seqnum, last_change_ts, principal,
+            interest_rate, interest, last_interest_rate_change_ts, last_config_ts,
+            last_config_seqnum, last_transfer_number, last_transfer_committed_at,
+            negligible_amount, config_flags, config_data, status_flags, total_locked_amount,
+            pending_transfers_count, last_transfer_id, previous_interest_rate, last_heartbeat_ts,
+            last_interest_capitalization_ts, last_deletion_attempt_ts, pending_account_update
+        )
+        VALUES (
+            p_debtor_id, p_creditor_id, creation_date, 0, p_current_ts, 0,
+            0.0, 0.0, t0, t0,
+            0, 0, t0,
+            0.0, 0, '', 0, 0,
+            0, (creation_date - '1970-01-01'::date)::bigint << 40, 0.0, p_current_ts,
+            t0, t0, false
+        )
+        ON CONFLICT DO NOTHING
+        RETURNING * INTO a;
+
+        IF NOT FOUND THEN
+            -- The account has been created by a concurrent transaction.
+            RAISE EXCEPTION 'concurrent account creation' USING ERRCODE = 'serialization_failure';
+        END IF;
+
+        a := insert_account_update_signal(a, p_current_ts);
+    END IF;
+
+    IF a.status_flags & 1 != 0 THEN
+        a.status_flags := a.status_flags & ~1;
+        a.last_change_seqnum := increment_seqnum(a.last_change_seqnum);
+        a.last_change_ts := greatest(a.last_change_ts, p_current_ts);
+        a := insert_account_update_signal(a, p_current_ts);
+    END IF;
+
+    RETURN a;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE FUNCTION process_transfer_requests(
+    p_debtor_id bigint,
+    p_creditor_id bigint,
+    p_commit_period double precision,
+    p_current_ts timestamp with time zone,
+    p_checked_recipients bigint[] DEFAULT NULL,
+    p_reachable_recipients bigint[] DEFAULT NULL
+) RETURNS void AS $$
+DECLARE
+    a account%ROWTYPE;
+    tr transfer_request%ROWTYPE;
+    is_locked boolean := false;
+    has_account boolean := false;
+    status_code text;
+    expendable_amount numeric;
+    transfer_commit_period double precision;
+    deadline timestamp with time zone;
+BEGIN
+    FOR tr IN
+        SELECT *
+        FROM transfer_request
+        WHERE
+            debtor_id = p_debtor_id
+            AND sender_creditor_id = p_creditor_id
+            AND (p_checked_recipients IS NULL OR recipient_creditor_id = ANY(p_checked_recipients))
+        ORDER BY transfer_request_id
+        FOR UPDATE SKIP LOCKED
+    LOOP
+        IF NOT is_locked THEN
+            SELECT * INTO a
+            FROM account
+            WHERE debtor_id = p_debtor_id AND creditor_id = p_creditor_id
+            FOR UPDATE;
+
+            has_account := FOUND AND a.status_flags & 1 = 0;
+            is_locked := true;
+        END IF;
+
+        DELETE FROM transfer_request
+        WHERE
+            debtor_id = tr.debtor_id
+            AND sender_creditor_id = tr.sender_creditor_id
+            AND transfer_request_id = tr.transfer_request_id;
+
+        status_code := NULL;
+        IF NOT has_account THEN
+            status_code := 'SENDER_IS_UNREACHABLE';
+        ELSIF p_checked_recipients IS NOT NULL
+                AND NOT coalesce(tr.recipient_creditor_id = ANY(p_reachable_recipients), false) THEN
+            status_code := 'RECIPIENT_IS_UNREACHABLE';
+        ELSIF a.pending_transfers_count >= 2147483647 THEN
+            status_code := 'TOO_MANY_TRANSFERS';
+        ELSIF tr.sender_creditor_id = tr.recipient_creditor_id THEN
+            status_code := 'RECIPIENT_SAME_AS_SENDER';
+        ELSIF a.interest_rate < tr.min_interest_rate THEN
+            status_code := 'TERMINATED';
+        ELSE
+            expendable_amount := (
+                contain_principal_overflow(floor(calc_current_balance(a, p_current_ts)) - a.total_locked_amount)
+                - CASE WHEN p_creditor_id = 0 THEN -9223372036854775807 ELSE 0 END
+            );
+            expendable_amount := greatest(0, least(expendable_amount, tr.max_locked_amount));
+
+            -- The available amount should be checked last. (See the
+            -- comment in `_process_transfer_request`.)
+            IF expendable_amount < tr.min_locked_amount THEN
+                status_code := 'INSUFFICIENT_AVAILABLE_AMOUNT';
+            END IF;
+        END IF;
+
+        IF status_code IS NOT NULL THEN
+            INSERT INTO rejected_transfer_signal (
+                debtor_id, sender_creditor_id, coordinator_type, coordinator_id,
+                coordinator_request_id, status_code, total_locked_amount, inserted_at
+            )
+            VALUES (
+                tr.debtor_id, tr.sender_creditor_id, tr.coordinator_type, tr.coordinator_id,
+                tr.coordinator_request_id, status_code,
+                CASE WHEN has_account THEN a.total_locked_amount ELSE 0 END, p_current_ts
+            );
+            CONTINUE;
+        END IF;
+
+        a.total_locked_amount := least(a.total_locked_amount + expendable_amount, 9223372036854775807);
+        a.pending_transfers_count := a.pending_transfers_count + 1;
+        a.last_transfer_id := a.last_transfer_id + 1;
+
+        -- When a real interest rate constraint is set, we put an
+        -- upper limit of one day on the deadline. (See the comment in
+        -- `_process_transfer_request`.)
+        IF tr.min_interest_rate > -50.0 THEN
+            transfer_commit_period := least(p_commit_period, 86400);
+        ELSE
+            transfer_commit_period := p_commit_period;
+        END IF;
+
+        deadline := least(p_current_ts + transfer_commit_period * interval '1 second', tr.deadline);
+
+        INSERT INTO prepared_transfer (
+            debtor_id, sender_creditor_id, transfer_id, coordinator_type, coordinator_id,
+            coordinator_request_id, locked_amount, recipient_creditor_id, min_interest_rate,
+            demurrage_rate, deadline, prepared_at
+        )
+        VALUES (
+            tr.debtor_id, tr.sender_creditor_id, a.last_transfer_id, tr.coordinator_type, tr.coordinator_id,
+            tr.coordinator_request_id, expendable_amount, tr.recipient_creditor_id, tr.min_interest_rate,
+            -50.0, deadline, p_current_ts
+        );
+
+        INSERT INTO prepared_transfer_signal (
+            debtor_id, sender_creditor_id, transfer_id, coordinator_type, coordinator_id,
+            coordinator_request_id, locked_amount, recipient_creditor_id, prepared_at,
+            demurrage_rate, deadline, min_interest_rate, inserted_at
+        )
+        VALUES (
+            tr.debtor_id, tr.sender_creditor_id, a.last_transfer_id, tr.coordinator_type, tr.coordinator_id,
+            tr.coordinator_request_id, expendable_amount, tr.recipient_creditor_id, p_current_ts,
+            -50.0, deadline, tr.min_interest_rate, p_current_ts
+        );
+    END LOOP;
+
+    IF has_account THEN
+        PERFORM save_account(a);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE FUNCTION process_finalization_requests(
+    p_debtor_id bigint,
+    p_sender_creditor_id bigint,
+    p_current_ts timestamp with time zone
+) RETURNS void AS $$
+DECLARE
+    a account%ROWTYPE;
+    fr finalization_request%ROWTYPE;
+    pt prepared_transfer%ROWTYPE;
+    is_locked boolean := false;
+    has_account boolean := false;
+    starting_balance numeric;
+    min_account_balance numeric := CASE WHEN p_sender_creditor_id = 0 THEN -9223372036854775807 ELSE 0 END;
+    principal_delta numeric := 0;
+    expendable_amount numeric;
+    status_code text;
+    committed_amount bigint;
+BEGIN
+    FOR fr IN
+        SELECT *
+        FROM finalization_request
+        WHERE debtor_id = p_debtor_id AND sender_creditor_id = p_sender_creditor_id
+        ORDER BY transfer_id
+        FOR UPDATE SKIP LOCKED
+    LOOP
+        IF NOT is_locked THEN
+            SELECT * INTO a
+            FROM account
+            WHERE debtor_id = p_debtor_id AND creditor_id = p_sender_creditor_id
+            FOR UPDATE;
+
+            has_account := FOUND AND a.status_flags & 1 = 0;
+            IF has_account THEN
+                starting_balance := floor(calc_current_balance(a, p_current_ts));
+            END IF;
+            is_locked := true;
+        END IF;
+
+        SELECT * INTO pt
+        FROM prepared_transfer
+        WHERE
+            debtor_id = fr.debtor_id
+            AND sender_creditor_id = fr.sender_creditor_id
+            AND transfer_id = fr.transfer_id
+            AND coordinator_type = fr.coordinator_type
+            AND coordinator_id = fr.coordinator_id
+            AND coordinator_request_id = fr.coordinator_request_id;
+
+        IF has_account AND FOUND THEN
+            expendable_amount := starting_balance + principal_delta - a.total_locked_amount - min_account_balance;
+            a.total_locked_amount := greatest(0, a.total_locked_amount - pt.locked_amount);
+            a.pending_transfers_count := greatest(0, a.pending_transfers_count - 1);
+            status_code := calc_status_code(pt, fr.committed_amount, expendable_amount, a.interest_rate, p_current_ts);
+            committed_amount := CASE WHEN status_code = 'OK' THEN fr.committed_amount ELSE 0 END;
+
+            INSERT INTO finalized_transfer_signal (
+                debtor_id, sender_creditor_id, transfer_id, coordinator_type, coordinator_id,
+                coordinator_request_id, prepared_at, finalized_at, committed_amount,
+                total_locked_amount, status_code, inserted_at
+            )
+            VALUES (
+                pt.debtor_id, pt.sender_creditor_id, pt.transfer_id, pt.coordinator_type, pt.coordinator_id,
+                pt.coordinator_request_id, pt.prepared_at, p_current_ts, committed_amount,
+                a.total_locked_amount, status_code, p_current_ts
+            );
+
+            IF committed_amount > 0 THEN
+                a := insert_account_transfer_signal(
+                    a, pt.coordinator_type, pt.recipient_creditor_id, p_current_ts, -committed_amount,
+                    fr.transfer_note_format, fr.transfer_note,
+                    contain_principal_overflow(a.principal::numeric - committed_amount), p_current_ts
+                );
+
+                INSERT INTO pending_balance_change_signal (
+                    debtor_id, other_creditor_id, creditor_id, committed_at, coordinator_type,
+                    transfer_note_format, transfer_note, principal_delta, inserted_at
+                )
+                VALUES (
+                    pt.debtor_id, pt.sender_creditor_id, pt.recipient_creditor_id, p_current_ts, pt.coordinator_type,
+                    fr.transfer_note_format, fr.transfer_note, committed_amount, p_current_ts
+                );
+            END IF;
+
+            principal_delta := principal_delta - committed_amount;
+
+            DELETE FROM prepared_transfer
+            WHERE
+                debtor_id = pt.debtor_id
+                AND sender_creditor_id = pt.sender_creditor_id
+                AND transfer_id = pt.transfer_id;
+        END IF;
+
+        DELETE FROM finalization_request
+        WHERE
+            debtor_id = fr.debtor_id
+            AND sender_creditor_id = fr.sender_creditor_id
+            AND transfer_id = fr.transfer_id;
+    END LOOP;
+
+    IF has_account THEN
+        IF principal_delta != 0 THEN
+            a := apply_account_change(a, principal_delta, 0.0, p_current_ts);
+        END IF;
+
+        PERFORM save_account(a);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE FUNCTION process_pending_balance_changes(
+    p_debtor_id bigint,
+    p_creditor_id bigint,
+    p_current_ts timestamp with time zone
+) RETURNS void AS $$
+DECLARE
+    a account%ROWTYPE;
+    change pending_balance_change%ROWTYPE;
+    is_locked boolean := false;
+    principal_delta numeric := 0;
+    interest_delta double precision := 0.0;
+BEGIN
+    FOR change IN
+        SELECT *
+        FROM pending_balance_change
+        WHERE debtor_id = p_debtor_id AND creditor_id = p_creditor_id
+        ORDER BY other_creditor_id, change_id
+        FOR UPDATE SKIP LOCKED
+    LOOP
+        IF NOT is_locked THEN
+            a := lock_or_create_account(p_debtor_id, p_creditor_id, p_current_ts);
+            is_locked := true;
+        END IF;
+
+        principal_delta := principal_delta + change.principal_delta;
+
+        -- We should compensate for the fact that the transfer was
+        -- committed at `change.committed_at`, but the transferred
+        -- amount is being added to the account's principal just now.
+        interest_delta := interest_delta + calc_due_interest(
+            a, change.principal_delta, change.committed_at, p_current_ts);
+
+        a := insert_account_transfer_signal(
+            a, change.coordinator_type, change.other_creditor_id, change.committed_at, change.principal_delta,
+            change.transfer_note_format, change.transfer_note,
+            contain_principal_overflow(a.principal + principal_delta), p_current_ts
+        );
+
+        DELETE FROM pending_balance_change
+        WHERE
+            debtor_id = change.debtor_id
+            AND other_creditor_id = change.other_creditor_id
+            AND change_id = change.change_id;
+
+        UPDATE registered_balance_change
+        SET is_applied = true
+        WHERE
+            debtor_id = change.debtor_id
+            AND other_creditor_id = change.other_creditor_id
+            AND change_id = change.change_id;
+    END LOOP;
+
+    IF is_locked THEN
+        a := apply_account_change(a, principal_delta, interest_delta, p_current_ts);
+        PERFORM save_account(a);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+DOWNGRADE_SQL = r"""
+DROP FUNCTION process_pending_balance_changes(bigint, bigint, timestamp with time zone);
+DROP FUNCTION process_finalization_requests(bigint, bigint, timestamp with time zone);
+DROP FUNCTION process_transfer_requests(
+    bigint, bigint, double precision, timestamp with time zone, bigint[], bigint[]);
+DROP FUNCTION lock_or_create_account(bigint, bigint, timestamp with time zone);
+DROP FUNCTION apply_account_change(account, numeric, double precision, timestamp with time zone);
+DROP FUNCTION insert_account_transfer_signal(
+    account, text, bigint, timestamp with time zone, bigint, text, text, bigint, timestamp with time zone);
+DROP FUNCTION insert_account_update_signal(account, timestamp with time zone);
+DROP FUNCTION save_account(account);
+DROP FUNCTION calc_status_code(prepared_transfer, bigint, numeric, real, timestamp with time zone);
+DROP FUNCTION calc_due_interest(account, bigint, timestamp with time zone, timestamp with time zone);
+DROP FUNCTION calc_current_balance(account, timestamp with time zone);
+DROP FUNCTION contain_principal_overflow(numeric);
+DROP FUNCTION increment_seqnum(integer);
+DROP FUNCTION calc_k(double precision);
+"""
+
+
+def upgrade():
+    op.execute(sa.text(UPGRADE_SQL))
+
+
+def downgrade():
+    op.execute(sa.text(DOWNGRADE_SQL))
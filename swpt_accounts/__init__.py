@@ -159,12 +159,30 @@ class Configuration(metaclass=MetaEnvReader):
     APP_PROCESS_BALANCE_CHANGES_THREADS = 1
     APP_PROCESS_BALANCE_CHANGES_WAIT = 5.0
     APP_PROCESS_BALANCE_CHANGES_MAX_COUNT = 500000
+    APP_PROCESS_BALANCE_CHANGES_CHUNK_SIZE = 1
+    APP_ROOT_ACCOUNT_SHARDS = 1
     APP_PROCESS_TRANSFER_REQUESTS_THREADS = 1
     APP_PROCESS_TRANSFER_REQUESTS_WAIT = 5.0
     APP_PROCESS_TRANSFER_REQUESTS_MAX_COUNT = 500000
+    APP_DEFER_REACHABILITY_CHECKS = False
     APP_PROCESS_FINALIZATION_REQUESTS_THREADS = 1
     APP_PROCESS_FINALIZATION_REQUESTS_WAIT = 5.0
     APP_PROCESS_FINALIZATION_REQUESTS_MAX_COUNT = 500000
+    APP_PROCESS_REQUESTS_THREADS = 1
+    APP_PROCESS_REQUESTS_WAIT = 5.0
+    APP_PROCESS_REQUESTS_MAX_COUNT = 500000
+    APP_USE_STORED_PROCEDURES = False
+    APP_PIPELINED_PROCESSING = False
+    APP_AFFINE_WORKERS = False
+    APP_WORKER_ACCOUNT_CACHE_SIZE = 1000
+    APP_CONSUME_BATCHES_MAX_COUNT = 100
+    APP_CONSUME_BATCHES_WAIT = 0.05
+    APP_SIGNAL_TABLE_PARTITIONS = 1
+    APP_FLUSH_SIGNALS_THREADS = 1
+    APP_FLUSH_SIGNALS_WAIT = 5.0
+    APP_USE_OUTBOX = False
+    APP_PUBLISH_OUTBOX_WAIT = 5.0
+    APP_PUBLISH_OUTBOX_BURST_COUNT = 10000
     APP_FLUSH_REJECTED_TRANSFERS_BURST_COUNT = 10000
     APP_FLUSH_PREPARED_TRANSFERS_BURST_COUNT = 10000
     APP_FLUSH_FINALIZED_TRANSFERS_BURST_COUNT = 10000
@@ -186,6 +204,9 @@ class Configuration(metaclass=MetaEnvReader):
     APP_FETCH_DNS_CACHE_SECONDS = 10.0
     APP_FETCH_CONNECTIONS = 100
     APP_FETCH_DATA_CACHE_SIZE = 1000
+    APP_FETCH_REACHABLE_CACHE_SIZE = 10000
+    APP_FETCH_REACHABLE_CACHE_SECONDS = 600.0
+    APP_FETCH_UNREACHABLE_CACHE_SECONDS = 10.0
     APP_MIN_INTEREST_CAPITALIZATION_DAYS = 14.0
     APP_MAX_INTEREST_TO_PRINCIPAL_RATIO = 0.0001
     APP_DELETION_ATTEMPTS_MIN_DAYS = 14.0
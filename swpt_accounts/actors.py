@@ -1,16 +1,25 @@
 import re
+import logging
+import threading
 from datetime import datetime
+from typing import TypeVar, Callable, Optional, Sequence, List, Tuple, Dict, Set
+import dramatiq
 from flask import current_app
-from swpt_lib.utils import u64_to_i64
-from swpt_accounts.extensions import protocol_broker, APP_QUEUE_NAME
+from swpt_lib.utils import u64_to_i64, Seqnum
+from swpt_accounts.extensions import db, protocol_broker, APP_QUEUE_NAME
 from swpt_accounts.models import MIN_INT32, MAX_INT32, MIN_INT64, MAX_INT64, T0, TRANSFER_NOTE_MAX_BYTES, \
     CONFIG_DATA_MAX_BYTES, SECONDS_IN_DAY
-from swpt_accounts.fetch_api_client import get_if_account_is_reachable
+from swpt_accounts.fetch_api_client import get_if_account_is_reachable, get_reachable_creditor_ids
 from swpt_accounts import procedures
 from swpt_accounts.fetch_api_client import get_root_config_data_dict
 
+T = TypeVar('T')
+atomic: Callable[[T], T] = db.atomic
+
 RE_TRANSFER_NOTE_FORMAT = re.compile(r'^[0-9A-Za-z.-]{0,8}$')
 
+_batch_state = threading.local()
+
 
 @protocol_broker.actor(queue_name=APP_QUEUE_NAME)
 def configure_account(
@@ -33,7 +42,7 @@ def configure_account(
     assert MIN_INT32 <= config_flags <= MAX_INT32
     assert len(config_data) <= CONFIG_DATA_MAX_BYTES and len(config_data.encode('utf8')) <= CONFIG_DATA_MAX_BYTES
 
-    _configure_and_initialize_account(
+    config = dict(
         debtor_id=debtor_id,
         creditor_id=creditor_id,
         ts=parsed_ts,
@@ -42,6 +51,13 @@ def configure_account(
         config_flags=config_flags,
         config_data=config_data,
     )
+    batch = _get_current_batch()
+    if batch is None:
+        _configure_and_initialize_account(**config)
+    else:
+        # Only the newest valid configuration for each account in the
+        # batch will be applied.
+        batch.register_config(config)
 
 
 @protocol_broker.actor(queue_name=APP_QUEUE_NAME)
@@ -71,12 +87,13 @@ def prepare_transfer(
     assert parsed_ts > T0
     assert 0 <= max_commit_delay <= MAX_INT32
 
-    try:
-        recipient_creditor_id = u64_to_i64(int(recipient))
-    except ValueError:
-        is_reachable = False
-    else:
-        is_reachable = get_if_account_is_reachable(debtor_id, recipient_creditor_id)
+    # NOTE: When the reachability checks are deferred, the recipient
+    # will be checked by the transfer requests processor, for all
+    # queued transfer requests from the sender at once.
+    recipient_creditor_id = _parse_recipient(recipient)
+    is_reachable = recipient_creditor_id is not None and (
+        current_app.config['APP_DEFER_REACHABILITY_CHECKS'] or _is_reachable(debtor_id, recipient_creditor_id)
+    )
 
     procedures.prepare_transfer(
         coordinator_type,
@@ -163,7 +180,7 @@ def on_pending_balance_change_signal(
     assert -MAX_INT64 <= principal_delta <= MAX_INT64
     assert MIN_INT64 <= other_creditor_id <= MAX_INT64
 
-    procedures.insert_pending_balance_change(
+    change = dict(
         debtor_id=debtor_id,
         creditor_id=creditor_id,
         change_id=change_id,
@@ -173,8 +190,16 @@ def on_pending_balance_change_signal(
         committed_at=parsed_committed_at,
         principal_delta=principal_delta,
         other_creditor_id=other_creditor_id,
-        cutoff_ts=current_app.config['APP_REGISTERED_BALANCE_CHANGES_RETENTION_DATETIME'],
     )
+    batch = _get_current_batch()
+    if batch is None:
+        procedures.insert_pending_balance_change(
+            **change,
+            cutoff_ts=current_app.config['APP_REGISTERED_BALANCE_CHANGES_RETENTION_DATETIME'],
+        )
+    else:
+        # All balance changes in the batch will be inserted at once.
+        batch.pending_balance_changes.append(change)
 
 
 def _configure_and_initialize_account(
@@ -199,7 +224,24 @@ def _configure_and_initialize_account(
         signalbus_max_delay_seconds=signalbus_max_delay_seconds,
     )
     if should_be_initialized:
-        root_config_data = get_root_config_data_dict([debtor_id]).get(debtor_id)
+        batch = _get_current_batch()
+        if batch is None:
+            _initialize_accounts([(debtor_id, creditor_id)])
+        else:
+            # The account will be initialized after the batch
+            # transaction has been committed.
+            batch.accounts_to_initialize.append((debtor_id, creditor_id))
+
+
+def _initialize_accounts(accounts: Sequence[Tuple[int, int]]) -> None:
+    if not accounts:
+        return
+
+    signalbus_max_delay_seconds = current_app.config['APP_SIGNALBUS_MAX_DELAY_DAYS'] * SECONDS_IN_DAY
+    root_config_data_dict = get_root_config_data_dict(list({debtor_id for debtor_id, _ in accounts}))
+
+    for debtor_id, creditor_id in accounts:
+        root_config_data = root_config_data_dict.get(debtor_id)
 
         if root_config_data:
             procedures.change_interest_rate(
@@ -215,3 +257,199 @@ def _configure_and_initialize_account(
                 debtor_info_content_type=root_config_data.info_content_type,
                 debtor_info_sha256=root_config_data.info_sha256,
             )
+
+
+def _parse_recipient(recipient: str) -> Optional[int]:
+    try:
+        return u64_to_i64(int(recipient))
+    except ValueError:
+        return None
+
+
+def _is_reachable(debtor_id: int, creditor_id: int) -> bool:
+    batch = _get_current_batch()
+    if batch is not None:
+        try:
+            return batch.reachable_accounts[(debtor_id, creditor_id)]
+        except KeyError:
+            pass
+
+    return get_if_account_is_reachable(debtor_id, creditor_id)
+
+
+class _MessageBatch:
+    def __init__(self, messages: Sequence[dramatiq.Message]):
+        self.messages = messages
+        self.reachable_accounts: Dict[Tuple[int, int], bool] = {}
+        self.accounts_to_initialize: List[Tuple[int, int]] = []
+        self.pending_balance_changes: List[dict] = []
+        self.configs: Dict[Tuple[int, int], dict] = {}
+        self.invalid_configs: Dict[Tuple[int, int], List[dict]] = {}
+
+    def check_reachable_accounts(self) -> None:
+        # The recipients' reachability is checked before the database
+        # transaction has been started, so that no database locks are
+        # held while waiting for the HTTP responses.
+        if current_app.config['APP_DEFER_REACHABILITY_CHECKS']:
+            return
+
+        recipients_by_debtor: Dict[int, Set[int]] = {}
+        for message in self.messages:
+            if message.actor_name == 'prepare_transfer':
+                try:
+                    debtor_id = message.kwargs['debtor_id']
+                    recipient_creditor_id = _parse_recipient(message.kwargs['recipient'])
+                except (KeyError, TypeError):
+                    continue
+
+                if recipient_creditor_id is not None and type(debtor_id) is int and MIN_INT64 <= debtor_id <= MAX_INT64:
+                    recipients_by_debtor.setdefault(debtor_id, set()).add(recipient_creditor_id)
+
+        for debtor_id, recipients in recipients_by_debtor.items():
+            reachable_recipients = get_reachable_creditor_ids(debtor_id, recipients)
+            for recipient_creditor_id in recipients:
+                key = (debtor_id, recipient_creditor_id)
+                self.reachable_accounts[key] = recipient_creditor_id in reachable_recipients
+
+    def register_config(self, config: dict) -> None:
+        account = (config['debtor_id'], config['creditor_id'])
+        if not procedures.is_valid_config(config['creditor_id'], config['negligible_amount'], config['config_data']):
+            # Invalid configurations do not change the account, but
+            # each one of them may need to be rejected. Therefore,
+            # they can not be coalesced.
+            self.invalid_configs.setdefault(account, []).append(config)
+            return
+
+        # NOTE: Valid configurations superseded by a newer valid
+        # configuration for the same account are discarded, exactly
+        # as `procedures.configure_account` would discard them if
+        # they were processed after the newer one.
+        newest_config = self.configs.get(account)
+        if newest_config is None or _get_config_event(config) > _get_config_event(newest_config):
+            self.configs[account] = config
+
+    def reset(self) -> None:
+        self.accounts_to_initialize.clear()
+        self.pending_balance_changes.clear()
+        self.configs.clear()
+        self.invalid_configs.clear()
+
+
+def _get_config_event(config: dict) -> Tuple[datetime, Seqnum]:
+    return config['ts'], Seqnum(config['seqnum'])
+
+
+def _get_current_batch() -> Optional[_MessageBatch]:
+    return getattr(_batch_state, 'batch', None)
+
+
+def _process_message(message: dramatiq.Message) -> None:
+    actor = _BATCH_ACTORS[message.actor_name]
+    actor(*message.args, **message.kwargs)
+
+
+@atomic
+def _process_messages(batch: _MessageBatch) -> None:
+    # NOTE: If a serialization error occurs, the atomic block will
+    # re-execute this function, so we must clean up the leftovers
+    # from the previous attempt.
+    batch.reset()
+
+    for message in batch.messages:
+        _process_message(message)
+
+    # The accounts are configured in primary key order, to reduce the
+    # chance of deadlocks with concurrent batches. The invalid
+    # configurations go first, so that they are checked against the
+    # account's configuration before the batch, as if they were
+    # processed before the valid ones.
+    for account in sorted(batch.configs.keys() | batch.invalid_configs.keys()):
+        for config in batch.invalid_configs.get(account, ()):
+            _configure_and_initialize_account(**config)
+        if account in batch.configs:
+            _configure_and_initialize_account(**batch.configs[account])
+
+    procedures.insert_pending_balance_changes(
+        batch.pending_balance_changes,
+        cutoff_ts=current_app.config['APP_REGISTERED_BALANCE_CHANGES_RETENTION_DATETIME'],
+    )
+
+
+def process_message_batch(messages: Sequence[dramatiq.Message]) -> List[Optional[bool]]:
+    """Process a batch of protocol messages in a single database transaction.
+
+    Returns a list, with one element for each message: `True` if the
+    message has been processed successfully, `False` if the message
+    is invalid, and `None` if the message could not be processed due
+    to a (probably temporary) error, and should be retried later. If
+    the batch transaction fails, the messages are processed again,
+    this time one by one, so that one invalid message would not
+    prevent the rest from being processed.
+
+    """
+
+    batch = _MessageBatch(messages)
+    batch.check_reachable_accounts()
+    _batch_state.batch = batch
+    try:
+        _process_messages(batch)
+    except Exception:
+        logger = logging.getLogger(__name__)
+        logger.warning('Failed to process a batch of %i messages. Retrying one by one.', len(messages))
+        batch = None
+    finally:
+        _batch_state.batch = None
+
+    if batch is None:
+        return [_process_message_safely(message) for message in messages]
+
+    try:
+        _initialize_accounts(batch.accounts_to_initialize)
+    except Exception:
+        # The batch transaction has been committed already, so all
+        # the messages must be acknowledged. The accounts are
+        # initialized again one by one, so that one failing account
+        # would not prevent the others from being initialized.
+        _initialize_accounts_one_by_one(batch.accounts_to_initialize)
+
+    return [True] * len(messages)
+
+
+def _initialize_accounts_one_by_one(accounts: Sequence[Tuple[int, int]]) -> None:
+    logger = logging.getLogger(__name__)
+    for account in accounts:
+        try:
+            _initialize_accounts([account])
+        except Exception:
+            # This is not fatal. When the accounts scanner finds an
+            # account whose interest rate or debtor info differs from
+            # the debtor's root config, it sends `change_interest_rate`
+            # and `update_debtor_info` chores for the account (see
+            # `AccountsScanner._change_debtor_settings`).
+            logger.exception('Caught error while initializing account %s.', account)
+
+
+def _process_message_safely(message: dramatiq.Message) -> Optional[bool]:
+    logger = logging.getLogger(__name__)
+    try:
+        _process_message(message)
+    except (AssertionError, TypeError, KeyError, ValueError):
+        # The message is invalid, and will never be processed
+        # successfully (`ValueError` is raised for invalid timestamps).
+        logger.exception('Caught error while processing a %s message.', message.actor_name)
+        return False
+    except Exception:
+        # Database errors (a lost connection, for example), and
+        # serialization failures after the retries have been exhausted.
+        logger.exception('Failed to process a %s message. It will be retried.', message.actor_name)
+        return None
+
+    return True
+
+
+_BATCH_ACTORS = {
+    'configure_account': configure_account,
+    'prepare_transfer': prepare_transfer,
+    'finalize_transfer': finalize_transfer,
+    'on_pending_balance_change_signal': on_pending_balance_change_signal,
+}
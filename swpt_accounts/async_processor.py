@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+import psycopg2
+import psycopg2.extensions
+from swpt_accounts.extensions import db
+
+MAX_PENDING_PER_CONNECTION = 10
+MAX_RETRIES = 10
+
+
+def _get_connect_kwargs() -> dict:
+    url = db.engine.url
+    kwargs = url.translate_connect_args(username='user', database='dbname')
+    kwargs.update(url.query)
+
+    return kwargs
+
+
+async def _wait_until_ready(connection) -> None:
+    # Drives an asynchronous psycopg2 connection until the current
+    # operation is complete (see "Asynchronous support" in the
+    # psycopg2 documentation).
+    loop = asyncio.get_event_loop()
+
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+
+        fd = connection.fileno()
+        ready = loop.create_future()
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, ready.set_result, None)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fd)
+
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, ready.set_result, None)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(fd)
+
+        else:  # pragma: no cover
+            raise psycopg2.OperationalError(f'unexpected poll state: {state}')
+
+
+async def _connect(connect_kwargs: dict):
+    connection = psycopg2.connect(async_=True, **connect_kwargs)
+    await _wait_until_ready(connection)
+
+    return connection
+
+
+async def _execute(connection, sql: str, params: tuple = ()) -> None:
+    # Asynchronous connections are always in autocommit mode, so every
+    # statement is executed in its own transaction.
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql, params)
+        await _wait_until_ready(connection)
+    finally:
+        cursor.close()
+
+
+class AsyncioProcessor:
+    """Process many objects concurrently, on asynchronous database connections.
+
+    `get_sql_call(*args)` must return an `(sql, params)` tuple. The SQL
+    statement is executed in its own transaction, which is retried on
+    serialization failures and deadlocks. Normally, the statement
+    calls one of the stored procedures that process queued requests
+    (see `APP_USE_STORED_PROCEDURES`).
+
+    """
+
+    def __init__(self, connections, *, get_args_collection, get_sql_call, wait_seconds, listen_channels=()):
+        self.logger = logging.getLogger(__name__)
+        self.connections = connections
+        self.get_args_collection = get_args_collection
+        self.get_sql_call = get_sql_call
+        self.wait_seconds = wait_seconds
+        self.listen_channels = listen_channels
+        self.max_pending = connections * MAX_PENDING_PER_CONNECTION
+        self.error_has_occurred = False
+
+    async def _process(self, pool: asyncio.Queue, args) -> None:
+        connection = await pool.get()
+        try:
+            for retry in range(MAX_RETRIES):  # pragma: no branch
+                try:
+                    await _execute(connection, *self.get_sql_call(*args))
+                    break
+                except psycopg2.extensions.TransactionRollbackError:  # pragma: no cover
+                    if retry + 1 == MAX_RETRIES:
+                        raise
+        finally:
+            pool.put_nowait(connection)
+
+    def _log_errors(self, tasks) -> None:
+        for task in tasks:
+            e = task.exception()
+            if e is not None:  # pragma: no cover
+                self.logger.error('Caught error while processing objects.', exc_info=e)
+                self.error_has_occurred = True
+
+    async def _listen(self, connect_kwargs: dict):
+        # Returns a connection listening for notifications on
+        # `self.listen_channels`, and an event which is set when a
+        # notification arrives.
+        if not self.listen_channels:
+            return None, None
+
+        connection = await _connect(connect_kwargs)
+        for channel in self.listen_channels:
+            await _execute(connection, f'LISTEN {channel}')
+        notified = asyncio.Event()
+
+        def on_readable():
+            connection.poll()
+            if connection.notifies:
+                connection.notifies.clear()
+                notified.set()
+
+        asyncio.get_event_loop().add_reader(connection.fileno(), on_readable)
+        return connection, notified
+
+    async def _wait(self, notified, seconds: float) -> None:
+        if notified is None:
+            await asyncio.sleep(seconds)
+            return
+
+        try:
+            await asyncio.wait_for(notified.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+        notified.clear()
+
+    async def _run(self, quit_early: bool) -> None:
+        connect_kwargs = _get_connect_kwargs()
+        connections = [await _connect(connect_kwargs) for _ in range(self.connections)]
+        pool = asyncio.Queue()
+        for connection in connections:
+            pool.put_nowait(connection)
+
+        listen_connection, notified = await self._listen(connect_kwargs)
+        iteration_counter = 0
+
+        try:
+            while not (self.error_has_occurred or (quit_early and iteration_counter > 0)):
+                iteration_counter += 1
+                started_at = time.time()
+                pending = set()
+
+                for args in self.get_args_collection():
+                    if len(pending) >= self.max_pending:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        self._log_errors(done)
+
+                    pending.add(asyncio.ensure_future(self._process(pool, args)))
+
+                if pending:
+                    done, _ = await asyncio.wait(pending)
+                    self._log_errors(done)
+
+                await self._wait(notified, max(0.0, self.wait_seconds + started_at - time.time()))
+
+        finally:
+            if listen_connection is not None:
+                asyncio.get_event_loop().remove_reader(listen_connection.fileno())
+                listen_connection.close()
+            for connection in connections:
+                connection.close()
+
+    def run(self, *, quit_early=False):
+        # Note that the args collection is obtained synchronously, in
+        # the current thread.
+        asyncio.run(self._run(quit_early))
+
+
+def process_pending_balance_changes_call(debtor_id: int, creditor_id: int) -> tuple:
+    return (
+        'SELECT process_pending_balance_changes(%s, %s, %s)',
+        (debtor_id, creditor_id, datetime.now(tz=timezone.utc)),
+    )
+
+
+def process_transfer_requests_call(debtor_id: int, creditor_id: int, commit_period: int) -> tuple:
+    return (
+        'SELECT process_transfer_requests(%s, %s, %s, %s)',
+        (debtor_id, creditor_id, commit_period, datetime.now(tz=timezone.utc)),
+    )
+
+
+def process_finalization_requests_call(debtor_id: int, sender_creditor_id: int) -> tuple:
+    return (
+        'SELECT process_finalization_requests(%s, %s, %s)',
+        (debtor_id, sender_creditor_id, datetime.now(tz=timezone.utc)),
+    )
@@ -1,26 +1,70 @@
 import logging
 import click
 import time
+import select
 import threading
+import dramatiq
+import multiprocessing
+from functools import partial
+from itertools import islice
 from datetime import timedelta
 from os import environ
 from multiprocessing.dummy import Pool as ThreadPool
 from flask import current_app
 from flask.cli import with_appcontext
 from swpt_accounts import procedures
+from swpt_accounts.fetch_api_client import get_reachable_creditor_ids
+from swpt_accounts.async_processor import AsyncioProcessor, process_pending_balance_changes_call, \
+    process_transfer_requests_call, process_finalization_requests_call
 from swpt_accounts.extensions import db
-from swpt_accounts.models import SECONDS_IN_DAY
+from swpt_accounts.models import SECONDS_IN_DAY, TransferRequest, FinalizationRequest, PendingBalanceChange, \
+    OutboxMessage
+
+
+MAX_PENDING_PER_THREAD = 100
+
+
+def _push_app_context(app, account_cache_size=0):
+    ctx = app.app_context()
+    ctx.push()
+    if account_cache_size > 0:
+        procedures.enable_account_cache(account_cache_size)
 
 
 class ThreadPoolProcessor:
-    def __init__(self, threads, *, get_args_collection, process_func, wait_seconds):
+    """Process many objects concurrently, in a pool of worker threads.
+
+    If `affinity` is true, each worker thread has its own queue, and
+    the objects are routed to the workers by the first two elements of
+    their args, which must be `debtor_id` and `creditor_id`. Thus, a
+    given account is always processed by the same worker, which avoids
+    lock contention on hot accounts, and allows each worker to keep a
+    cache of the accounts it has recently processed (see
+    `procedures.enable_account_cache`). When only one of
+    `buckets_count` buckets of accounts is processed (see
+    `procedures.is_in_bucket`), `buckets_count` must be passed, so
+    that the accounts are evenly distributed among the workers.
+
+    """
+
+    def __init__(self, threads, *, get_args_collection, process_func, wait_seconds, listen_channels=(),
+                 pipelined=False, affinity=False, account_cache_size=0, buckets_count=1):
         self.logger = logging.getLogger(__name__)
         self.threads = threads
         self.get_args_collection = get_args_collection
         self.process_func = process_func
         self.wait_seconds = wait_seconds
+        self.listen_channels = listen_channels
+        self.pipelined = pipelined
+        self.affinity = affinity
+        self.account_cache_size = account_cache_size if affinity else 0
+        self.buckets_count = buckets_count
+        self.low_water_mark = threads if pipelined else 0
+        self.max_pending = threads * MAX_PENDING_PER_THREAD
         self.all_done = threading.Condition()
         self.pending = 0
+        self.in_flight = set()
+        self.last_submitted = set()
         self.error_has_occurred = False
 
     def _wait_until_all_done(self):
@@ -28,11 +72,20 @@ class ThreadPoolProcessor:
             self.all_done.wait()
         assert self.pending == 0
 
+    def _wait_until_low_water_mark(self):
+        while self.pending > self.low_water_mark:
+            self.all_done.wait()
+
+    def _wait_until_can_submit(self):
+        # The args collection may be a lazy iterator, so we should not
+        # consume it faster than the args are processed.
+        while self.pending >= self.max_pending:
+            self.all_done.wait()
+
     def _mark_done(self, result=None):
         with self.all_done:
             self.pending -= 1
-            if self.pending <= 0:
-                self.all_done.notify()
+            self.all_done.notify()
 
     def _log_error(self, e):  # pragma: no cover
         self._mark_done()
@@ -43,14 +96,99 @@ class ThreadPoolProcessor:
 
         self.error_has_occurred = True
 
-    def run(self, *, quit_early=False):
-        app = current_app._get_current_object()
+    def _listen(self):
+        # Returns a dedicated database connection, listening for
+        # notifications on `self.listen_channels`. The connection is
+        # detached from the pool, because it is in autocommit mode.
+        if not self.listen_channels:
+            return None
+
+        connection = db.engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            for channel in self.listen_channels:
+                cursor.execute(f'LISTEN {channel}')
+
+        return connection
+
+    def _wait(self, connection, seconds):
+        # Waits until a notification arrives, or the given number of
+        # seconds passes. Notifications that have arrived while the
+        # previous iteration was running, wake us up immediately.
+        if connection is None:
+            time.sleep(seconds)
+            return
+
+        dbapi_connection = connection.connection
+        dbapi_connection.poll()
+        if not dbapi_connection.notifies and seconds > 0.0:
+            select.select([dbapi_connection], [], [], seconds)
+            dbapi_connection.poll()
+
+        dbapi_connection.notifies.clear()
+
+    def _apply_async(self, pools, args, callback, error_callback):
+        if len(pools) == 1:
+            pool = pools[0]
+        else:
+            # All accounts in a bucket have the same `(debtor_id XOR
+            # creditor_id) mod buckets_count`, so it is divided out.
+            debtor_id, creditor_id = args[:2]
+            pool = pools[(debtor_id ^ creditor_id) // self.buckets_count % len(pools)]
+
+        pool.apply_async(self.process_func, args, callback=callback, error_callback=error_callback)
+
+    def _submit_pipelined(self, pools, args_collection):
+        # Submits only the args that are not being processed already,
+        # so that the same object is never processed by two threads
+        # at the same time. Returns the number of submitted args that
+        # have not been submitted by the previous call. (Objects that
+        # can not be processed at the moment, like rows locked by
+        # another transaction, will be fetched again and again.)
+        submitted = set()
+        new_count = 0
+        for args in map(tuple, args_collection):
+            with self.all_done:
+                if args in self.in_flight:
+                    continue
+                self._wait_until_can_submit()
+                self.in_flight.add(args)
+                self.pending += 1
+
+            submitted.add(args)
+            if args not in self.last_submitted:
+                new_count += 1
+
+            def mark_done(result=None, args=args):
+                with self.all_done:
+                    self.in_flight.discard(args)
+                self._mark_done()
+
+            def log_error(e, args=args):  # pragma: no cover
+                with self.all_done:
+                    self.in_flight.discard(args)
+                self._log_error(e)
 
-        def push_app_context():
-            ctx = app.app_context()
-            ctx.push()
+            self._apply_async(pools, args, mark_done, log_error)
 
-        pool = ThreadPool(self.threads, initializer=push_app_context)
+        self.last_submitted = submitted
+        return new_count
+
+    def _create_pool(self, app, size):
+        return ThreadPool(size, initializer=_push_app_context, initargs=(app, self.account_cache_size))
+
+    def _create_pools(self, app):
+        if self.affinity:
+            return [self._create_pool(app, 1) for _ in range(self.threads)]
+
+        return [self._create_pool(app, self.threads)]
+
+    def run(self, *, quit_early=False):
+        app = current_app._get_current_object()
+        pools = self._create_pools(app)
+        connection = self._listen()
         iteration_counter = 0
 
         while not (self.error_has_occurred or (quit_early and iteration_counter > 0)):
@@ -58,19 +196,137 @@ class ThreadPoolProcessor:
             started_at = time.time()
             args_collection = self.get_args_collection()
 
-            with self.all_done:
-                self.pending += len(args_collection)
+            if self.pipelined:
+                # Instead of waiting for all the submitted args to be
+                # processed, new args are fetched as soon as the
+                # number of pending args drops to the low-water
+                # mark. We wait for notifications only when there is
+                # no new work to do.
+                new_count = self._submit_pipelined(pools, args_collection)
+                with self.all_done:
+                    self._wait_until_low_water_mark()
+
+                if new_count == 0:
+                    self._wait(connection, max(0.0, self.wait_seconds + started_at - time.time()))
+
+                continue
 
             for args in args_collection:
-                pool.apply_async(self.process_func, args, callback=self._mark_done, error_callback=self._log_error)
+                with self.all_done:
+                    self._wait_until_can_submit()
+                    self.pending += 1
+
+                self._apply_async(pools, args, self._mark_done, self._log_error)
 
             with self.all_done:
                 self._wait_until_all_done()
 
-            time.sleep(max(0.0, self.wait_seconds + started_at - time.time()))
+            self._wait(connection, max(0.0, self.wait_seconds + started_at - time.time()))
+
+        with self.all_done:
+            self._wait_until_all_done()
+
+        if connection is not None:
+            connection.close()
+
+        for pool in pools:
+            pool.close()
+            pool.join()
+
+
+class ProcessPoolProcessor(ThreadPoolProcessor):
+    """Like `ThreadPoolProcessor`, but calls `process_func` in worker processes.
+
+    The worker processes are forked from the current process, and the
+    passed `threads` is the number of processes. `process_func` and
+    its arguments must be picklable.
+
+    """
+
+    def _create_pool(self, app, size):
+        # The forked processes must not inherit open database
+        # connections from the parent process.
+        db.engine.dispose()
+
+        return multiprocessing.get_context('fork').Pool(
+            size,
+            initializer=_push_app_context,
+            initargs=(app, self.account_cache_size),
+        )
+
+
+class BatchConsumer:
+    def __init__(self, queue_name, *, max_count, wait_seconds, process_batch):
+        self.logger = logging.getLogger(__name__)
+        self.queue_name = queue_name
+        self.max_count = max_count
+        self.wait_seconds = wait_seconds
+        self.process_batch = process_batch
+
+    def _process_deliveries(self, channel, deliveries):
+        delivery_tags = []
+        messages = []
+        for delivery_tag, body in deliveries:
+            try:
+                message = dramatiq.Message.decode(body)
+            except (ValueError, TypeError):
+                self.logger.exception('Caught error while decoding a message.')
+                channel.basic_nack(delivery_tag, requeue=False)
+            else:
+                delivery_tags.append(delivery_tag)
+                messages.append(message)
+
+        if not messages:
+            return
+
+        results = self.process_batch(messages)
+        if all(results):
+            # All messages have been committed in one transaction, so
+            # we acknowledge all of them at once.
+            channel.basic_ack(delivery_tags[-1], multiple=True)
+            return
+
+        for delivery_tag, result in zip(delivery_tags, results):
+            if result:
+                channel.basic_ack(delivery_tag)
+            elif result is None:
+                channel.basic_nack(delivery_tag, requeue=True)
+            else:
+                # Invalid messages are dead-lettered, the same way
+                # Dramatiq would do it after the retries are exhausted.
+                channel.basic_nack(delivery_tag, requeue=False)
+
+        if None in results:
+            # Give the database some time to recover, before the
+            # re-queued messages are received again.
+            channel.connection.sleep(self.wait_seconds)
+
+    def run(self, *, quit_early=False):
+        from .extensions import protocol_broker
+
+        channel = protocol_broker.channel
+        channel.basic_qos(prefetch_count=self.max_count)
+        deliveries = []
+        batch_started_at = time.time()
+
+        for method, properties, body in channel.consume(self.queue_name, inactivity_timeout=self.wait_seconds):
+            if method is not None:
+                if not deliveries:
+                    batch_started_at = time.time()
+                deliveries.append((method.delivery_tag, body))
+
+            is_batch_complete = (
+                method is None
+                or len(deliveries) >= self.max_count
+                or time.time() - batch_started_at >= self.wait_seconds
+            )
+            if deliveries and is_batch_complete:
+                self._process_deliveries(channel, deliveries)
+                deliveries = []
+            elif quit_early and method is None:
+                break
 
-        pool.close()
-        pool.join()
+        channel.cancel()
 
 
 @click.group('swpt_accounts')
@@ -116,128 +372,607 @@ def subscribe(queue_name):  # pragma: no cover
                 logger.info(f'Unsubscribed "{queue_name}" from "{MAIN_EXCHANGE_NAME}.{routing_key}".')
 
 
+def _get_processor_class(processes):
+    return ProcessPoolProcessor if processes else ThreadPoolProcessor
+
+
+def _check_async_connections_usage():
+    # With --async-connections, the stored procedures are called
+    # directly. They write their signals to the signal tables, and do
+    # not know about the root account shards.
+    config = current_app.config
+    if not config['APP_USE_STORED_PROCEDURES']:
+        raise click.UsageError('--async-connections can be used only with APP_USE_STORED_PROCEDURES.')
+    if config['APP_USE_OUTBOX']:
+        raise click.UsageError('--async-connections can not be used with APP_USE_OUTBOX.')
+    if config['APP_ROOT_ACCOUNT_SHARDS'] > 1:
+        raise click.UsageError('--async-connections can not be used with APP_ROOT_ACCOUNT_SHARDS.')
+
+
+def _check_root_account_shards_usage(chunk_size=1):
+    # The shards are written only by the Python implementation of
+    # `procedures.process_pending_balance_changes`. The other ways of
+    # processing balance changes lock the debtors' account rows.
+    config = current_app.config
+    if config['APP_ROOT_ACCOUNT_SHARDS'] > 1:
+        if config['APP_USE_STORED_PROCEDURES']:
+            raise click.UsageError('APP_ROOT_ACCOUNT_SHARDS can not be used with APP_USE_STORED_PROCEDURES.')
+        if chunk_size > 1:
+            raise click.UsageError('APP_ROOT_ACCOUNT_SHARDS can not be used with --chunk-size bigger than 1.')
+
+
+def _process_transfer_requests(
+        process_transfer_requests_func,
+        defer_reachability_checks,
+        debtor_id,
+        creditor_id,
+        commit_period):
+
+    recipients_reachability = None
+
+    if defer_reachability_checks:
+        # The reachability of the recipients is checked before the
+        # transaction is started, so that no database locks are held
+        # while waiting for the HTTP response.
+        recipients = procedures.get_transfer_request_recipients(debtor_id, creditor_id)
+        reachable_recipients = get_reachable_creditor_ids(debtor_id, recipients)
+        recipients_reachability = {r: r in reachable_recipients for r in recipients}
+
+    process_transfer_requests_func(debtor_id, creditor_id, commit_period, recipients_reachability)
+
+
+def _flush_signals(model, table_name):
+    burst_count = int(model.signalbus_burst_count)
+    while procedures.flush_signals(model, table_name, burst_count) >= burst_count:
+        pass
+
+
+def _publish_outbox_messages(burst_count):
+    while procedures.publish_outbox_messages(burst_count) >= burst_count:
+        pass
+
+
 @swpt_accounts.command('process_balance_changes')
 @with_appcontext
 @click.option('-t', '--threads', type=int, help='The number of worker threads.')
-@click.option('-w', '--wait', type=float, help='The minimal number of seconds between'
+@click.option('-p', '--processes', type=int, help='The number of worker processes (replaces --threads).')
+@click.option('-a', '--async-connections', type=int, help='The number of asynchronous database connections'
+              ' (replaces --threads).')
+@click.option('-w', '--wait', type=float, help='The maximal number of seconds between'
               ' the queries to obtain pending balance changes.')
+@click.option('-c', '--chunk-size', type=int, help='The maximal number of accounts processed'
+              ' in a single database transaction.')
+@click.option('--bucket', type=int, default=0, help='The bucket of accounts that this instance processes.')
+@click.option('--of', 'buckets_count', type=int, default=1, help='The total number of buckets.')
 @click.option('--quit-early', is_flag=True, default=False, help='Exit after some time (mainly useful during testing).')
-def process_balance_changes(threads, wait, quit_early):
+def process_balance_changes(threads, processes, async_connections, wait, chunk_size, bucket, buckets_count, quit_early):
     """Process pending balance changes.
 
     If --threads is not specified, the value of the configuration
     variable APP_PROCESS_BALANCE_CHANGES_THREADS is taken. If it is
     not set, the default number of threads is 1.
 
+    If --processes is specified, the requests are processed by the
+    given number of worker processes, instead of by worker threads.
+    This is useful when the processing is CPU-bound.
+
+    If --async-connections is specified, the stored procedures that
+    process the requests are called concurrently, on the given number
+    of asynchronous database connections, instead of by worker
+    threads. This is useful when the processing is I/O-bound. Note
+    that in this case --chunk-size is ignored. --async-connections
+    can be used only when APP_USE_STORED_PROCEDURES is set, and
+    neither APP_USE_OUTBOX nor APP_ROOT_ACCOUNT_SHARDS is enabled.
+
     If --wait is not specified, the value of the configuration
     variable APP_PROCESS_BALANCE_CHANGES_WAIT is taken. If it is not
     set, the default number of seconds is 5.
 
-    """
+    Regardless of --wait, new queries are made as soon as the
+    database notifies that new balance changes have been queued.
+
+    If --chunk-size is not specified, the value of the configuration
+    variable APP_PROCESS_BALANCE_CHANGES_CHUNK_SIZE is taken. If it is
+    not set, the default chunk size is 1. When the chunk size is
+    bigger than 1, the pending balance changes for up to that many
+    accounts are processed in a single database transaction.
 
-    # TODO: Consider allowing load-sharing between multiple
-    #       containers. A possible way to do this is to separate the
-    #       `args collection` in multiple buckets, assigning a
-    #       dedicated container for each bucket. This may also be true
-    #       for the other "process_*" CLI commands. Note that this
-    #       would makes sense only if the load is CPU-bound, which is
-    #       unlikely if we re-implement the logic in stored
-    #       procedures.
+    When several instances of this command run in parallel, each one
+    should be started with a different --bucket, and the same --of
+    options. Then each instance will process only the accounts for
+    which `(debtor_id XOR creditor_id) mod <of> == <bucket>`.
+
+    If the configuration variable APP_USE_STORED_PROCEDURES is set,
+    the processing is done by a stored procedure in the database.
+
+    If the configuration variable APP_ROOT_ACCOUNT_SHARDS is bigger
+    than 1, the balance changes for debtors' accounts are written to
+    that many shards, instead of to the debtors' account rows. This
+    can not be used together with APP_USE_STORED_PROCEDURES, or when
+    the chunk size is bigger than 1.
+
+    """
 
     threads = threads or int(current_app.config['APP_PROCESS_BALANCE_CHANGES_THREADS'])
     wait = wait if wait is not None else current_app.config['APP_PROCESS_BALANCE_CHANGES_WAIT']
+    chunk_size = chunk_size or int(current_app.config['APP_PROCESS_BALANCE_CHANGES_CHUNK_SIZE'])
     max_count = current_app.config['APP_PROCESS_BALANCE_CHANGES_MAX_COUNT']
-
-    def get_args_collection():
-        return procedures.get_accounts_with_pending_balance_changes(max_count=max_count)
+    assert 0 <= bucket < buckets_count
+    use_stored_procedures = current_app.config['APP_USE_STORED_PROCEDURES']
+    assert chunk_size > 0
+    _check_root_account_shards_usage(chunk_size)
+
+    if chunk_size == 1:
+        def get_args_collection():
+            return procedures.get_accounts_with_pending_balance_changes(max_count, bucket, buckets_count)
+
+        process_func = (
+            procedures.process_pending_balance_changes_in_db
+            if use_stored_procedures
+            else partial(
+                procedures.process_pending_balance_changes,
+                root_account_shards=current_app.config['APP_ROOT_ACCOUNT_SHARDS'],
+            )
+        )
+    else:
+        def get_args_collection():
+            # The accounts come sorted by primary key, so the chunks
+            # lock their account rows in primary key order.
+            account_pks = procedures.get_accounts_with_pending_balance_changes(max_count, bucket, buckets_count)
+            while True:
+                chunk = tuple(islice(account_pks, chunk_size))
+                if not chunk:
+                    break
+                yield (chunk,)
+
+        process_func = (
+            procedures.process_pending_balance_changes_for_accounts_in_db
+            if use_stored_procedures
+            else procedures.process_pending_balance_changes_for_accounts
+        )
 
     logger = logging.getLogger(__name__)
     logger.info('Started balance changes processor.')
 
-    ThreadPoolProcessor(
-        threads,
+    if async_connections:
+        _check_async_connections_usage()
+        AsyncioProcessor(
+            async_connections,
+            get_args_collection=lambda: procedures.get_accounts_with_pending_balance_changes(
+                max_count, bucket, buckets_count),
+            get_sql_call=process_pending_balance_changes_call,
+            wait_seconds=wait,
+            listen_channels=[PendingBalanceChange.__table__.name],
+        ).run(quit_early=quit_early)
+        return
+
+    _get_processor_class(processes)(
+        processes or threads,
         get_args_collection=get_args_collection,
-        process_func=procedures.process_pending_balance_changes,
+        process_func=process_func,
         wait_seconds=wait,
+        listen_channels=[PendingBalanceChange.__table__.name],
+        pipelined=current_app.config['APP_PIPELINED_PROCESSING'],
+        # A chunk contains many accounts, so it can not be routed to
+        # the worker that processes a given account.
+        affinity=current_app.config['APP_AFFINE_WORKERS'] and chunk_size == 1,
+        account_cache_size=current_app.config['APP_WORKER_ACCOUNT_CACHE_SIZE'],
+        buckets_count=buckets_count,
     ).run(quit_early=quit_early)
 
 
 @swpt_accounts.command('process_transfer_requests')
 @with_appcontext
 @click.option('-t', '--threads', type=int, help='The number of worker threads.')
-@click.option('-w', '--wait', type=float, help='The minimal number of seconds between'
+@click.option('-p', '--processes', type=int, help='The number of worker processes (replaces --threads).')
+@click.option('-a', '--async-connections', type=int, help='The number of asynchronous database connections'
+              ' (replaces --threads).')
+@click.option('-w', '--wait', type=float, help='The maximal number of seconds between'
               ' the queries to obtain pending transfer requests.')
+@click.option('--bucket', type=int, default=0, help='The bucket of accounts that this instance processes.')
+@click.option('--of', 'buckets_count', type=int, default=1, help='The total number of buckets.')
 @click.option('--quit-early', is_flag=True, default=False, help='Exit after some time (mainly useful during testing).')
-def process_transfer_requests(threads, wait, quit_early):
+def process_transfer_requests(threads, processes, async_connections, wait, bucket, buckets_count, quit_early):
     """Process pending transfer requests.
 
     If --threads is not specified, the value of the configuration
     variable APP_PROCESS_TRANSFER_REQUESTS_THREADS is taken. If it is
     not set, the default number of threads is 1.
 
+    If --processes is specified, the requests are processed by the
+    given number of worker processes, instead of by worker threads.
+    This is useful when the processing is CPU-bound.
+
+    If --async-connections is specified, the stored procedures that
+    process the requests are called concurrently, on the given number
+    of asynchronous database connections, instead of by worker
+    threads. This is useful when the processing is I/O-bound. This
+    can be done only when APP_USE_STORED_PROCEDURES is set, and
+    neither APP_USE_OUTBOX nor APP_ROOT_ACCOUNT_SHARDS is enabled.
+
     If --wait is not specified, the value of the configuration
     variable APP_PROCESS_TRANSFER_REQUESTS_WAIT is taken. If it is not
     set, the default number of seconds is 5.
 
+    Regardless of --wait, new queries are made as soon as the
+    database notifies that new transfer requests have been queued.
+
+    If the configuration variable APP_USE_STORED_PROCEDURES is set,
+    the processing is done by a stored procedure in the database.
+
+    If the configuration variable APP_DEFER_REACHABILITY_CHECKS is
+    set, the reachability of the recipients is checked here, with one
+    fetch request per sender account, instead of in the
+    "prepare_transfer" actor.
+
+    When several instances of this command run in parallel, each one
+    should be started with a different --bucket, and the same --of
+    options. Then each instance will process only the accounts for
+    which `(debtor_id XOR creditor_id) mod <of> == <bucket>`.
+
     """
 
     threads = threads or int(current_app.config['APP_PROCESS_TRANSFER_REQUESTS_THREADS'])
     wait = wait if wait is not None else current_app.config['APP_PROCESS_TRANSFER_REQUESTS_WAIT']
     commit_period = current_app.config['APP_PREPARED_TRANSFER_MAX_DELAY_DAYS'] * SECONDS_IN_DAY
     max_count = current_app.config['APP_PROCESS_TRANSFER_REQUESTS_MAX_COUNT']
+    assert 0 <= bucket < buckets_count
 
     logger = logging.getLogger(__name__)
     logger.info('Started transfer requests processor.')
 
+    defer_reachability_checks = current_app.config['APP_DEFER_REACHABILITY_CHECKS']
+    if async_connections:
+        _check_async_connections_usage()
+        if defer_reachability_checks:
+            raise click.UsageError('--async-connections can not be used with APP_DEFER_REACHABILITY_CHECKS.')
+
+    process_transfer_requests_func = (
+        procedures.process_transfer_requests_in_db
+        if current_app.config['APP_USE_STORED_PROCEDURES']
+        else procedures.process_transfer_requests
+    )
+
     def get_args_collection():
-        return [
+        return (
             (debtor_id, creditor_id, commit_period)
             for debtor_id, creditor_id
-            in procedures.get_accounts_with_transfer_requests(max_count=max_count)
-        ]
-
-    ThreadPoolProcessor(
-        threads,
+            in procedures.get_accounts_with_transfer_requests(max_count, bucket, buckets_count)
+        )
+
+    if async_connections:
+        AsyncioProcessor(
+            async_connections,
+            get_args_collection=get_args_collection,
+            get_sql_call=process_transfer_requests_call,
+            wait_seconds=wait,
+            listen_channels=[TransferRequest.__table__.name],
+        ).run(quit_early=quit_early)
+        return
+
+    _get_processor_class(processes)(
+        processes or threads,
         get_args_collection=get_args_collection,
-        process_func=procedures.process_transfer_requests,
+        process_func=partial(
+            _process_transfer_requests,
+            process_transfer_requests_func,
+            defer_reachability_checks,
+        ),
         wait_seconds=wait,
+        listen_channels=[TransferRequest.__table__.name],
+        pipelined=current_app.config['APP_PIPELINED_PROCESSING'],
+        affinity=current_app.config['APP_AFFINE_WORKERS'],
+        account_cache_size=current_app.config['APP_WORKER_ACCOUNT_CACHE_SIZE'],
+        buckets_count=buckets_count,
     ).run(quit_early=quit_early)
 
 
 @swpt_accounts.command('process_finalization_requests')
 @with_appcontext
 @click.option('-t', '--threads', type=int, help='The number of worker threads.')
-@click.option('-w', '--wait', type=float, help='The minimal number of seconds between'
+@click.option('-p', '--processes', type=int, help='The number of worker processes (replaces --threads).')
+@click.option('-a', '--async-connections', type=int, help='The number of asynchronous database connections'
+              ' (replaces --threads).')
+@click.option('-w', '--wait', type=float, help='The maximal number of seconds between'
               ' the queries to obtain pending finalization requests.')
+@click.option('--bucket', type=int, default=0, help='The bucket of accounts that this instance processes.')
+@click.option('--of', 'buckets_count', type=int, default=1, help='The total number of buckets.')
 @click.option('--quit-early', is_flag=True, default=False, help='Exit after some time (mainly useful during testing).')
-def process_finalization_requests(threads, wait, quit_early):
+def process_finalization_requests(threads, processes, async_connections, wait, bucket, buckets_count, quit_early):
     """Process pending finalization requests.
 
     If --threads is not specified, the value of the configuration
     variable APP_PROCESS_FINALIZATION_REQUESTS_THREADS is taken. If it
     is not set, the default number of threads is 1.
 
+    If --processes is specified, the requests are processed by the
+    given number of worker processes, instead of by worker threads.
+    This is useful when the processing is CPU-bound.
+
+    If --async-connections is specified, the stored procedures that
+    process the requests are called concurrently, on the given number
+    of asynchronous database connections, instead of by worker
+    threads. This is useful when the processing is I/O-bound. This
+    can be done only when APP_USE_STORED_PROCEDURES is set, and
+    neither APP_USE_OUTBOX nor APP_ROOT_ACCOUNT_SHARDS is enabled.
+
     If --wait is not specified, the value of the configuration
     variable APP_PROCESS_FINALIZATION_REQUESTS_WAIT is taken. If it is
     not set, the default number of seconds is 5.
 
+    Regardless of --wait, new queries are made as soon as the
+    database notifies that new finalization requests have been queued.
+
+    When several instances of this command run in parallel, each one
+    should be started with a different --bucket, and the same --of
+    options. Then each instance will process only the accounts for
+    which `(debtor_id XOR creditor_id) mod <of> == <bucket>`.
+
+    If the configuration variable APP_USE_STORED_PROCEDURES is set,
+    the processing is done by a stored procedure in the database.
+
     """
 
     threads = threads or int(environ.get('APP_PROCESS_FINALIZATION_REQUESTS_THREADS', '1'))
     wait = wait if wait is not None else current_app.config['APP_PROCESS_FINALIZATION_REQUESTS_WAIT']
     max_count = current_app.config['APP_PROCESS_FINALIZATION_REQUESTS_MAX_COUNT']
+    assert 0 <= bucket < buckets_count
+    use_stored_procedures = current_app.config['APP_USE_STORED_PROCEDURES']
 
     def get_args_collection():
-        return procedures.get_accounts_with_finalization_requests(max_count=max_count)
+        return procedures.get_accounts_with_finalization_requests(max_count, bucket, buckets_count)
 
     logger = logging.getLogger(__name__)
     logger.info('Started finalization requests processor.')
 
+    if async_connections:
+        _check_async_connections_usage()
+        AsyncioProcessor(
+            async_connections,
+            get_args_collection=get_args_collection,
+            get_sql_call=process_finalization_requests_call,
+            wait_seconds=wait,
+            listen_channels=[FinalizationRequest.__table__.name],
+        ).run(quit_early=quit_early)
+        return
+
+    _get_processor_class(processes)(
+        processes or threads,
+        get_args_collection=get_args_collection,
+        process_func=(
+            procedures.process_finalization_requests_in_db
+            if use_stored_procedures
+            else procedures.process_finalization_requests
+        ),
+        wait_seconds=wait,
+        listen_channels=[FinalizationRequest.__table__.name],
+        pipelined=current_app.config['APP_PIPELINED_PROCESSING'],
+        affinity=current_app.config['APP_AFFINE_WORKERS'],
+        account_cache_size=current_app.config['APP_WORKER_ACCOUNT_CACHE_SIZE'],
+        buckets_count=buckets_count,
+    ).run(quit_early=quit_early)
+
+
+@swpt_accounts.command('process_requests')
+@with_appcontext
+@click.option('-t', '--threads', type=int, help='The number of worker threads.')
+@click.option('-p', '--processes', type=int, help='The number of worker processes (replaces --threads).')
+@click.option('-w', '--wait', type=float, help='The maximal number of seconds between'
+              ' the queries to obtain accounts with queued requests.')
+@click.option('--bucket', type=int, default=0, help='The bucket of accounts that this instance processes.')
+@click.option('--of', 'buckets_count', type=int, default=1, help='The total number of buckets.')
+@click.option('--quit-early', is_flag=True, default=False, help='Exit after some time (mainly useful during testing).')
+def process_requests(threads, processes, wait, bucket, buckets_count, quit_early):
+    """Process pending balance changes, finalization requests, and
+    transfer requests together.
+
+    This is an alternative to running the "process_balance_changes",
+    "process_finalization_requests", and "process_transfer_requests"
+    commands. All the queued requests for a given account are
+    processed in a single transaction, which locks the account only
+    once. Note that the processing is always done in Python, even if
+    the configuration variable APP_USE_STORED_PROCEDURES is set. This
+    command can not be used when the configuration variable
+    APP_ROOT_ACCOUNT_SHARDS is bigger than 1.
+
+    If --threads is not specified, the value of the configuration
+    variable APP_PROCESS_REQUESTS_THREADS is taken. If it is not set,
+    the default number of threads is 1.
+
+    If --processes is specified, the requests are processed by the
+    given number of worker processes, instead of by worker threads.
+    This is useful when the processing is CPU-bound.
+
+    If --wait is not specified, the value of the configuration
+    variable APP_PROCESS_REQUESTS_WAIT is taken. If it is not set, the
+    default number of seconds is 5.
+
+    Regardless of --wait, new queries are made as soon as the
+    database notifies that new requests have been queued.
+
+    When several instances of this command run in parallel, each one
+    should be started with a different --bucket, and the same --of
+    options. Then each instance will process only the accounts for
+    which `(debtor_id XOR creditor_id) mod <of> == <bucket>`.
+
+    """
+
+    threads = threads or int(current_app.config['APP_PROCESS_REQUESTS_THREADS'])
+    wait = wait if wait is not None else current_app.config['APP_PROCESS_REQUESTS_WAIT']
+    commit_period = current_app.config['APP_PREPARED_TRANSFER_MAX_DELAY_DAYS'] * SECONDS_IN_DAY
+    max_count = current_app.config['APP_PROCESS_REQUESTS_MAX_COUNT']
+    assert 0 <= bucket < buckets_count
+    if current_app.config['APP_ROOT_ACCOUNT_SHARDS'] > 1:
+        raise click.UsageError('process_requests can not be used with APP_ROOT_ACCOUNT_SHARDS.')
+
+    def get_args_collection():
+        return (
+            (debtor_id, creditor_id, commit_period)
+            for debtor_id, creditor_id
+            in procedures.get_accounts_with_requests(max_count, bucket, buckets_count)
+        )
+
+    logger = logging.getLogger(__name__)
+    logger.info('Started requests processor.')
+
+    _get_processor_class(processes)(
+        processes or threads,
+        get_args_collection=get_args_collection,
+        process_func=partial(
+            _process_transfer_requests,
+            procedures.process_account_requests,
+            current_app.config['APP_DEFER_REACHABILITY_CHECKS'],
+        ),
+        wait_seconds=wait,
+        listen_channels=[
+            PendingBalanceChange.__table__.name,
+            FinalizationRequest.__table__.name,
+            TransferRequest.__table__.name,
+        ],
+        pipelined=current_app.config['APP_PIPELINED_PROCESSING'],
+        affinity=current_app.config['APP_AFFINE_WORKERS'],
+        account_cache_size=current_app.config['APP_WORKER_ACCOUNT_CACHE_SIZE'],
+        buckets_count=buckets_count,
+    ).run(quit_early=quit_early)
+
+
+@swpt_accounts.command('consume_batches')
+@with_appcontext
+@click.option('-n', '--max-count', type=int, help='The maximal number of messages in a batch.')
+@click.option('-w', '--wait', type=float, help='The maximal number of seconds to wait'
+              ' for a batch to fill up.')
+@click.option('--quit-early', is_flag=True, default=False, help='Exit after some time (mainly useful during testing).')
+def consume_batches(max_count, wait, quit_early):
+    """Consume protocol messages in batches.
+
+    This is an alternative to running Dramatiq workers for the
+    protocol broker. The messages in each batch are processed in a
+    single database transaction, and are acknowledged together after
+    the transaction has been committed.
+
+    If --max-count is not specified, the value of the configuration
+    variable APP_CONSUME_BATCHES_MAX_COUNT is taken. If it is not
+    set, the default number of messages is 100.
+
+    If --wait is not specified, the value of the configuration
+    variable APP_CONSUME_BATCHES_WAIT is taken. If it is not set, the
+    default number of seconds is 0.05.
+
+    """
+
+    from .extensions import APP_QUEUE_NAME
+    from .actors import process_message_batch
+
+    max_count = max_count or int(current_app.config['APP_CONSUME_BATCHES_MAX_COUNT'])
+    wait = wait if wait is not None else current_app.config['APP_CONSUME_BATCHES_WAIT']
+
+    logger = logging.getLogger(__name__)
+    logger.info('Started batch consumer.')
+
+    BatchConsumer(
+        APP_QUEUE_NAME,
+        max_count=max_count,
+        wait_seconds=wait,
+        process_batch=process_message_batch,
+    ).run(quit_early=quit_early)
+
+
+@swpt_accounts.command('flush_signals')
+@with_appcontext
+@click.option('-t', '--threads', type=int, help='The number of worker threads.')
+@click.option('-w', '--wait', type=float, help='The number of seconds to wait between flushes.')
+@click.option('--quit-early', is_flag=True, default=False, help='Exit after some time (mainly useful during testing).')
+@click.argument('signal_names', nargs=-1)
+def flush_signals(threads, wait, quit_early, signal_names):
+    """Send pending signals over the message bus.
+
+    If a list of SIGNAL_NAMES is specified, flushes only those
+    signals. If no SIGNAL_NAMES are specified, flushes all signals.
+
+    This is an alternative to running "flask signalbus flushmany".
+    When the signal tables are hash-partitioned (see the configuration
+    variable APP_SIGNAL_TABLE_PARTITIONS), each partition is flushed
+    independently, so that several worker threads (and several
+    instances of this command) can flush signals in parallel, without
+    contending for the same rows.
+
+    If --threads is not specified, the value of the configuration
+    variable APP_FLUSH_SIGNALS_THREADS is taken. If it is not set, the
+    default number of threads is 1.
+
+    If --wait is not specified, the value of the configuration
+    variable APP_FLUSH_SIGNALS_WAIT is taken. If it is not set, the
+    default number of seconds is 5.
+
+    """
+
+    threads = threads or int(current_app.config['APP_FLUSH_SIGNALS_THREADS'])
+    wait = wait if wait is not None else current_app.config['APP_FLUSH_SIGNALS_WAIT']
+    models = {model.__name__: model for model in db.signalbus.get_signal_models()}
+    for signal_name in signal_names:
+        if signal_name not in models:
+            raise click.BadParameter(f'invalid signal name "{signal_name}"')
+
+    models_to_flush = [models[signal_name] for signal_name in signal_names] or list(models.values())
+    partitions = [
+        (model, table_name)
+        for model in models_to_flush
+        for table_name in procedures.get_table_partitions(model.__table__.name)
+    ]
+
+    logger = logging.getLogger(__name__)
+    logger.info('Started flushing %s.', ', '.join(model.__name__ for model in models_to_flush))
+
     ThreadPoolProcessor(
         threads,
-        get_args_collection=get_args_collection,
-        process_func=procedures.process_finalization_requests,
+        get_args_collection=lambda: partitions,
+        process_func=_flush_signals,
+        wait_seconds=wait,
+    ).run(quit_early=quit_early)
+
+
+@swpt_accounts.command('publish_outbox')
+@with_appcontext
+@click.option('-w', '--wait', type=float, help='The maximal number of seconds between'
+              ' the queries to obtain pending outbox messages.')
+@click.option('--quit-early', is_flag=True, default=False, help='Exit after some time (mainly useful during testing).')
+def publish_outbox(wait, quit_early):
+    """Send the messages from the outbox table over the message bus.
+
+    When the configuration variable APP_USE_OUTBOX is enabled, the
+    messages for all signal types are written to a single outbox
+    table, and this command should be run instead of flushing the
+    signal tables. Only one instance of this command should run at a
+    time, so that the messages are sent in the order in which they
+    have been written. Note that the stored procedures (see
+    APP_USE_STORED_PROCEDURES) write their signals to the signal
+    tables regardless of APP_USE_OUTBOX.
+
+    If --wait is not specified, the value of the configuration
+    variable APP_PUBLISH_OUTBOX_WAIT is taken. If it is not set, the
+    default number of seconds is 5.
+
+    Regardless of --wait, new queries are made as soon as the
+    database notifies that new messages have been written.
+
+    The maximal number of messages sent in one transaction is
+    determined by the configuration variable
+    APP_PUBLISH_OUTBOX_BURST_COUNT.
+
+    """
+
+    wait = wait if wait is not None else current_app.config['APP_PUBLISH_OUTBOX_WAIT']
+    burst_count = int(current_app.config['APP_PUBLISH_OUTBOX_BURST_COUNT'])
+
+    logger = logging.getLogger(__name__)
+    logger.info('Started outbox publisher.')
+
+    ThreadPoolProcessor(
+        1,
+        get_args_collection=lambda: [(burst_count,)],
+        process_func=_publish_outbox_messages,
         wait_seconds=wait,
+        listen_channels=[OutboxMessage.__table__.name],
     ).run(quit_early=quit_early)
 
 
@@ -1,9 +1,17 @@
+import json
+import threading
 from base64 import b16encode
+from typing import Callable, Dict, Any, Iterable, List, Optional, Tuple
 import dramatiq
+import pika
 from flask import current_app
+from flask_sqlalchemy import SignallingSession
 from datetime import datetime, timezone
 from marshmallow import Schema, fields
+from marshmallow.utils import get_func_args
+from sqlalchemy import event
 from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.sql.expression import text
 from swpt_lib.utils import i64_to_u64
 from swpt_accounts.extensions import db, protocol_broker, MAIN_EXCHANGE_NAME
 
@@ -16,6 +24,9 @@ __all__ = [
     'AccountPurgeSignal',
     'RejectedConfigSignal',
     'PendingBalanceChangeSignal',
+    'OutboxMessage',
+    'bulk_insert_signals',
+    'bulk_save_signals',
 ]
 
 SECONDS_IN_DAY = 24 * 60 * 60
@@ -28,6 +39,114 @@ def get_now_utc():
     return datetime.now(tz=timezone.utc)
 
 
+def _compile_field(field: fields.Field) -> Callable[[Any], Any]:
+    attr = field.attribute or field.name
+
+    def get_converted(convert):
+        def serialize(obj):
+            value = getattr(obj, attr)
+            return None if value is None else convert(value)
+
+        return serialize
+
+    field_type = type(field)
+    if field_type is fields.Function:
+        serialize_func = field.serialize_func
+        if serialize_func is not None and len(get_func_args(serialize_func)) == 1:
+            return serialize_func
+    if field_type is fields.Constant:
+        constant = field.constant
+        return lambda obj: constant
+    if field_type is fields.Integer and not field.as_string:
+        return get_converted(int)
+    if field_type is fields.Float and not field.as_string:
+        return get_converted(float)
+    if field_type is fields.String:
+        return get_converted(str)
+    if field_type in (fields.DateTime, fields.Date) and field.format in (None, 'iso', 'iso8601'):
+        return get_converted(lambda value: value.isoformat())
+
+    raise TypeError(f'unsupported field: {field!r}')
+
+
+def compile_schema_dumper(schema: Schema) -> Callable[[Any], Dict[str, Any]]:
+    """Return a function that works like `schema.dump`, only faster.
+
+    The returned function does not do any validation, and supports
+    only the field types used by the signal models. If the schema has
+    a field of a different type, `schema.dump` is returned instead.
+
+    """
+
+    try:
+        serializers = [
+            (field.data_key or field_name, _compile_field(field))
+            for field_name, field in schema.dump_fields.items()
+        ]
+    except TypeError:
+        return schema.dump
+
+    def dump(obj):
+        return {data_key: serialize(obj) for data_key, serialize in serializers}
+
+    return dump
+
+
+_publisher = threading.local()
+
+
+def _get_publishing_channel():  # pragma: no cover
+    channel = getattr(_publisher, 'channel', None)
+    if channel is None or channel.is_closed:
+        channel = protocol_broker.connection.channel()
+        channel.tx_select()
+        _publisher.channel = channel
+
+    return channel
+
+
+def publish_messages(messages: List[Tuple[dramatiq.Message, str, str]]) -> None:  # pragma: no cover
+    """Publish `(message, exchange, routing_key)` tuples, atomically.
+
+    The whole batch is published on one channel, and confirmed by a
+    single `Tx.Commit` round trip. (Publishing with `confirm_delivery`
+    would wait for a separate confirm after each message.)
+
+    """
+
+    if not messages:
+        return
+
+    attempts = 0
+    while True:
+        try:
+            channel = _get_publishing_channel()
+            for message, exchange, routing_key in messages:
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=message.encode(),
+                    properties=pika.BasicProperties(
+                        content_type='application/json',
+                        delivery_mode=2,
+                        priority=message.options.get('broker_priority'),
+                    ),
+                )
+            channel.tx_commit()
+            return
+
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+            # Nothing has been committed, so the whole batch can be
+            # safely re-published on a new connection.
+            _publisher.channel = None
+            del protocol_broker.channel
+            del protocol_broker.connection
+
+            attempts += 1
+            if attempts > 5:
+                raise dramatiq.ConnectionClosed(e) from None
+
+
 class classproperty(object):
     def __init__(self, f):
         self.f = f
@@ -39,18 +158,27 @@ class classproperty(object):
 class Signal(db.Model):
     __abstract__ = True
 
-    # TODO: Define `send_signalbus_messages` class method, and set
-    #      `ModelClass.signalbus_burst_count = N` in models. Make sure
-    #      RabbitMQ message headers are set properly for the messages.
-
     queue_name = None
 
+    _dumpers: Dict[type, Callable[[Any], Dict[str, Any]]] = {}
+
+    @classmethod
+    def dump_signalbus_message(cls, instance) -> Dict[str, Any]:
+        try:
+            dump = Signal._dumpers[cls]
+        except KeyError:
+            dump = Signal._dumpers[cls] = compile_schema_dumper(cls.__marshmallow_schema__)
+
+        return dump(instance)
+
     @property
     def event_name(self):  # pragma: no cover
         model = type(self)
         return f'on_{model.__tablename__}'
 
-    def send_signalbus_message(self):  # pragma: no cover
+    def get_message_route(self) -> Tuple[Optional[str], str, str]:
+        """Return a `(queue_name, actor_name, routing_key)` tuple."""
+
         model = type(self)
         if model.queue_name is None:
             assert not hasattr(model, 'actor_name'), \
@@ -60,15 +188,29 @@ class Signal(db.Model):
         else:
             actor_name = model.actor_name
             routing_key = model.queue_name
-        data = model.__marshmallow_schema__.dump(self)
+
+        return model.queue_name, actor_name, routing_key
+
+    def create_message(self) -> Tuple[dramatiq.Message, str, str]:
+        """Return a `(message, exchange, routing_key)` tuple."""
+
+        model = type(self)
+        queue_name, actor_name, routing_key = self.get_message_route()
         message = dramatiq.Message(
-            queue_name=model.queue_name,
+            queue_name=queue_name,
             actor_name=actor_name,
             args=(),
-            kwargs=data,
+            kwargs=model.dump_signalbus_message(self),
             options={},
         )
-        protocol_broker.publish_message(message, exchange=MAIN_EXCHANGE_NAME, routing_key=routing_key)
+        return message, MAIN_EXCHANGE_NAME, routing_key
+
+    def send_signalbus_message(self):  # pragma: no cover
+        publish_messages([self.create_message()])
+
+    @classmethod
+    def send_signalbus_messages(cls, instances: Iterable['Signal']) -> None:  # pragma: no cover
+        publish_messages([instance.create_message() for instance in instances])
 
     inserted_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=get_now_utc)
 
@@ -354,3 +496,131 @@ class PendingBalanceChangeSignal(Signal):
     @classproperty
     def signalbus_burst_count(self):
         return current_app.config['APP_FLUSH_PENDING_BALANCE_CHANGES_BURST_COUNT']
+
+
+class OutboxMessage(db.Model):
+    message_id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    exchange = db.Column(db.String, nullable=False)
+    routing_key = db.Column(db.String, nullable=False)
+    queue_name = db.Column(db.String)
+    actor_name = db.Column(db.String, nullable=False)
+    payload = db.Column(pg.TEXT, nullable=False, comment='The JSON-serialized keyword arguments of the message.')
+    inserted_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=get_now_utc)
+    __table_args__ = (
+        {
+            'comment': 'Contains ready to be sent messages. When `APP_USE_OUTBOX` is enabled, the '
+                       'messages for all signal types are written to this table, instead of to '
+                       'their respective signal tables. The messages are serialized when they are '
+                       'written, and are sent in `message_id` order by a single publisher.',
+        }
+    )
+
+    @staticmethod
+    def send_messages(messages) -> None:  # pragma: no cover
+        publish_messages([
+            (
+                dramatiq.Message(
+                    queue_name=m.queue_name,
+                    actor_name=m.actor_name,
+                    args=(),
+                    kwargs=json.loads(m.payload),
+                    options={},
+                ),
+                m.exchange,
+                m.routing_key,
+            ) for m in messages
+        ])
+
+
+def _is_outbox_enabled() -> bool:
+    return current_app.config['APP_USE_OUTBOX']
+
+
+def _get_sequence_columns(model) -> list:
+    # Returns the columns which get their values from a database
+    # sequence, and are included in the message.
+    dumped_attributes = {
+        field.attribute or field_name for field_name, field in model.__marshmallow_schema__.dump_fields.items()
+    }
+    return [c for c in model.__table__.primary_key.columns if c.autoincrement is True and c.key in dumped_attributes]
+
+
+def _insert_outbox_messages(session, signals: list) -> None:
+    current_ts = get_now_utc()
+    signals_by_model = {}
+    for signal in signals:
+        if signal.inserted_at is None:
+            signal.inserted_at = current_ts
+        signals_by_model.setdefault(type(signal), []).append(signal)
+
+    # Because the signals will not be inserted in their tables, the
+    # values generated by database sequences must be obtained here.
+    for model, model_signals in signals_by_model.items():
+        for column in _get_sequence_columns(model):
+            signals_without_value = [s for s in model_signals if getattr(s, column.key) is None]
+            if signals_without_value:
+                values = session.execute(
+                    text('SELECT nextval(pg_get_serial_sequence(:table_name, :column_name)) '
+                         'FROM generate_series(1, :n)'),
+                    {'table_name': model.__table__.name, 'column_name': column.name, 'n': len(signals_without_value)},
+                    mapper=model,
+                ).fetchall()
+                for signal, row in zip(signals_without_value, values):
+                    setattr(signal, column.key, row[0])
+
+    rows = []
+    for signal in signals:
+        queue_name, actor_name, routing_key = signal.get_message_route()
+        rows.append(dict(
+            exchange=MAIN_EXCHANGE_NAME,
+            routing_key=routing_key,
+            queue_name=queue_name,
+            actor_name=actor_name,
+            payload=json.dumps(type(signal).dump_signalbus_message(signal)),
+            inserted_at=signal.inserted_at,
+        ))
+
+    session.execute(OutboxMessage.__table__.insert(), rows)
+
+
+def bulk_insert_signals(model, mappings: Iterable[Dict[str, Any]]) -> None:
+    """Work like `db.session.bulk_insert_mappings(model, mappings)`,
+    but write the signals to the outbox table when `APP_USE_OUTBOX`
+    is enabled.
+
+    """
+
+    if _is_outbox_enabled():
+        bulk_save_signals([model(**mapping) for mapping in mappings])
+    else:
+        db.session.bulk_insert_mappings(model, mappings)
+
+
+def bulk_save_signals(signals: List[Signal]) -> None:
+    """Work like `db.session.bulk_save_objects(signals, preserve_order=False)`,
+    but write the signals to the outbox table when `APP_USE_OUTBOX`
+    is enabled.
+
+    """
+
+    if not signals:
+        return
+
+    if _is_outbox_enabled():
+        _insert_outbox_messages(db.session, signals)
+    else:
+        db.session.bulk_save_objects(signals, preserve_order=False)
+
+
+# Listening on `db.session` would not cover sessions made by other
+# session factories (`db.create_scoped_session`, for example).
+@event.listens_for(SignallingSession, 'before_flush')
+def _move_signals_to_outbox(session, flush_context, instances) -> None:
+    if not (session.new and _is_outbox_enabled()):
+        return
+
+    signals = [instance for instance in session.new if isinstance(instance, Signal)]
+    if signals:
+        for signal in signals:
+            session.expunge(signal)
+        _insert_outbox_messages(session, signals)
@@ -1,41 +1,126 @@
 import logging
 import time
 import asyncio
+import threading
 from collections import OrderedDict
 from functools import partial
 from urllib.parse import urljoin
-from typing import Optional, Iterable, Dict, Tuple
+from typing import Optional, Iterable, Dict, Tuple, Set
 import typing
 import requests
 from flask import current_app, url_for
 from swpt_accounts.extensions import requests_session, aiohttp_session, asyncio_loop
 from swpt_accounts.models import ROOT_CREDITOR_ID
+from swpt_accounts.routes import MAX_REACHABLE_CREDITOR_IDS
 from swpt_accounts.schemas import RootConfigData, parse_root_config_data
 
 _fetch_conifg_path = partial(url_for, 'fetch.config', _external=False, creditorId=ROOT_CREDITOR_ID)
 _root_config_data_lru_cache: typing.OrderedDict[int, Tuple[Optional[RootConfigData], float]] = OrderedDict()
+_reachable_lru_cache: typing.OrderedDict[Tuple[int, int], Tuple[bool, float]] = OrderedDict()
+_reachable_lru_cache_lock = threading.Lock()
+_reachable_cache_stats: Dict[str, int] = {'hits': 0, 'misses': 0}
 
 
 def get_if_account_is_reachable(debtor_id: int, creditor_id: int) -> bool:
-    with current_app.test_request_context():
-        path = url_for('fetch.reachable', _external=False, debtorId=debtor_id, creditorId=creditor_id)
+    """Return whether the account is reachable, consulting a TTL cache first.
 
-    url = urljoin(current_app.config['APP_FETCH_API_URL'], path)
+    Positive and negative answers are cached for different periods
+    (`APP_FETCH_REACHABLE_CACHE_SECONDS` and
+    `APP_FETCH_UNREACHABLE_CACHE_SECONDS`). Failed requests are not
+    cached.
+
+    """
 
     try:
-        response = requests_session.get(url)
-        status_code = response.status_code
-        if status_code == 204:
-            return True
-        if status_code != 404:
-            response.raise_for_status()  # pragma: no cover
+        is_reachable = _lookup_reachable(debtor_id, creditor_id)
+    except KeyError:
+        _increment_reachable_cache_stat('misses')
+    else:
+        _increment_reachable_cache_stat('hits')
+        return is_reachable
 
+    try:
+        is_reachable = _make_reachable_request(debtor_id, creditor_id)
     except requests.RequestException as e:
         _log_error(e)
+        return False
+
+    _register_reachable(debtor_id, creditor_id, is_reachable)
+    return is_reachable
+
+
+def get_reachable_creditor_ids(debtor_id: int, creditor_ids: Iterable[int]) -> Set[int]:
+    """Return the reachable ones among the given creditor IDs.
+
+    This is the bulk version of `get_if_account_is_reachable`, using
+    the same cache. The creditor IDs that are not in the cache are
+    checked with a single request per `MAX_REACHABLE_CREDITOR_IDS`
+    IDs.
+
+    """
+
+    reachable_creditor_ids = set()
+    unknown_creditor_ids = []
+
+    for creditor_id in set(creditor_ids):
+        try:
+            is_reachable = _lookup_reachable(debtor_id, creditor_id)
+        except KeyError:
+            _increment_reachable_cache_stat('misses')
+            unknown_creditor_ids.append(creditor_id)
+        else:
+            _increment_reachable_cache_stat('hits')
+            if is_reachable:
+                reachable_creditor_ids.add(creditor_id)
+
+    for i in range(0, len(unknown_creditor_ids), MAX_REACHABLE_CREDITOR_IDS):
+        chunk = unknown_creditor_ids[i:i + MAX_REACHABLE_CREDITOR_IDS]
+        try:
+            reachable_chunk = _make_reachable_many_request(debtor_id, chunk)
+        except (requests.RequestException, ValueError, TypeError, KeyError) as e:
+            _log_error(e)
+            continue
+
+        for creditor_id in chunk:
+            is_reachable = creditor_id in reachable_chunk
+            _register_reachable(debtor_id, creditor_id, is_reachable)
+            if is_reachable:
+                reachable_creditor_ids.add(creditor_id)
+
+    return reachable_creditor_ids
+
+
+def get_reachable_cache_stats() -> Dict[str, int]:
+    with _reachable_lru_cache_lock:
+        return dict(_reachable_cache_stats, size=len(_reachable_lru_cache))
+
+
+def _make_reachable_request(debtor_id: int, creditor_id: int) -> bool:
+    with current_app.test_request_context():
+        path = url_for('fetch.reachable', _external=False, debtorId=debtor_id, creditorId=creditor_id)
+
+    url = urljoin(current_app.config['APP_FETCH_API_URL'], path)
+    response = requests_session.get(url)
+    status_code = response.status_code
+    if status_code == 204:
+        return True
+    if status_code != 404:
+        response.raise_for_status()  # pragma: no cover
 
     return False
 
 
+def _make_reachable_many_request(debtor_id: int, creditor_ids: Iterable[int]) -> Set[int]:
+    with current_app.test_request_context():
+        path = url_for('fetch.reachable_many', _external=False, debtorId=debtor_id)
+
+    url = urljoin(current_app.config['APP_FETCH_API_URL'], path)
+    response = requests_session.post(url, json={'creditorIds': list(creditor_ids)})
+    response.raise_for_status()
+
+    return set(response.json()['reachableCreditorIds'])
+
+
 def get_root_config_data_dict(
         debtor_ids: Iterable[int],
         cache_seconds: float = 7200.0) -> Dict[int, Optional[RootConfigData]]:
@@ -80,6 +165,48 @@ def _clear_root_config_data() -> None:
     _root_config_data_lru_cache.clear()
 
 
+def _clear_reachable() -> None:
+    with _reachable_lru_cache_lock:
+        _reachable_lru_cache.clear()
+        for key in _reachable_cache_stats:
+            _reachable_cache_stats[key] = 0
+
+
+def _increment_reachable_cache_stat(key: str) -> None:
+    with _reachable_lru_cache_lock:
+        _reachable_cache_stats[key] += 1
+
+
+def _lookup_reachable(debtor_id: int, creditor_id: int) -> bool:
+    key = (debtor_id, creditor_id)
+
+    with _reachable_lru_cache_lock:
+        is_reachable, expires_at = _reachable_lru_cache[key]
+        if expires_at < time.time():
+            del _reachable_lru_cache[key]
+            raise KeyError
+
+        _reachable_lru_cache.move_to_end(key)
+
+    return is_reachable
+
+
+def _register_reachable(debtor_id: int, creditor_id: int, is_reachable: bool) -> None:
+    config = current_app.config
+    max_size = config['APP_FETCH_REACHABLE_CACHE_SIZE']
+    ttl = config['APP_FETCH_REACHABLE_CACHE_SECONDS' if is_reachable else 'APP_FETCH_UNREACHABLE_CACHE_SECONDS']
+    if ttl <= 0.0 or max_size <= 0:
+        return
+
+    key = (debtor_id, creditor_id)
+    with _reachable_lru_cache_lock:
+        _reachable_lru_cache.pop(key, None)
+        while len(_reachable_lru_cache) >= max_size:
+            _reachable_lru_cache.popitem(last=False)
+
+        _reachable_lru_cache[key] = (is_reachable, time.time() + ttl)
+
+
 def _lookup_root_config_data(debtor_id: int, cutoff_ts: float) -> Optional[RootConfigData]:
     config_data, ts = _root_config_data_lru_cache[debtor_id]
     if ts < cutoff_ts:
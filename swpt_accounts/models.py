@@ -1,6 +1,7 @@
 import math
 from datetime import datetime, timezone
-from decimal import Decimal
+from typing import Iterable, List, Tuple
+from decimal import Decimal, Context, Inexact, MAX_PREC, MAX_EMAX, MIN_EMIN
 from sqlalchemy.dialects import postgresql as pg
 from sqlalchemy.sql.expression import func, null, or_, and_
 from swpt_lib.utils import date_to_int24
@@ -17,6 +18,16 @@ MIN_INT64 = -1 << 63
 MAX_INT64 = (1 << 63) - 1
 T0 = datetime(1970, 1, 1, tzinfo=timezone.utc)
 SECONDS_IN_YEAR = 365.25 * SECONDS_IN_DAY
+
+# The default decimal context rounds the results to 28 significant
+# digits. The stored procedures calculate current balances exactly,
+# and so must we.
+EXACT_DECIMAL_CONTEXT = Context(prec=MAX_PREC, Emax=MAX_EMAX, Emin=MIN_EMIN, traps=[Inexact])
+APPROX_BALANCE_REL_ERROR = 1e-12
+
+# An upper bound for the relative rounding error of the floating
+# point operations in `floor_current_balance` (8 ulps).
+FLOAT_REL_ERROR = 2.0 ** -50
 CONFIG_DATA_MAX_BYTES = 2000
 
 # Reserved coordinator types:
@@ -71,19 +82,139 @@ def calc_current_balance(
     # included in the current balance. Thus, accumulating interest on
     # the debtor's account has no effect.
     if creditor_id != ROOT_CREDITOR_ID:
-        current_balance += Decimal.from_float(interest)
+        current_balance = EXACT_DECIMAL_CONTEXT.add(current_balance, Decimal.from_float(interest))
         if current_balance > 0:
             k = calc_k(interest_rate)
             passed_seconds = max(0.0, (current_ts - last_change_ts).total_seconds())
-            current_balance *= Decimal.from_float(math.exp(k * passed_seconds))
+            growth = Decimal.from_float(math.exp(k * passed_seconds))
+            current_balance = EXACT_DECIMAL_CONTEXT.multiply(current_balance, growth)
 
     return current_balance
 
 
+def floor_current_balance(
+        *,
+        creditor_id: int,
+        principal: int,
+        interest: float,
+        interest_rate: float,
+        last_change_ts: datetime,
+        current_ts: datetime) -> int:
+
+    """Return `math.floor(calc_current_balance(...))`, but faster.
+
+    The current balance is calculated with floats, along with an upper
+    bound of the rounding error. When there is exactly one integer
+    that can be the floor of the exact result, it is returned.
+    Otherwise (this may happen for balances near integers, or bigger
+    than 2**53), `calc_current_balance` is called.
+
+    """
+
+    if creditor_id == ROOT_CREDITOR_ID:
+        return principal
+
+    # `math.exp` returns the same float as in `calc_current_balance`,
+    # so the error comes only from the (at most 3) roundings of the
+    # addition and the multiplication.
+    current_balance = principal + interest
+    max_error = (abs(principal) + abs(interest)) * FLOAT_REL_ERROR
+
+    if current_balance > max_error:
+        k = calc_k(interest_rate)
+        passed_seconds = max(0.0, (current_ts - last_change_ts).total_seconds())
+        growth = math.exp(k * passed_seconds)
+        current_balance *= growth
+        max_error *= growth
+        is_exact_sign = True
+    else:
+        is_exact_sign = current_balance < -max_error
+
+    if is_exact_sign and math.isfinite(current_balance):
+        lower_bound = math.floor(current_balance - max_error)
+        if lower_bound == math.floor(current_balance + max_error):
+            return lower_bound
+
+    return math.floor(calc_current_balance(
+        creditor_id=creditor_id,
+        principal=principal,
+        interest=interest,
+        interest_rate=interest_rate,
+        last_change_ts=last_change_ts,
+        current_ts=current_ts,
+    ))
+
+
+def calc_approx_current_balances(
+        accounts: Iterable[Tuple[int, int, float, float, datetime]],
+        current_ts: datetime) -> List[Tuple[float, float]]:
+
+    """Calculate the approximate current balances of many accounts at once.
+
+    Each element of `accounts` must be a `(creditor_id, principal,
+    interest, interest_rate, last_change_ts)` tuple. For each account,
+    a `(balance, max_error)` tuple is returned, where `balance` differs
+    from the exact value calculated by `calc_current_balance` by at
+    most `max_error`. This is much faster than calling
+    `calc_current_balance` for each account, because the calculations
+    are done with floats instead of decimals, and `calc_k` is called
+    once per interest rate.
+
+    """
+
+    ks = {}
+    results = []
+    for creditor_id, principal, interest, interest_rate, last_change_ts in accounts:
+        if creditor_id == ROOT_CREDITOR_ID:
+            current_balance = float(principal)
+            max_error = APPROX_BALANCE_REL_ERROR * abs(current_balance)
+        else:
+            current_balance = principal + interest
+            max_error = APPROX_BALANCE_REL_ERROR * (abs(principal) + abs(interest))
+            if current_balance > max_error:
+                k = ks.get(interest_rate)
+                if k is None:
+                    k = ks[interest_rate] = calc_k(interest_rate)
+                passed_seconds = max(0.0, (current_ts - last_change_ts).total_seconds())
+                growth = math.exp(k * passed_seconds)
+                current_balance *= growth
+                max_error *= growth
+            elif current_balance > -max_error:
+                # We can not know whether the exact balance is
+                # positive, and therefore, whether interest should be
+                # accumulated on it.
+                max_error = math.inf
+
+        results.append((current_balance, max_error))
+
+    return results
+
+
 def is_negligible_balance(balance, negligible_amount):
     return balance <= negligible_amount or balance <= 2.0
 
 
+def _account_config_property(name: str) -> property:
+    # The rarely changed account configuration columns are stored in
+    # the `account_config` table. A missing `account_config` row means
+    # that all those columns have their default values.
+
+    def fget(account):
+        config = account.config
+        return AccountConfig.DEFAULTS[name] if config is None else getattr(config, name)
+
+    def fset(account, value):
+        config = account.config
+        if config is None:
+            if value == AccountConfig.DEFAULTS[name]:
+                return
+            config = account.config = AccountConfig(**AccountConfig.DEFAULTS)
+
+        setattr(config, name, value)
+
+    return property(fget, fset)
+
+
 class Account(db.Model):
     CONFIG_SCHEDULED_FOR_DELETION_FLAG = 1 << 0
 
@@ -105,10 +236,6 @@ class Account(db.Model):
     last_transfer_committed_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=T0)
     negligible_amount = db.Column(db.REAL, nullable=False, default=0.0)
     config_flags = db.Column(db.Integer, nullable=False, default=0)
-    config_data = db.Column(db.String, nullable=False, default='')
-    debtor_info_iri = db.Column(db.String)
-    debtor_info_content_type = db.Column(db.String)
-    debtor_info_sha256 = db.Column(db.LargeBinary)
     status_flags = db.Column(
         db.Integer,
         nullable=False,
@@ -191,12 +318,18 @@ class Account(db.Model):
         db.CheckConstraint(last_transfer_id >= 0),
         db.CheckConstraint(last_transfer_number >= 0),
         db.CheckConstraint(negligible_amount >= 0.0),
-        db.CheckConstraint(or_(debtor_info_sha256 == null(), func.octet_length(debtor_info_sha256) == 32)),
         {
             'comment': 'Tells who owes what to whom.',
         }
     )
 
+    config = db.relationship('AccountConfig', uselist=False, cascade='all, delete-orphan', passive_deletes=True)
+
+    config_data = _account_config_property('config_data')
+    debtor_info_iri = _account_config_property('debtor_info_iri')
+    debtor_info_content_type = _account_config_property('debtor_info_content_type')
+    debtor_info_sha256 = _account_config_property('debtor_info_sha256')
+
     def calc_current_balance(self, current_ts: datetime) -> Decimal:
         return calc_current_balance(
             creditor_id=self.creditor_id,
@@ -207,6 +340,16 @@ class Account(db.Model):
             current_ts=current_ts,
         )
 
+    def floor_current_balance(self, current_ts: datetime) -> int:
+        return floor_current_balance(
+            creditor_id=self.creditor_id,
+            principal=self.principal,
+            interest=self.interest,
+            interest_rate=self.interest_rate,
+            last_change_ts=self.last_change_ts,
+            current_ts=current_ts,
+        )
+
     def calc_due_interest(self, amount: int, due_ts: datetime, current_ts: datetime) -> float:
         """Return the accumulated interest between `due_ts` and `current_ts`.
 
@@ -238,6 +381,63 @@ class Account(db.Model):
 
         return amount * (math.exp(k1 * t1 + k2 * t2) - 1.0)
 
+    def calc_total_due_interest(self, amounts: Iterable[Tuple[int, datetime]], current_ts: datetime) -> float:
+        """Return the sum of the accumulated interests for many amounts at once.
+
+        Each element of `amounts` is an `(amount, due_ts)` tuple. The
+        result is the same as summing `self.calc_due_interest(amount,
+        due_ts, current_ts)` for all elements (in the given order), but
+        the interest rates are converted to coefficients only once.
+
+        """
+
+        k1 = calc_k(self.previous_interest_rate)
+        k2 = calc_k(self.interest_rate)
+        last_interest_rate_change_ts = self.last_interest_rate_change_ts
+        exp = math.exp
+        total_due_interest = 0.0
+
+        for amount, due_ts in amounts:
+            end_ts = max(due_ts, current_ts)
+            interest_rate_change_ts = min(last_interest_rate_change_ts, end_ts)
+            t = (end_ts - due_ts).total_seconds()
+            t1 = max((interest_rate_change_ts - due_ts).total_seconds(), 0)
+            t2 = min((end_ts - interest_rate_change_ts).total_seconds(), t)
+            total_due_interest += amount * (exp(k1 * t1 + k2 * t2) - 1.0)
+
+        return total_due_interest
+
+
+class AccountConfig(db.Model):
+    DEFAULTS = {
+        'config_data': '',
+        'debtor_info_iri': None,
+        'debtor_info_content_type': None,
+        'debtor_info_sha256': None,
+    }
+
+    debtor_id = db.Column(db.BigInteger, primary_key=True)
+    creditor_id = db.Column(db.BigInteger, primary_key=True)
+    config_data = db.Column(db.String, nullable=False, default='')
+    debtor_info_iri = db.Column(db.String)
+    debtor_info_content_type = db.Column(db.String)
+    debtor_info_sha256 = db.Column(db.LargeBinary)
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ['debtor_id', 'creditor_id'],
+            ['account.debtor_id', 'account.creditor_id'],
+            ondelete='CASCADE',
+        ),
+        db.CheckConstraint(or_(debtor_info_sha256 == null(), func.octet_length(debtor_info_sha256) == 32)),
+        {
+            'comment': 'Contains the rarely changed, and potentially big, configuration columns of '
+                       'accounts. Keeping them out of the `account` table makes the frequent '
+                       'updates of `account` table rows cheaper, and allows them to be done as '
+                       'HOT (heap-only tuple) updates more often. A missing row means that all '
+                       'the columns have their default values.',
+        }
+    )
+
 
 class TransferRequest(db.Model):
     debtor_id = db.Column(db.BigInteger, primary_key=True)
@@ -385,6 +585,24 @@ class RegisteredBalanceChange(db.Model):
     )
 
 
+class RootAccountShard(db.Model):
+    debtor_id = db.Column(db.BigInteger, primary_key=True)
+    shard_number = db.Column(db.SmallInteger, primary_key=True)
+    principal_delta = db.Column(db.BigInteger, nullable=False)
+    interest_delta = db.Column(db.FLOAT, nullable=False)
+    __table_args__ = (
+        {
+            'comment': 'Represents a part of the balance changes of a given debtor\'s account, '
+                       'which has not been applied to the `account` table row yet. When the '
+                       'debtor\'s account receives lots of balance changes, writing them to '
+                       'several shards spreads the writes over several rows, thus reducing the '
+                       'lock contention on the debtor\'s `account` table row. The shards are '
+                       'applied to the `account` table row (and deleted) whenever the debtor\'s '
+                       'account gets locked.',
+        }
+    )
+
+
 class PendingBalanceChange(db.Model):
     debtor_id = db.Column(db.BigInteger, primary_key=True)
     other_creditor_id = db.Column(
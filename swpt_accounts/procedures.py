@@ -1,41 +1,73 @@
 import math
+import random
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from typing import TypeVar, Iterable, Tuple, Union, Optional, Callable
+from typing import TypeVar, Iterable, Iterator, Tuple, Union, Optional, Callable, Dict, List, Set
 from decimal import Decimal
-from sqlalchemy.sql.expression import tuple_, and_
-from sqlalchemy.exc import IntegrityError
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql.expression import tuple_, and_, func, cast, select, true, literal_column, text, literal, \
+    union_all
+from sqlalchemy.dialects.postgresql import insert, ARRAY
 from swpt_lib.utils import Seqnum, increment_seqnum
 from swpt_accounts.extensions import db
 from swpt_accounts.schemas import parse_root_config_data
-from swpt_accounts.models import Account, TransferRequest, PreparedTransfer, PendingBalanceChange, \
+from swpt_accounts.models import Account, AccountConfig, TransferRequest, PreparedTransfer, PendingBalanceChange, \
     RegisteredBalanceChange, PendingBalanceChangeSignal, RejectedConfigSignal, RejectedTransferSignal, \
     PreparedTransferSignal, FinalizedTransferSignal, AccountUpdateSignal, AccountTransferSignal, \
-    FinalizationRequest, ROOT_CREDITOR_ID, INTEREST_RATE_FLOOR, INTEREST_RATE_CEIL, MAX_INT32, MIN_INT64, \
-    MAX_INT64, SECONDS_IN_DAY, CT_INTEREST, CT_DELETE, CT_DIRECT, SC_OK, SC_SENDER_IS_UNREACHABLE, \
+    FinalizationRequest, RootAccountShard, ROOT_CREDITOR_ID, INTEREST_RATE_FLOOR, INTEREST_RATE_CEIL, MAX_INT32, \
+    MIN_INT64, MAX_INT64, SECONDS_IN_DAY, CT_INTEREST, CT_DELETE, CT_DIRECT, SC_OK, SC_SENDER_IS_UNREACHABLE, \
     SC_RECIPIENT_IS_UNREACHABLE, SC_INSUFFICIENT_AVAILABLE_AMOUNT, SC_RECIPIENT_SAME_AS_SENDER, \
-    SC_TOO_MANY_TRANSFERS, SC_TOO_LOW_INTEREST_RATE, T0, is_negligible_balance, contain_principal_overflow
+    SC_TOO_MANY_TRANSFERS, SC_TOO_LOW_INTEREST_RATE, T0, OutboxMessage, is_negligible_balance, \
+    contain_principal_overflow, floor_current_balance, bulk_save_signals, EXACT_DECIMAL_CONTEXT
 
 T = TypeVar('T')
 atomic: Callable[[T], T] = db.atomic
 
+STREAM_QUERY_BATCH_SIZE = 1000
+
 ACCOUNT_PK = tuple_(
     Account.debtor_id,
     Account.creditor_id,
 )
+PENDING_BALANCE_CHANGE_ACCOUNT_PK = tuple_(
+    PendingBalanceChange.debtor_id,
+    PendingBalanceChange.creditor_id,
+)
 REGISTERED_BALANCE_CHANGE_PK = tuple_(
     RegisteredBalanceChange.debtor_id,
     RegisteredBalanceChange.other_creditor_id,
     RegisteredBalanceChange.change_id,
 )
 RC_INVALID_CONFIGURATION = 'INVALID_CONFIGURATION'
-PREPARED_TRANSFER_JOIN_CLAUSE = and_(
-    FinalizationRequest.debtor_id == PreparedTransfer.debtor_id,
-    FinalizationRequest.sender_creditor_id == PreparedTransfer.sender_creditor_id,
-    FinalizationRequest.transfer_id == PreparedTransfer.transfer_id,
-    FinalizationRequest.coordinator_type == PreparedTransfer.coordinator_type,
-    FinalizationRequest.coordinator_id == PreparedTransfer.coordinator_id,
-    FinalizationRequest.coordinator_request_id == PreparedTransfer.coordinator_request_id,
-)
+# The `xmin` system column of a row contains the (32-bit) ID of the
+# transaction that inserted the current version of the row.
+ACCOUNT_XMIN = literal_column('xmin::text::bigint').label('xmin')
+CURRENT_XID = (func.txid_current() % 4294967296).label('xid')
+
+_account_cache = threading.local()
+
+
+def is_valid_config(creditor_id: int, negligible_amount: float, config_data: str) -> bool:
+    if negligible_amount >= 0.0:
+        if config_data == '':
+            return True
+
+        # NOTE: Currently, only the root account is allowed to have a
+        # non-empty string as config data. ("Normal" accounts can not
+        # set config data.)
+        if creditor_id == ROOT_CREDITOR_ID:
+            try:
+                parse_root_config_data(config_data)
+            except ValueError:
+                return False
+            return True
+
+    return False
 
 
 @atomic
@@ -59,27 +91,10 @@ def configure_account(
             account.status_flags &= ~Account.STATUS_DELETED_FLAG
             should_be_initialized = True
 
-    def is_valid_config():
-        if negligible_amount >= 0.0:
-            if config_data == '':
-                return True
-
-            # NOTE: Currently, only the root account is allowed to
-            # have a non-empty string as config data. ("Normal"
-            # accounts can not set config data.)
-            if creditor_id == ROOT_CREDITOR_ID:
-                try:
-                    parse_root_config_data(config_data)
-                except ValueError:
-                    return False
-                return True
-
-        return False
-
     def try_to_configure(account):
         nonlocal should_be_initialized
 
-        if is_valid_config():
+        if is_valid_config(creditor_id, negligible_amount, config_data):
             if account is None:
                 account = _create_account(debtor_id, creditor_id, current_ts)
                 should_be_initialized = True
@@ -173,23 +188,26 @@ def finalize_transfer(
         transfer_note: str = '',
         ts: datetime = None) -> None:
 
-    db.session.add(FinalizationRequest(
-        debtor_id=debtor_id,
-        sender_creditor_id=creditor_id,
-        transfer_id=transfer_id,
-        coordinator_type=coordinator_type,
-        coordinator_id=coordinator_id,
-        coordinator_request_id=coordinator_request_id,
-        committed_amount=committed_amount,
-        transfer_note_format=transfer_note_format,
-        transfer_note=transfer_note,
-        ts=ts or datetime.now(tz=timezone.utc),
-    ))
-
-    try:
-        db.session.flush()
-    except IntegrityError:
-        db.session.rollback()
+    # NOTE: Duplicated finalization requests are ignored with "ON
+    # CONFLICT DO NOTHING", instead of rolling back the transaction,
+    # because this procedure may be called from within a bigger
+    # transaction (see `actors.process_message_batch`).
+    db.session.execute(
+        insert(FinalizationRequest.__table__).
+        values(
+            debtor_id=debtor_id,
+            sender_creditor_id=creditor_id,
+            transfer_id=transfer_id,
+            coordinator_type=coordinator_type,
+            coordinator_id=coordinator_id,
+            coordinator_request_id=coordinator_request_id,
+            committed_amount=committed_amount,
+            transfer_note_format=transfer_note_format,
+            transfer_note=transfer_note,
+            ts=ts or datetime.now(tz=timezone.utc),
+        ).
+        on_conflict_do_nothing()
+    )
 
 
 @atomic
@@ -205,11 +223,32 @@ def is_reachable_account(debtor_id: int, creditor_id: int) -> bool:
     return db.session.query(account_query.exists()).scalar()
 
 
+@atomic
+def get_reachable_creditor_ids(debtor_id: int, creditor_ids: Iterable[int]) -> Set[int]:
+    creditor_ids = set(creditor_ids)
+    reachable_creditor_ids = {ROOT_CREDITOR_ID} & creditor_ids
+    creditor_ids.discard(ROOT_CREDITOR_ID)
+
+    if creditor_ids:
+        rows = db.session.\
+            query(Account.creditor_id).\
+            filter(Account.debtor_id == debtor_id).\
+            filter(Account.creditor_id.in_(creditor_ids)).\
+            filter(Account.status_flags.op('&')(Account.STATUS_DELETED_FLAG) == 0).\
+            filter(Account.config_flags.op('&')(Account.CONFIG_SCHEDULED_FOR_DELETION_FLAG) == 0).\
+            all()
+        reachable_creditor_ids.update(row.creditor_id for row in rows)
+
+    return reachable_creditor_ids
+
+
 @atomic
 def get_account_config_data(debtor_id: int, creditor_id: int) -> Optional[str]:
     return db.session.\
-        query(Account.config_data).\
-        filter_by(debtor_id=debtor_id, creditor_id=creditor_id).\
+        query(func.coalesce(AccountConfig.config_data, '')).\
+        select_from(Account).\
+        outerjoin(Account.config).\
+        filter(Account.debtor_id == debtor_id, Account.creditor_id == creditor_id).\
         scalar()
 
 
@@ -339,159 +378,357 @@ def try_to_delete_account(debtor_id: int, creditor_id: int) -> None:
             _mark_account_as_deleted(account, current_ts)
 
 
-@atomic
-def get_accounts_with_transfer_requests(max_count: int = None) -> Iterable[Tuple[int, int]]:
-    query = db.session.query(TransferRequest.debtor_id, TransferRequest.sender_creditor_id).distinct()
-    if max_count is not None:
-        query = query.limit(max_count)
+def get_accounts_with_transfer_requests(
+        max_count: int = None,
+        bucket: int = 0,
+        buckets_count: int = 1) -> Iterator[Tuple[int, int]]:
 
-    return query.all()
+    query = db.session.\
+        query(TransferRequest.debtor_id, TransferRequest.sender_creditor_id).\
+        filter(_in_bucket(TransferRequest.debtor_id, TransferRequest.sender_creditor_id, bucket, buckets_count)).\
+        distinct()
 
+    return _stream_query_results(query, max_count)
 
-@atomic
-def process_transfer_requests(debtor_id: int, creditor_id: int, commit_period: int = MAX_INT32) -> None:
-    current_ts = datetime.now(tz=timezone.utc)
 
-    transfer_requests = TransferRequest.query.\
+@atomic
+def get_transfer_request_recipients(debtor_id: int, creditor_id: int) -> List[int]:
+    rows = db.session.\
+        query(TransferRequest.recipient_creditor_id).\
         filter_by(debtor_id=debtor_id, sender_creditor_id=creditor_id).\
-        with_for_update(skip_locked=True).\
+        distinct().\
         all()
 
+    return [row.recipient_creditor_id for row in rows]
+
+
+@atomic
+def process_transfer_requests(
+        debtor_id: int,
+        creditor_id: int,
+        commit_period: int = MAX_INT32,
+        recipients_reachability: Dict[int, bool] = None) -> None:
+
+    """Process the queued transfer requests from a given account.
+
+    When `recipients_reachability` is passed, the recipients of the
+    transfer requests are assumed to have not been checked yet. In
+    this case, requests to unreachable recipients will be rejected,
+    and requests to recipients that are missing from the dictionary
+    will be left in the queue.
+
+    """
+
+    current_ts = datetime.now(tz=timezone.utc)
+    transfer_requests = _claim_transfer_requests(debtor_id, creditor_id, recipients_reachability)
+
     if transfer_requests:
         sender_account = get_account(debtor_id, creditor_id, lock=True)
-        rejected_transfer_signals = []
-        prepared_transfer_signals = []
+        _process_transfer_requests(
+            transfer_requests, sender_account, current_ts, commit_period, recipients_reachability)
 
-        for tr in transfer_requests:
-            signal = _process_transfer_request(tr, sender_account, current_ts, commit_period)
 
-            if isinstance(signal, RejectedTransferSignal):
-                rejected_transfer_signals.append(signal)
-            elif isinstance(signal, PreparedTransferSignal):
-                prepared_transfer_signals.append(signal)
-            else:  # pragma: nocover
-                raise RuntimeError('unexpected return type')
+@atomic
+def process_transfer_requests_in_db(
+        debtor_id: int,
+        creditor_id: int,
+        commit_period: int = MAX_INT32,
+        recipients_reachability: Dict[int, bool] = None) -> None:
 
-        db.session.bulk_save_objects(rejected_transfer_signals, preserve_order=False)
-        db.session.bulk_save_objects(prepared_transfer_signals, preserve_order=False)
+    """Do the same as `process_transfer_requests`, but in a stored procedure."""
 
+    if recipients_reachability is None:
+        checked_recipients = reachable_recipients = None
+    else:
+        checked_recipients = list(recipients_reachability)
+        reachable_recipients = [r for r, is_reachable in recipients_reachability.items() if is_reachable]
+
+    _call_stored_procedure(func.process_transfer_requests(
+        debtor_id,
+        creditor_id,
+        commit_period,
+        datetime.now(tz=timezone.utc),
+        cast(checked_recipients, ARRAY(db.BigInteger)),
+        cast(reachable_recipients, ARRAY(db.BigInteger)),
+    ))
 
-@atomic
-def get_accounts_with_finalization_requests(max_count: int = None) -> Iterable[Tuple[int, int]]:
-    query = db.session.query(FinalizationRequest.debtor_id, FinalizationRequest.sender_creditor_id).distinct()
-    if max_count is not None:
-        query = query.limit(max_count)
 
-    return query.all()
+def get_accounts_with_finalization_requests(
+        max_count: int = None,
+        bucket: int = 0,
+        buckets_count: int = 1) -> Iterator[Tuple[int, int]]:
+
+    query = db.session.\
+        query(FinalizationRequest.debtor_id, FinalizationRequest.sender_creditor_id).\
+        filter(_in_bucket(
+            FinalizationRequest.debtor_id, FinalizationRequest.sender_creditor_id, bucket, buckets_count)).\
+        distinct()
+
+    return _stream_query_results(query, max_count)
 
 
 @atomic
 def process_finalization_requests(debtor_id: int, sender_creditor_id: int) -> None:
     current_ts = datetime.now(tz=timezone.utc)
 
-    requests = db.session.query(FinalizationRequest, PreparedTransfer).\
-        outerjoin(PreparedTransfer, PREPARED_TRANSFER_JOIN_CLAUSE).\
-        filter(
-            FinalizationRequest.debtor_id == debtor_id,
-            FinalizationRequest.sender_creditor_id == sender_creditor_id).\
-        with_for_update(skip_locked=True, of=FinalizationRequest).\
-        all()
-
-    if requests:
-        principal_delta = 0
-        pending_balance_change_signals = []
+    finalization_requests = _claim_queued_rows(
+        FinalizationRequest,
+        FinalizationRequest.debtor_id == debtor_id,
+        FinalizationRequest.sender_creditor_id == sender_creditor_id,
+    )
 
+    if finalization_requests:
         sender_account = get_account(debtor_id, sender_creditor_id, lock=True)
-        if sender_account:
-            starting_balance = math.floor(sender_account.calc_current_balance(current_ts))
-            min_account_balance = _get_min_account_balance(sender_creditor_id)
-
-        for finalization_request, prepared_transfer in requests:
-            if sender_account and prepared_transfer:
-                expendable_amount = (
-                    + starting_balance
-                    + principal_delta
-                    - sender_account.total_locked_amount
-                    - min_account_balance
-                )
-                signal = _finalize_prepared_transfer(
-                    prepared_transfer,
-                    finalization_request,
-                    sender_account,
-                    expendable_amount,
-                    current_ts,
-                )
-                if signal:
-                    committed_amount = signal.principal_delta
-                    assert committed_amount > 0
-                    pending_balance_change_signals.append(signal)
-                else:
-                    committed_amount = 0
-
-                principal_delta -= committed_amount
-                db.session.delete(prepared_transfer)
-
-            db.session.delete(finalization_request)
+        principal_delta = _process_finalization_requests(
+            debtor_id, sender_creditor_id, finalization_requests, sender_account, current_ts)
 
         if principal_delta != 0:
             assert sender_account
             _apply_account_change(sender_account, principal_delta, 0.0, current_ts)
 
-        db.session.bulk_save_objects(pending_balance_change_signals, preserve_order=False)
+
+@atomic
+def process_finalization_requests_in_db(debtor_id: int, sender_creditor_id: int) -> None:
+    """Do the same as `process_finalization_requests`, but in a stored procedure."""
+
+    _call_stored_procedure(func.process_finalization_requests(
+        debtor_id,
+        sender_creditor_id,
+        datetime.now(tz=timezone.utc),
+    ))
+
+
+def get_accounts_with_pending_balance_changes(
+        max_count: int = None,
+        bucket: int = 0,
+        buckets_count: int = 1) -> Iterator[Tuple[int, int]]:
+
+    """Return an iterator over the accounts that have pending balance changes.
+
+    The accounts are ordered by primary key, so that they can be
+    processed in chunks (see `process_pending_balance_changes_for_accounts`).
+    Only the accounts in the given bucket are returned (see `is_in_bucket`).
+
+    """
+
+    query = db.session.\
+        query(PendingBalanceChange.debtor_id, PendingBalanceChange.creditor_id).\
+        filter(_in_bucket(PendingBalanceChange.debtor_id, PendingBalanceChange.creditor_id, bucket, buckets_count)).\
+        distinct().\
+        order_by(PendingBalanceChange.debtor_id, PendingBalanceChange.creditor_id)
+
+    return _stream_query_results(query, max_count)
 
 
 @atomic
-def get_accounts_with_pending_balance_changes(max_count: int = None) -> Iterable[Tuple[int, int]]:
-    query = db.session.query(PendingBalanceChange.debtor_id, PendingBalanceChange.creditor_id).distinct()
-    if max_count is not None:
-        query = query.limit(max_count)
+def process_pending_balance_changes(debtor_id: int, creditor_id: int, root_account_shards: int = 1) -> None:
+    """Apply the pending balance changes for a given account.
+
+    When `root_account_shards` is bigger than 1, the changes for the
+    debtor's account are written to one of that many shards (see
+    `RootAccountShard`), without exclusively locking the debtor's
+    account. The shards are added to the debtor's account before
+    sending an `AccountUpdateSignal` for it, and by
+    `apply_root_account_shards`.
 
-    return query.all()
+    """
+
+    current_ts = datetime.now(tz=timezone.utc)
+
+    changes = _claim_queued_rows(
+        PendingBalanceChange,
+        PendingBalanceChange.debtor_id == debtor_id,
+        PendingBalanceChange.creditor_id == creditor_id,
+    )
+
+    if changes:
+        if creditor_id == ROOT_CREDITOR_ID and root_account_shards > 1:
+            # The debtor's account is share-locked, so that its
+            # interest rate can not change until the shard is written.
+            account = Account.query.\
+                filter_by(debtor_id=debtor_id, creditor_id=creditor_id).\
+                with_for_update(read=True).\
+                one_or_none()
+            if account and not account.status_flags & Account.STATUS_DELETED_FLAG:
+                principal_delta, interest_delta = _process_pending_balance_changes(account, changes, current_ts)
+                _add_to_root_account_shard(
+                    debtor_id, random.randrange(root_account_shards), principal_delta, interest_delta)
+                return
+
+        account = _lock_or_create_account(debtor_id, creditor_id, current_ts)
+        _apply_pending_balance_changes(account, changes, current_ts)
 
 
 @atomic
-def process_pending_balance_changes(debtor_id: int, creditor_id: int) -> None:
+def process_pending_balance_changes_for_accounts(account_pks: Iterable[Tuple[int, int]]) -> None:
+    """Process the pending balance changes for many accounts in a single transaction.
+
+    Each element of `account_pks` is a `(debtor_id, creditor_id)`
+    tuple. Accounts that are locked by another transaction are
+    skipped, and their pending changes are left in the queue. The updated account rows are written back with a single
+    UPDATE statement.
+
+    """
+
+    account_pks = sorted(set(account_pks))
+    if not account_pks:
+        return
+
     current_ts = datetime.now(tz=timezone.utc)
 
-    changes = PendingBalanceChange.query.\
-        filter_by(debtor_id=debtor_id, creditor_id=creditor_id).\
+    locked_accounts = Account.query.\
+        filter(ACCOUNT_PK.in_(account_pks)).\
+        order_by(Account.debtor_id, Account.creditor_id).\
         with_for_update(skip_locked=True).\
         all()
+    locked_account_pks = {(a.debtor_id, a.creditor_id) for a in locked_accounts}
+
+    # Accounts that have not been locked either do not exist (and
+    # should be created if they have pending changes), or are locked
+    # by another transaction (and should be skipped).
+    not_locked_account_pks = [pk for pk in account_pks if pk not in locked_account_pks]
+    if not_locked_account_pks:
+        existing_account_pks = set(
+            db.session.query(Account.debtor_id, Account.creditor_id).
+            filter(ACCOUNT_PK.in_(not_locked_account_pks)).
+            all()
+        )
+        account_pks = [pk for pk in account_pks if pk in locked_account_pks or pk not in existing_account_pks]
+        if not account_pks:
+            return
+
+    changes_by_account_pk: Dict[Tuple[int, int], list] = {}
+    for change in _claim_queued_rows(PendingBalanceChange, PENDING_BALANCE_CHANGE_ACCOUNT_PK.in_(account_pks)):
+        changes_by_account_pk.setdefault((change.debtor_id, change.creditor_id), []).append(change)
+
+    locked_accounts = [a for a in locked_accounts if (a.debtor_id, a.creditor_id) in changes_by_account_pk]
+    accounts = {(a.debtor_id, a.creditor_id): a for a in locked_accounts}
+    for pk in changes_by_account_pk:
+        if pk not in accounts:
+            accounts[pk] = _lock_or_create_account(pk[0], pk[1], current_ts)
+
+    # The locked accounts are written back by `_write_back_accounts`,
+    # so the ORM must not flush them in the meantime.
+    with db.session.no_autoflush:
+        for account in locked_accounts:
+            _revive_deleted_account(account, current_ts)
+
+        for pk in sorted(accounts):
+            _apply_pending_balance_changes(accounts[pk], changes_by_account_pk[pk], current_ts)
+
+        _write_back_accounts(locked_accounts)
+
+
+@atomic
+def process_pending_balance_changes_in_db(debtor_id: int, creditor_id: int) -> None:
+    """Do the same as `process_pending_balance_changes`, but in a stored procedure."""
+
+    _call_stored_procedure(func.process_pending_balance_changes(
+        debtor_id,
+        creditor_id,
+        datetime.now(tz=timezone.utc),
+    ))
+
+
+@atomic
+def process_pending_balance_changes_for_accounts_in_db(account_pks: Iterable[Tuple[int, int]]) -> None:
+    """Do the same as `process_pending_balance_changes_for_accounts`, but in stored procedures."""
+
+    current_ts = datetime.now(tz=timezone.utc)
+    for debtor_id, creditor_id in sorted(set(account_pks)):
+        _call_stored_procedure(func.process_pending_balance_changes(debtor_id, creditor_id, current_ts))
+
+
+def get_accounts_with_requests(
+        max_count: int = None,
+        bucket: int = 0,
+        buckets_count: int = 1) -> Iterator[Tuple[int, int]]:
+
+    """Return an iterator over the accounts that have any queued requests."""
+
+    query = db.session.\
+        query(TransferRequest.debtor_id, TransferRequest.sender_creditor_id).\
+        filter(_in_bucket(TransferRequest.debtor_id, TransferRequest.sender_creditor_id, bucket, buckets_count)).\
+        union(
+            db.session.
+            query(FinalizationRequest.debtor_id, FinalizationRequest.sender_creditor_id).
+            filter(_in_bucket(
+                FinalizationRequest.debtor_id, FinalizationRequest.sender_creditor_id, bucket, buckets_count)),
+            db.session.
+            query(PendingBalanceChange.debtor_id, PendingBalanceChange.creditor_id).
+            filter(_in_bucket(
+                PendingBalanceChange.debtor_id, PendingBalanceChange.creditor_id, bucket, buckets_count)),
+        )
+
+    return _stream_query_results(query, max_count)
+
+
+@atomic
+def process_account_requests(
+        debtor_id: int,
+        creditor_id: int,
+        commit_period: int = MAX_INT32,
+        recipients_reachability: Dict[int, bool] = None) -> None:
+
+    """Process all the queued requests for a given account at once.
+
+    This does the same as `process_pending_balance_changes`,
+    `process_finalization_requests`, and `process_transfer_requests`
+    (in this order), but locks the account only once, and applies a
+    single change to the account. The transfer requests are processed
+    last, so that they can use the amounts received by the pending
+    balance changes.
+
+    """
+
+    current_ts = datetime.now(tz=timezone.utc)
+    changes = _claim_queued_rows(
+        PendingBalanceChange,
+        PendingBalanceChange.debtor_id == debtor_id,
+        PendingBalanceChange.creditor_id == creditor_id,
+    )
+    finalization_requests = _claim_queued_rows(
+        FinalizationRequest,
+        FinalizationRequest.debtor_id == debtor_id,
+        FinalizationRequest.sender_creditor_id == creditor_id,
+    )
+    transfer_requests = _claim_transfer_requests(debtor_id, creditor_id, recipients_reachability)
 
     if changes:
-        applied_change_pks = []
-        principal_delta = 0
-        interest_delta = 0.0
         account = _lock_or_create_account(debtor_id, creditor_id, current_ts)
+    elif finalization_requests or transfer_requests:
+        account = get_account(debtor_id, creditor_id, lock=True)
+    else:
+        return
 
-        for change in changes:
-            principal_delta += change.principal_delta
-
-            # We should compensate for the fact that the transfer was
-            # committed at `change.committed_at`, but the transferred
-            # amount is being added to the account's principal just
-            # now (`current_ts`).
-            interest_delta += account.calc_due_interest(change.principal_delta, change.committed_at, current_ts)
-
-            _insert_account_transfer_signal(
-                account=account,
-                coordinator_type=change.coordinator_type,
-                other_creditor_id=change.other_creditor_id,
-                committed_at=change.committed_at,
-                acquired_amount=change.principal_delta,
-                transfer_note_format=change.transfer_note_format,
-                transfer_note=change.transfer_note,
-                principal=contain_principal_overflow(account.principal + principal_delta),
-            )
+    principal_delta = 0
+    interest_delta = 0.0
 
-            applied_change_pks.append((change.debtor_id, change.other_creditor_id, change.change_id))
-            db.session.delete(change)
+    if changes:
+        principal_delta, interest_delta = _process_pending_balance_changes(account, changes, current_ts)
 
+    if finalization_requests:
+        principal_delta += _process_finalization_requests(
+            debtor_id, creditor_id, finalization_requests, account, current_ts, principal_delta, interest_delta)
+
+    if changes or principal_delta != 0:
+        assert account
         _apply_account_change(account, principal_delta, interest_delta, current_ts)
 
-        RegisteredBalanceChange.query.\
-            filter(REGISTERED_BALANCE_CHANGE_PK.in_(applied_change_pks)).\
-            update({RegisteredBalanceChange.is_applied: True}, synchronize_session=False)
+    if transfer_requests:
+        _process_transfer_requests(transfer_requests, account, current_ts, commit_period, recipients_reachability)
+
+
+def is_in_bucket(debtor_id: int, creditor_id: int, bucket: int, buckets_count: int) -> bool:
+    """Return whether the given account belongs to the given bucket.
+
+    The accounts are distributed among `buckets_count` buckets, so
+    that the accounts in different buckets can be processed by
+    different processes.
+
+    """
+
+    return (debtor_id ^ creditor_id) % buckets_count == bucket
 
 
 @atomic
@@ -509,7 +746,12 @@ def get_available_amount(debtor_id: int, creditor_id: int) -> Optional[int]:
 
     account = get_account(debtor_id, creditor_id)
     if account:
-        return _get_available_amount(account, current_ts)
+        available_amount = _get_available_amount(account, current_ts)
+        if creditor_id == ROOT_CREDITOR_ID:
+            available_amount = contain_principal_overflow(
+                available_amount + _get_root_account_shards_principal_delta(debtor_id))
+
+        return available_amount
 
     return None
 
@@ -543,41 +785,166 @@ def insert_pending_balance_change(
         principal_delta: int,
         cutoff_ts: datetime = T0) -> None:
 
-    assert MIN_INT64 <= debtor_id <= MAX_INT64
-    assert MIN_INT64 <= other_creditor_id <= MAX_INT64
-    assert MIN_INT64 <= change_id <= MAX_INT64
-
-    if committed_at < cutoff_ts:
-        return  # pragma: nocover
-
-    registered_balance_change_query = RegisteredBalanceChange.query.filter_by(
+    insert_pending_balance_changes([dict(
         debtor_id=debtor_id,
         other_creditor_id=other_creditor_id,
         change_id=change_id,
+        creditor_id=creditor_id,
+        coordinator_type=coordinator_type,
+        transfer_note_format=transfer_note_format,
+        transfer_note=transfer_note,
+        committed_at=committed_at,
+        principal_delta=principal_delta,
+    )], cutoff_ts)
+
+
+@atomic
+def insert_pending_balance_changes(changes: Iterable[Dict], cutoff_ts: datetime = T0) -> None:
+    """Register and queue many pending balance changes at once.
+
+    Each element of `changes` is a dictionary that contains the
+    arguments for `insert_pending_balance_change` (without
+    `cutoff_ts`). Balance changes that have been registered already
+    are ignored.
+
+    """
+
+    # The rows are inserted in primary key order, to reduce the chance
+    # of deadlocks with concurrent inserts of overlapping changes.
+    changes = sorted(
+        (change for change in changes if change['committed_at'] >= cutoff_ts),
+        key=lambda change: (change['debtor_id'], change['other_creditor_id'], change['change_id']),
     )
-    if not db.session.query(registered_balance_change_query.exists()).scalar():
-        with db.retry_on_integrity_error():
-            db.session.add(RegisteredBalanceChange(
-                debtor_id=debtor_id,
-                other_creditor_id=other_creditor_id,
-                change_id=change_id,
-                committed_at=committed_at,
-            ))
+    if not changes:
+        return
 
-        db.session.add(PendingBalanceChange(
-            debtor_id=debtor_id,
-            other_creditor_id=other_creditor_id,
-            change_id=change_id,
-            creditor_id=creditor_id,
-            coordinator_type=coordinator_type,
-            transfer_note_format=transfer_note_format,
-            transfer_note=transfer_note,
-            committed_at=committed_at,
-            principal_delta=principal_delta,
-        ))
+    for change in changes:
+        assert MIN_INT64 <= change['debtor_id'] <= MAX_INT64
+        assert MIN_INT64 <= change['other_creditor_id'] <= MAX_INT64
+        assert MIN_INT64 <= change['change_id'] <= MAX_INT64
+
+    registered_pks = db.session.execute(
+        insert(RegisteredBalanceChange.__table__).
+        values([
+            dict(
+                debtor_id=change['debtor_id'],
+                other_creditor_id=change['other_creditor_id'],
+                change_id=change['change_id'],
+                committed_at=change['committed_at'],
+                is_applied=False,
+            )
+            for change in changes
+        ]).
+        on_conflict_do_nothing().
+        returning(
+            RegisteredBalanceChange.__table__.c.debtor_id,
+            RegisteredBalanceChange.__table__.c.other_creditor_id,
+            RegisteredBalanceChange.__table__.c.change_id,
+        )
+    ).fetchall()
+
+    if registered_pks:
+        changes_by_pk = {}
+        for change in changes:
+            changes_by_pk.setdefault((change['debtor_id'], change['other_creditor_id'], change['change_id']), change)
+
+        db.session.execute(
+            insert(PendingBalanceChange.__table__).
+            values([
+                dict(
+                    debtor_id=change['debtor_id'],
+                    other_creditor_id=change['other_creditor_id'],
+                    change_id=change['change_id'],
+                    creditor_id=change['creditor_id'],
+                    coordinator_type=change['coordinator_type'],
+                    transfer_note_format=change['transfer_note_format'],
+                    transfer_note=change['transfer_note'],
+                    committed_at=change['committed_at'],
+                    principal_delta=change['principal_delta'],
+                )
+                for change in (changes_by_pk[pk] for pk in sorted(tuple(pk) for pk in registered_pks))
+            ])
+        )
+
+
+@atomic
+def get_table_partitions(table_name: str) -> List[str]:
+    """Return the names of the partitions of the given table.
+
+    If the table is not partitioned, a list containing only the name
+    of the table is returned.
+
+    """
+
+    rows = db.session.execute(
+        text('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+             'WHERE i.inhparent = CAST(:table_name AS regclass) ORDER BY c.relname'),
+        {'table_name': table_name},
+    ).fetchall()
+
+    return [row[0] for row in rows] or [table_name]
+
+
+@atomic
+def flush_signals(model: type, table_name: str, max_count: int) -> int:
+    """Send and delete up to `max_count` signals from the given table.
+
+    `table_name` is the name of the `model`'s table, or the name of
+    one of its partitions. Signals that are locked by concurrent
+    transactions are skipped. Returns the number of sent signals.
+
+    """
+
+    signals = db.session.\
+        query(model).\
+        from_statement(
+            text(f'SELECT * FROM {table_name} LIMIT :max_count FOR UPDATE SKIP LOCKED').
+            bindparams(max_count=max_count)
+        ).\
+        all()
+
+    if signals:
+        model.send_signalbus_messages(signals)
+
+    for signal in signals:
+        db.session.delete(signal)
+
+    return len(signals)
+
+
+@atomic
+def publish_outbox_messages(max_count: int) -> int:
+    """Send and delete up to `max_count` messages from the outbox table.
+
+    The messages are sent in the order in which they have been
+    written. Returns the number of sent messages.
+
+    """
+
+    table = OutboxMessage.__table__
+    messages = db.session.execute(
+        select([table]).
+        order_by(table.c.message_id).
+        limit(max_count).
+        with_for_update(skip_locked=True)
+    ).fetchall()
+
+    if messages:
+        OutboxMessage.send_messages(messages)
+        db.session.execute(
+            table.delete().
+            where(table.c.message_id.in_([m.message_id for m in messages]))
+        )
+
+    return len(messages)
 
 
 def _insert_account_update_signal(account: Account, current_ts: datetime) -> None:
+    if account.creditor_id == ROOT_CREDITOR_ID and not account.status_flags & Account.STATUS_DELETED_FLAG:
+        # The signal must include the changes that have been written
+        # to the debtor's account shards.
+        _apply_root_account_shards(account, current_ts)
+
     account.last_heartbeat_ts = current_ts
     account.pending_account_update = False
 
@@ -621,11 +988,186 @@ def _create_account(debtor_id: int, creditor_id: int, current_ts: datetime) -> A
 
 
 def _get_account_instance(debtor_id: int, creditor_id: int, lock: bool = False) -> Optional[Account]:
-    query = Account.query.filter_by(debtor_id=debtor_id, creditor_id=creditor_id)
-    if lock:
-        query = query.with_for_update()
+    if lock and getattr(_account_cache, 'accounts', None) is not None:
+        account = _get_cached_account_instance(debtor_id, creditor_id)
+    else:
+        query = Account.query.filter_by(debtor_id=debtor_id, creditor_id=creditor_id)
+        if lock:
+            query = query.with_for_update()
+
+        account = query.one_or_none()
+
+    return account
+
+
+@atomic
+def apply_root_account_shards(debtor_ids: Iterable[int]) -> None:
+    """Apply the shards of the given debtors' accounts to the `account` table rows."""
+
+    debtor_ids_with_shards = db.session.\
+        query(RootAccountShard.debtor_id).\
+        filter(RootAccountShard.debtor_id.in_(debtor_ids)).\
+        distinct().\
+        all()
+
+    current_ts = datetime.now(tz=timezone.utc)
+    for debtor_id, in sorted(debtor_ids_with_shards):
+        account = _get_account_instance(debtor_id, ROOT_CREDITOR_ID, lock=True)
+        if account:
+            _apply_root_account_shards(account, current_ts)
+
+
+def _add_to_root_account_shard(debtor_id: int, shard_number: int, principal_delta: int, interest_delta: float) -> None:
+    table = RootAccountShard.__table__
+    insert_stmt = insert(table).values(
+        debtor_id=debtor_id,
+        shard_number=shard_number,
+        principal_delta=principal_delta,
+        interest_delta=interest_delta,
+    )
+    db.session.execute(insert_stmt.on_conflict_do_update(
+        index_elements=[table.c.debtor_id, table.c.shard_number],
+        set_={
+            'principal_delta': table.c.principal_delta + insert_stmt.excluded.principal_delta,
+            'interest_delta': table.c.interest_delta + insert_stmt.excluded.interest_delta,
+        },
+    ))
+
+
+def _apply_root_account_shards(account: Account, current_ts: datetime) -> None:
+    # Shards that are being written at the moment are skipped. They
+    # will be applied the next time the account gets locked.
+    shards = _claim_queued_rows(RootAccountShard, RootAccountShard.debtor_id == account.debtor_id)
+    if shards:
+        principal_delta = sum(shard.principal_delta for shard in shards)
+        interest_delta = sum(shard.interest_delta for shard in shards)
+        _apply_account_change(account, principal_delta, interest_delta, current_ts)
+
+
+def _get_root_account_shards_principal_delta(debtor_id: int) -> int:
+    principal_delta = db.session.\
+        query(func.sum(RootAccountShard.principal_delta)).\
+        filter(RootAccountShard.debtor_id == debtor_id).\
+        scalar()
+
+    return int(principal_delta or 0)
+
+
+def enable_account_cache(max_size: int) -> None:
+    """Cache recently locked accounts in the current thread.
+
+    When the same accounts are processed again and again by the
+    current thread, a full-row SELECT is not needed to lock a cached
+    account. Instead, a narrow locking query verifies that the row has
+    not been changed (its `xmin` system column is compared) since the
+    last transaction in which the current thread has locked the
+    account. Note that the cached accounts must be modified only via
+    the ORM instances that have been locked, and not via bulk updates.
+
+    """
+
+    assert max_size > 0
+    _account_cache.max_size = max_size
+    _account_cache.accounts = OrderedDict()
+    _account_cache.locked = []
+    _account_cache.committed = {}
+
+
+def _get_cached_account_instance(debtor_id: int, creditor_id: int) -> Optional[Account]:
+    pk = (debtor_id, creditor_id)
+    if db.session.identity_map.get(identity_key(Account, pk)) is not None:
+        # The account has been locked already in this transaction.
+        return Account.query.filter_by(debtor_id=debtor_id, creditor_id=creditor_id).with_for_update().one_or_none()
+
+    accounts = _account_cache.accounts
+    cache_entry = accounts.get(pk)
+    if cache_entry is not None:
+        xmins, values = cache_entry
+        row = db.session.\
+            query(ACCOUNT_XMIN, CURRENT_XID, Account.last_change_seqnum).\
+            filter_by(debtor_id=debtor_id, creditor_id=creditor_id).\
+            with_for_update().\
+            one_or_none()
+        if row is None:
+            del accounts[pk]
+            return None
+
+        if row.xmin in xmins and row.last_change_seqnum == values['last_change_seqnum']:
+            account = Account(**values)
+            make_transient_to_detached(account)
+            db.session.add(account)
+            accounts.move_to_end(pk)
+            _register_locked_account(account, {row.xmin, row.xid})
+            return account
+
+    row = db.session.\
+        query(Account, ACCOUNT_XMIN, CURRENT_XID).\
+        filter_by(debtor_id=debtor_id, creditor_id=creditor_id).\
+        with_for_update().\
+        one_or_none()
+    if row is None:
+        return None
+
+    account = row[0]
+    _register_locked_account(account, {row.xmin, row.xid})
+    return account
+
+
+def _register_locked_account(account: Account, xmins: Set[int]) -> None:
+    # The column values are captured now, and again after each flush,
+    # because by the time the transaction gets committed, the
+    # instances may have been expunged from the session already.
+    _account_cache.locked.append((account, xmins))
+    _capture_account_values(account, xmins)
+
+
+def _capture_account_values(account: Account, xmins: Set[int]) -> None:
+    state = inspect(account)
+    keys = [attr.key for attr in Account.__mapper__.column_attrs]
+    if all(key in state.dict for key in keys):
+        _account_cache.committed[state.identity] = (xmins, {key: state.dict[key] for key in keys})
+    else:
+        _account_cache.committed.pop(state.identity, None)
+
+
+# NOTE: The listeners are registered on the session class, so that
+# they fire for every session, including the scoped sessions created
+# by `db.create_scoped_session`.
 
-    return query.one_or_none()
+@event.listens_for(SignallingSession, 'after_flush')
+def _capture_locked_accounts(session, flush_context) -> None:
+    # After the flush, the row of each locked account will have either
+    # the same `xmin` as when it was locked (the account has not been
+    # changed), or the ID of the current transaction.
+    locked = getattr(_account_cache, 'locked', None)
+    if locked:
+        for account, xmins in locked:
+            if inspect(account).session_id == session.hash_key:
+                _capture_account_values(account, xmins)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _update_account_cache(session) -> None:
+    committed = getattr(_account_cache, 'committed', None)
+    if not committed:
+        return
+
+    accounts = _account_cache.accounts
+    for pk, (xmins, values) in committed.items():
+        accounts[pk] = (xmins, values)
+        accounts.move_to_end(pk)
+
+    while len(accounts) > _account_cache.max_size:
+        accounts.popitem(last=False)
+
+    committed.clear()
+
+
+@event.listens_for(SignallingSession, 'after_transaction_end')
+def _forget_locked_accounts(session, transaction) -> None:
+    if (transaction.parent is None or transaction.nested) and getattr(_account_cache, 'accounts', None) is not None:
+        _account_cache.locked.clear()
+        _account_cache.committed.clear()
 
 
 def _lock_or_create_account(debtor_id: int, creditor_id: int, current_ts: datetime) -> Account:
@@ -634,23 +1176,95 @@ def _lock_or_create_account(debtor_id: int, creditor_id: int, current_ts: dateti
         account = _create_account(debtor_id, creditor_id, current_ts)
         _insert_account_update_signal(account, current_ts)
 
+    _revive_deleted_account(account, current_ts)
+    return account
+
+
+def _revive_deleted_account(account: Account, current_ts: datetime) -> None:
     if account.status_flags & Account.STATUS_DELETED_FLAG:
         account.status_flags &= ~Account.STATUS_DELETED_FLAG
         account.last_change_seqnum = increment_seqnum(account.last_change_seqnum)
         account.last_change_ts = max(account.last_change_ts, current_ts)
         _insert_account_update_signal(account, current_ts)
 
-    return account
+
+def _apply_pending_balance_changes(account: Account, changes: list, current_ts: datetime) -> None:
+    principal_delta, interest_delta = _process_pending_balance_changes(account, changes, current_ts)
+    _apply_account_change(account, principal_delta, interest_delta, current_ts)
+
+
+def _process_pending_balance_changes(account: Account, changes: list, current_ts: datetime) -> Tuple[int, float]:
+    # Inserts the account transfer signals for the given balance
+    # changes, but does not change the account. Returns the principal
+    # delta and the interest delta that should be applied.
+    applied_change_pks = []
+    principal_delta = 0
+
+    # We should compensate for the fact that the transfers were
+    # committed at `change.committed_at`, but the transferred amounts
+    # are being added to the account's principal just now
+    # (`current_ts`).
+    interest_delta = account.calc_total_due_interest(
+        [(change.principal_delta, change.committed_at) for change in changes],
+        current_ts,
+    )
+
+    for change in changes:
+        principal_delta += change.principal_delta
+
+        _insert_account_transfer_signal(
+            account=account,
+            coordinator_type=change.coordinator_type,
+            other_creditor_id=change.other_creditor_id,
+            committed_at=change.committed_at,
+            acquired_amount=change.principal_delta,
+            transfer_note_format=change.transfer_note_format,
+            transfer_note=change.transfer_note,
+            principal=contain_principal_overflow(account.principal + principal_delta),
+        )
+
+        applied_change_pks.append((change.debtor_id, change.other_creditor_id, change.change_id))
+
+    RegisteredBalanceChange.query.\
+        filter(REGISTERED_BALANCE_CHANGE_PK.in_(applied_change_pks)).\
+        update({RegisteredBalanceChange.is_applied: True}, synchronize_session=False)
+
+    return principal_delta, interest_delta
+
+
+def _write_back_accounts(accounts: List[Account]) -> None:
+    # Writes all the columns of the given (locked) accounts with a
+    # single UPDATE statement. Then the instances are marked as
+    # unmodified, so that the ORM would not update them again.
+    if not accounts:
+        return
+
+    table = Account.__table__
+    columns = list(table.columns)
+    values = union_all(*[
+        select([cast(literal(getattr(account, c.key), c.type), c.type).label(c.key) for c in columns])
+        for account in accounts
+    ]).subquery('v')
+
+    db.session.execute(
+        table.update().
+        where(and_(*[c == values.c[c.key] for c in table.primary_key.columns])).
+        values({c.key: values.c[c.key] for c in columns if not c.primary_key})
+    )
+
+    for account in accounts:
+        for c in columns:
+            set_committed_value(account, c.key, getattr(account, c.key))
 
 
 def _get_available_amount(account: Account, current_ts: datetime) -> int:
-    current_balance = math.floor(account.calc_current_balance(current_ts))
+    current_balance = account.floor_current_balance(current_ts)
 
     return contain_principal_overflow(current_balance - account.total_locked_amount)
 
 
 def _calc_account_accumulated_interest(account: Account, current_ts: datetime) -> Decimal:
-    return account.calc_current_balance(current_ts) - account.principal
+    return EXACT_DECIMAL_CONTEXT.subtract(account.calc_current_balance(current_ts), account.principal)
 
 
 def _insert_account_transfer_signal(
@@ -758,7 +1372,8 @@ def _process_transfer_request(
         tr: TransferRequest,
         sender_account: Optional[Account],
         current_ts: datetime,
-        commit_period: int) -> Union[RejectedTransferSignal, PreparedTransferSignal]:
+        commit_period: int,
+        is_reachable: bool = True) -> Union[RejectedTransferSignal, PreparedTransferSignal]:
 
     def reject(status_code: str, total_locked_amount: int) -> RejectedTransferSignal:
         assert total_locked_amount >= 0
@@ -824,14 +1439,15 @@ def _process_transfer_request(
             inserted_at=current_ts,
         )
 
-    db.session.delete(tr)
-
     if sender_account is None:
         return reject(SC_SENDER_IS_UNREACHABLE, 0)
 
     assert sender_account.debtor_id == tr.debtor_id
     assert sender_account.creditor_id == tr.sender_creditor_id
 
+    if not is_reachable:
+        return reject(SC_RECIPIENT_IS_UNREACHABLE, sender_account.total_locked_amount)
+
     if sender_account.pending_transfers_count >= MAX_INT32:
         return reject(SC_TOO_MANY_TRANSFERS, sender_account.total_locked_amount)
 
@@ -857,12 +1473,124 @@ def _process_transfer_request(
     return prepare(expendable_amount)
 
 
+def _claim_transfer_requests(
+        debtor_id: int,
+        creditor_id: int,
+        recipients_reachability: Optional[Dict[int, bool]]) -> list:
+
+    criteria = [TransferRequest.debtor_id == debtor_id, TransferRequest.sender_creditor_id == creditor_id]
+
+    if recipients_reachability is not None:
+        if not recipients_reachability:
+            return []
+        criteria.append(TransferRequest.recipient_creditor_id.in_(list(recipients_reachability)))
+
+    return _claim_queued_rows(TransferRequest, *criteria)
+
+
+def _process_transfer_requests(
+        transfer_requests: list,
+        sender_account: Optional[Account],
+        current_ts: datetime,
+        commit_period: int,
+        recipients_reachability: Optional[Dict[int, bool]]) -> None:
+
+    rejected_transfer_signals = []
+    prepared_transfer_signals = []
+
+    for tr in transfer_requests:
+        is_reachable = recipients_reachability is None or recipients_reachability[tr.recipient_creditor_id]
+        signal = _process_transfer_request(tr, sender_account, current_ts, commit_period, is_reachable)
+
+        if isinstance(signal, RejectedTransferSignal):
+            rejected_transfer_signals.append(signal)
+        elif isinstance(signal, PreparedTransferSignal):
+            prepared_transfer_signals.append(signal)
+        else:  # pragma: nocover
+            raise RuntimeError('unexpected return type')
+
+    bulk_save_signals(rejected_transfer_signals)
+    bulk_save_signals(prepared_transfer_signals)
+
+
+def _process_finalization_requests(
+        debtor_id: int,
+        sender_creditor_id: int,
+        finalization_requests: list,
+        sender_account: Optional[Account],
+        current_ts: datetime,
+        pending_principal_delta: int = 0,
+        pending_interest_delta: float = 0.0) -> int:
+
+    # Finalizes the prepared transfers, but does not change the
+    # account's principal. Returns the principal delta that should be
+    # applied. The `pending_principal_delta` and the
+    # `pending_interest_delta` have not been applied to the account
+    # yet, but must be taken into account.
+    principal_delta = 0
+    pending_balance_change_signals = []
+    requests = _get_finalization_requests_prepared_transfers(debtor_id, sender_creditor_id, finalization_requests)
+    deleted_transfer_ids = []
+
+    if sender_account:
+        if pending_principal_delta == 0 and pending_interest_delta == 0.0:
+            starting_balance = sender_account.floor_current_balance(current_ts)
+        else:
+            # Calculates the balance exactly as it would be calculated
+            # after `_apply_account_change` has applied the deltas.
+            starting_balance = floor_current_balance(
+                creditor_id=sender_creditor_id,
+                principal=contain_principal_overflow(sender_account.principal + pending_principal_delta),
+                interest=float(_calc_account_accumulated_interest(sender_account, current_ts)) + pending_interest_delta,
+                interest_rate=sender_account.interest_rate,
+                last_change_ts=max(sender_account.last_change_ts, current_ts),
+                current_ts=current_ts,
+            )
+        min_account_balance = _get_min_account_balance(sender_creditor_id)
+
+    for finalization_request, prepared_transfer in requests:
+        if sender_account and prepared_transfer:
+            expendable_amount = (
+                + starting_balance
+                + principal_delta
+                - sender_account.total_locked_amount
+                - min_account_balance
+            )
+            signal = _finalize_prepared_transfer(
+                prepared_transfer,
+                finalization_request,
+                sender_account,
+                expendable_amount,
+                current_ts,
+                pending_principal_delta,
+            )
+            if signal:
+                committed_amount = signal.principal_delta
+                assert committed_amount > 0
+                pending_balance_change_signals.append(signal)
+            else:
+                committed_amount = 0
+
+            principal_delta -= committed_amount
+            deleted_transfer_ids.append(prepared_transfer.transfer_id)
+
+    if deleted_transfer_ids:
+        PreparedTransfer.query.\
+            filter_by(debtor_id=debtor_id, sender_creditor_id=sender_creditor_id).\
+            filter(PreparedTransfer.transfer_id.in_(deleted_transfer_ids)).\
+            delete(synchronize_session=False)
+
+    bulk_save_signals(pending_balance_change_signals)
+    return principal_delta
+
+
 def _finalize_prepared_transfer(
         pt: PreparedTransfer,
         fr: FinalizationRequest,
         sender_account: Account,
         expendable_amount: int,
-        current_ts: datetime) -> Optional[PendingBalanceChangeSignal]:
+        current_ts: datetime,
+        pending_principal_delta: int = 0) -> Optional[PendingBalanceChangeSignal]:
 
     sender_account.total_locked_amount = max(0, sender_account.total_locked_amount - pt.locked_amount)
     sender_account.pending_transfers_count = max(0, sender_account.pending_transfers_count - 1)
@@ -893,7 +1621,7 @@ def _finalize_prepared_transfer(
             acquired_amount=-committed_amount,
             transfer_note_format=fr.transfer_note_format,
             transfer_note=fr.transfer_note,
-            principal=contain_principal_overflow(sender_account.principal - committed_amount),
+            principal=contain_principal_overflow(sender_account.principal + pending_principal_delta - committed_amount),
         )
 
         return PendingBalanceChangeSignal(
@@ -911,5 +1639,106 @@ def _finalize_prepared_transfer(
     return None
 
 
+def _in_bucket(debtor_id_column, creditor_id_column, bucket: int, buckets_count: int):
+    # Does the same as `is_in_bucket`, but in SQL. Note that the
+    # result of the "%" operator in SQL has the sign of the dividend.
+    assert 0 <= bucket < buckets_count
+    if buckets_count == 1:
+        return true()
+
+    n = buckets_count
+    return (debtor_id_column.op('#')(creditor_id_column) % n + n) % n == bucket
+
+
+def _stream_query_results(query, max_count: Optional[int]) -> Iterator:
+    # Pages through the results, ordered by all of their columns
+    # (keyset pagination), so that the processing can start before
+    # all the results have arrived. Each page is fetched in its own
+    # short transaction, so that no transaction is kept open while
+    # the results are being processed, which would prevent the
+    # vacuuming of the (heavily updated) queue tables. The rows are
+    # yielded as plain tuples, so that they can be pickled.
+    subquery = query.subquery()
+    last_row = None
+    remaining_count = max_count
+
+    while remaining_count is None or remaining_count > 0:
+        page_size = STREAM_QUERY_BATCH_SIZE
+        if remaining_count is not None:
+            page_size = min(page_size, remaining_count)
+        rows = _fetch_query_page(subquery, last_row, page_size)
+        yield from rows
+
+        if len(rows) < page_size:
+            break
+
+        last_row = rows[-1]
+        if remaining_count is not None:
+            remaining_count -= len(rows)
+
+
+@atomic
+def _fetch_query_page(subquery, last_row: Optional[tuple], page_size: int) -> List[tuple]:
+    columns = list(subquery.c)
+    query = db.session.query(subquery)
+    if last_row is not None:
+        query = query.filter(tuple_(*columns) > tuple_(*last_row))
+
+    return [tuple(row) for row in query.order_by(*columns).limit(page_size).all()]
+
+
+def _claim_queued_rows(model, *criteria) -> list:
+    # Deletes the queued rows that match the given criteria, and are
+    # not locked by another transaction, with a single statement.
+    # Returns the deleted rows, ordered by primary key.
+    table = model.__table__
+    pk_columns = list(table.primary_key.columns)
+    claimed_pks = select(pk_columns).where(and_(*criteria)).with_for_update(skip_locked=True)
+
+    db.session.flush()
+    rows = db.session.execute(
+        table.delete().
+        where(tuple_(*pk_columns).in_(claimed_pks)).
+        returning(*table.columns)
+    ).fetchall()
+
+    return sorted(rows, key=lambda row: tuple(row[c.name] for c in pk_columns))
+
+
+def _get_finalization_requests_prepared_transfers(
+        debtor_id: int,
+        sender_creditor_id: int,
+        finalization_requests: list) -> List[Tuple[object, Optional[PreparedTransfer]]]:
+
+    # Returns (finalization request, prepared transfer) pairs. The
+    # prepared transfer is `None` if there is no prepared transfer
+    # that matches the finalization request.
+    prepared_transfers = PreparedTransfer.query.\
+        filter_by(debtor_id=debtor_id, sender_creditor_id=sender_creditor_id).\
+        filter(PreparedTransfer.transfer_id.in_([fr.transfer_id for fr in finalization_requests])).\
+        all()
+    prepared_transfers_by_id = {pt.transfer_id: pt for pt in prepared_transfers}
+
+    def get_prepared_transfer(fr) -> Optional[PreparedTransfer]:
+        pt = prepared_transfers_by_id.get(fr.transfer_id)
+        if pt and (
+                pt.coordinator_type == fr.coordinator_type
+                and pt.coordinator_id == fr.coordinator_id
+                and pt.coordinator_request_id == fr.coordinator_request_id):
+            return pt
+
+        return None
+
+    return [(fr, get_prepared_transfer(fr)) for fr in finalization_requests]
+
+
+def _call_stored_procedure(stored_procedure_call) -> None:
+    # The stored procedure must see the changes made in the current
+    # session, and the session must not use stale objects after that.
+    db.session.flush()
+    db.session.execute(stored_procedure_call.select())
+    db.session.expire_all()
+
+
 def _get_min_account_balance(creditor_id: int) -> int:
     return 0 if creditor_id != ROOT_CREDITOR_ID else -MAX_INT64
@@ -1,11 +1,14 @@
-from flask import Blueprint
+from flask import Blueprint, request, jsonify, abort
 from swpt_accounts import procedures
+from swpt_accounts.models import MIN_INT64, MAX_INT64
 
 HTTP_HEADERS = {
     'Content-Type': 'text/plain; charset=utf-8',
     'Cache-Control': 'max-age=86400',
 }
 
+MAX_REACHABLE_CREDITOR_IDS = 1000
+
 fetch_api = Blueprint('fetch', __name__, url_prefix='/accounts')
 
 
@@ -16,6 +19,18 @@ def reachable(debtorId, creditorId):
     return '', status_code, HTTP_HEADERS
 
 
+@fetch_api.route('/<i64:debtorId>/reachable', methods=['POST'])
+def reachable_many(debtorId):
+    data = request.get_json(silent=True)
+    creditor_ids = data.get('creditorIds') if isinstance(data, dict) else None
+    if not (isinstance(creditor_ids, list) and len(creditor_ids) <= MAX_REACHABLE_CREDITOR_IDS and all(
+            type(x) is int and MIN_INT64 <= x <= MAX_INT64 for x in creditor_ids)):
+        abort(400)
+
+    reachable_creditor_ids = procedures.get_reachable_creditor_ids(debtorId, creditor_ids)
+    return jsonify(reachableCreditorIds=sorted(reachable_creditor_ids))
+
+
 @fetch_api.route('/<i64:debtorId>/<i64:creditorId>/config')
 def config(debtorId, creditorId):
     config_data = procedures.get_account_config_data(debtorId, creditorId)
@@ -3,12 +3,14 @@ from base64 import b16encode
 from typing import TypeVar, Callable
 from datetime import datetime, timedelta, timezone
 from swpt_lib.scan_table import TableScanner
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql.expression import true, tuple_, or_
 from flask import current_app
 from swpt_accounts.extensions import db
-from swpt_accounts.models import Account, AccountUpdateSignal, AccountPurgeSignal, PreparedTransfer, \
-    PreparedTransferSignal, RegisteredBalanceChange, ROOT_CREDITOR_ID, calc_current_balance, \
-    is_negligible_balance, contain_principal_overflow
+from swpt_accounts import procedures
+from swpt_accounts.models import Account, AccountConfig, AccountUpdateSignal, AccountPurgeSignal, PreparedTransfer, \
+    PreparedTransferSignal, RegisteredBalanceChange, ROOT_CREDITOR_ID, MAX_INT64, calc_current_balance, \
+    calc_approx_current_balances, is_negligible_balance, contain_principal_overflow, bulk_insert_signals
 from swpt_accounts.fetch_api_client import get_root_config_data_dict
 from swpt_accounts.chores import change_interest_rate, update_debtor_info, capitalize_interest, try_to_delete_account
 
@@ -57,6 +59,7 @@ class AccountScanner(TableScanner):
     def process_rows(self, rows):
         current_ts = datetime.now(tz=timezone.utc)
         self._purge_accounts(rows, current_ts)
+        self._apply_root_account_shards(rows, current_ts)
         self._send_heartbeats(rows, current_ts)
         self._delete_accounts(rows, current_ts)
         self._capitalize_interests(rows, current_ts)
@@ -93,7 +96,7 @@ class AccountScanner(TableScanner):
                     filter(self.pk.in_(pks_to_purge)).\
                     delete(synchronize_session=False)
 
-                db.session.bulk_insert_mappings(AccountPurgeSignal, [
+                bulk_insert_signals(AccountPurgeSignal, [
                     dict(
                         debtor_id=debtor_id,
                         creditor_id=creditor_id,
@@ -102,6 +105,21 @@ class AccountScanner(TableScanner):
                     for debtor_id, creditor_id, creation_date in to_purge
                 ])
 
+    def _apply_root_account_shards(self, rows, current_ts):
+        c = self.table.c
+        deleted_flag = Account.STATUS_DELETED_FLAG
+
+        # Applying the shards sets the `pending_account_update` flag,
+        # so that an `AccountUpdateSignal` will be sent for the
+        # debtor's account the next time it is scanned.
+        debtor_ids = [row[c.debtor_id] for row in rows if (
+            row[c.creditor_id] == ROOT_CREDITOR_ID
+            and not row[c.status_flags] & deleted_flag)
+        ]
+
+        if debtor_ids:
+            procedures.apply_root_account_shards(debtor_ids)
+
     def _send_heartbeats(self, rows, current_ts):
         c = self.table.c
         deleted_flag = Account.STATUS_DELETED_FLAG
@@ -120,6 +138,7 @@ class AccountScanner(TableScanner):
                     Account.last_heartbeat_ts < heartbeat_cutoff_ts,
                     Account.pending_account_update == true(),
                 )).\
+                options(selectinload(Account.config)).\
                 with_for_update().\
                 all()
 
@@ -132,7 +151,7 @@ class AccountScanner(TableScanner):
                         Account.pending_account_update: False,
                     }, synchronize_session=False)
 
-                db.session.bulk_insert_mappings(AccountUpdateSignal, [
+                bulk_insert_signals(AccountUpdateSignal, [
                     dict(
                         debtor_id=account.debtor_id,
                         creditor_id=account.creditor_id,
@@ -174,14 +193,28 @@ class AccountScanner(TableScanner):
         deleted_flag = Account.STATUS_DELETED_FLAG
         cutoff_ts = current_ts - self.deletion_attempts_min_interval
 
-        for row in rows:
+        rows = [row for row in rows if (
+            row[c_creditor_id] != ROOT_CREDITOR_ID
+            and row[c_last_deletion_attempt_ts] <= cutoff_ts
+            and row[c_config_flags] & scheduled_for_deletion_flag
+            and not row[c_status_flags] & deleted_flag
+        )]
+        approx_balances = calc_approx_current_balances(
+            [(row[c_creditor_id], row[c_principal], row[c_interest], row[c_interest_rate], row[c_last_change_ts])
+             for row in rows],
+            current_ts,
+        )
+
+        for row, (approx_balance, max_error) in zip(rows, approx_balances):
             creditor_id = row[c_creditor_id]
-            should_be_deleted = (
-                creditor_id != ROOT_CREDITOR_ID
-                and row[c_last_deletion_attempt_ts] <= cutoff_ts
-                and row[c_config_flags] & scheduled_for_deletion_flag
-                and not row[c_status_flags] & deleted_flag
-                and is_negligible_balance(
+            threshold = max(row[c_negligible_amount], 2.0)
+
+            if approx_balance + max_error < threshold:
+                should_be_deleted = True
+            elif approx_balance - max_error > threshold:
+                should_be_deleted = False
+            else:
+                should_be_deleted = is_negligible_balance(
                     calc_current_balance(
                         creditor_id=creditor_id,
                         principal=row[c_principal],
@@ -192,7 +225,7 @@ class AccountScanner(TableScanner):
                     ),
                     row[c_negligible_amount],
                 )
-            )
+
             if should_be_deleted:
                 try_to_delete_account.send(row[c_debtor_id], creditor_id)
 
@@ -210,27 +243,46 @@ class AccountScanner(TableScanner):
         cutoff_ts = current_ts - self.min_interest_cap_interval
         max_ratio = self.max_interest_to_principal_ratio
 
-        for row in rows:
+        rows = [row for row in rows if (
+            row[c_creditor_id] != ROOT_CREDITOR_ID
+            and row[c_last_interest_capitalization_ts] <= cutoff_ts
+            and not row[c_status_flags] & deleted_flag
+        )]
+        approx_balances = calc_approx_current_balances(
+            [(row[c_creditor_id], row[c_principal], row[c_interest], row[c_interest_rate], row[c_last_change_ts])
+             for row in rows],
+            current_ts,
+        )
+
+        for row, (approx_balance, max_error) in zip(rows, approx_balances):
             creditor_id = row[c_creditor_id]
-            can_capitalize_interest = (
-                creditor_id != ROOT_CREDITOR_ID
-                and row[c_last_interest_capitalization_ts] <= cutoff_ts
-                and not row[c_status_flags] & deleted_flag
-            )
-            if can_capitalize_interest:
+            principal = row[c_principal]
+            denominator = 1 + abs(principal)
+            approx_accumulated_interest = abs(approx_balance - principal)
+
+            # The floor in the exact calculation may change the
+            # accumulated interest by up to 1.
+            margin = (max_error + 1.0) / denominator
+            approx_ratio = approx_accumulated_interest / denominator
+
+            if approx_accumulated_interest < MAX_INT64 and approx_ratio > max_ratio + margin:
+                should_capitalize_interest = True
+            elif approx_ratio < max_ratio - margin:
+                should_capitalize_interest = False
+            else:
                 current_balance = calc_current_balance(
                     creditor_id=creditor_id,
-                    principal=row[c_principal],
+                    principal=principal,
                     interest=row[c_interest],
                     interest_rate=row[c_interest_rate],
                     last_change_ts=row[c_last_change_ts],
                     current_ts=current_ts,
                 )
-                accumulated_interest = abs(contain_principal_overflow(math.floor(current_balance - row[c_principal])))
-                ratio = accumulated_interest / (1 + abs(row[c_principal]))
+                accumulated_interest = abs(contain_principal_overflow(math.floor(current_balance - principal)))
+                should_capitalize_interest = accumulated_interest / denominator > max_ratio
 
-                if ratio > max_ratio:
-                    capitalize_interest.send(row[c_debtor_id], creditor_id)
+            if should_capitalize_interest:
+                capitalize_interest.send(row[c_debtor_id], creditor_id)
 
     def _change_debtor_settings(self, rows, current_ts):
         c = self.table.c
@@ -239,9 +291,6 @@ class AccountScanner(TableScanner):
         c_last_interest_rate_change_ts = c.last_interest_rate_change_ts
         c_status_flags = c.status_flags
         c_interest_rate = c.interest_rate
-        c_debtor_info_iri = c.debtor_info_iri
-        c_debtor_info_content_type = c.debtor_info_content_type
-        c_debtor_info_sha256 = c.debtor_info_sha256
         deleted_flag = Account.STATUS_DELETED_FLAG
         interest_rate_change_cutoff_ts = current_ts - self.interest_rate_change_min_interval
 
@@ -249,46 +298,52 @@ class AccountScanner(TableScanner):
             return (
                 row[c_interest_rate] != current_interest_rate
                 and row[c_last_interest_rate_change_ts] <= interest_rate_change_cutoff_ts
-                and not row[c_status_flags] & deleted_flag
-            )
-
-        def should_update_debtor_info(row, debtor_info_iri, debtor_info_content_type, debtor_info_sha256):
-            return (
-                not row[c_status_flags] & deleted_flag
-                and (
-                    row[c_debtor_info_iri] != debtor_info_iri
-                    or row[c_debtor_info_content_type] != debtor_info_content_type
-                    or row[c_debtor_info_sha256] != debtor_info_sha256
-                )
             )
 
         debtor_ids = {row[c_debtor_id] for row in rows}
         config_data_dict = get_root_config_data_dict(debtor_ids)
+        rows = [row for row in rows if (
+            row[c_creditor_id] != ROOT_CREDITOR_ID
+            and not row[c_status_flags] & deleted_flag
+            and config_data_dict.get(row[c_debtor_id])
+        )]
 
-        for row in rows:
-            creditor_id = row[c_creditor_id]
-            if creditor_id == ROOT_CREDITOR_ID:
-                continue
-
-            debtor_id = row[c_debtor_id]
-            config_data = config_data_dict.get(debtor_id)
-            if config_data:
-                interest_rate = config_data.interest_rate_target
-                if should_change_interest_rate(row, interest_rate):
-                    change_interest_rate.send(debtor_id, creditor_id, interest_rate, current_ts.isoformat())
-
-                debtor_info_iri = config_data.info_iri
-                debtor_info_content_type = config_data.info_content_type
-                debtor_info_sha256 = config_data.info_sha256
-                if should_update_debtor_info(row, debtor_info_iri, debtor_info_content_type, debtor_info_sha256):
-                    update_debtor_info.send(
-                        debtor_id,
-                        creditor_id,
-                        debtor_info_iri,
-                        debtor_info_content_type,
-                        debtor_info_sha256 and b16encode(debtor_info_sha256).decode(),
-                        current_ts.isoformat(),
-                    )
+        # The debtor info is stored in the `account_config` table. A
+        # missing `account_config` row means that the account has no
+        # debtor info.
+        pks = [(row[c_debtor_id], row[c_creditor_id]) for row in rows]
+        no_debtor_info = (None, None, None)
+        debtor_info_dict = {} if not pks else {
+            (r.debtor_id, r.creditor_id): (r.debtor_info_iri, r.debtor_info_content_type, r.debtor_info_sha256)
+            for r in db.session.query(
+                AccountConfig.debtor_id,
+                AccountConfig.creditor_id,
+                AccountConfig.debtor_info_iri,
+                AccountConfig.debtor_info_content_type,
+                AccountConfig.debtor_info_sha256,
+            ).filter(tuple_(AccountConfig.debtor_id, AccountConfig.creditor_id).in_(pks)).all()
+        }
+
+        for row, pk in zip(rows, pks):
+            debtor_id, creditor_id = pk
+            config_data = config_data_dict[debtor_id]
+            interest_rate = config_data.interest_rate_target
+            if should_change_interest_rate(row, interest_rate):
+                change_interest_rate.send(debtor_id, creditor_id, interest_rate, current_ts.isoformat())
+
+            debtor_info_iri = config_data.info_iri
+            debtor_info_content_type = config_data.info_content_type
+            debtor_info_sha256 = config_data.info_sha256
+            debtor_info = (debtor_info_iri, debtor_info_content_type, debtor_info_sha256)
+            if debtor_info_dict.get(pk, no_debtor_info) != debtor_info:
+                update_debtor_info.send(
+                    debtor_id,
+                    creditor_id,
+                    debtor_info_iri,
+                    debtor_info_content_type,
+                    debtor_info_sha256 and b16encode(debtor_info_sha256).decode(),
+                    current_ts.isoformat(),
+                )
 
 
 class PreparedTransferScanner(TableScanner):
@@ -359,7 +414,7 @@ class PreparedTransferScanner(TableScanner):
                     PreparedTransfer.last_reminder_ts: current_ts,
                 }, synchronize_session=False)
 
-            db.session.bulk_insert_mappings(PreparedTransferSignal, prepared_transfer_signal_mappings.values())
+            bulk_insert_signals(PreparedTransferSignal, prepared_transfer_signal_mappings.values())
 
 
 class RegisteredBalanceChangeScanner(TableScanner):
@@ -99,3 +99,150 @@ def test_on_pending_balance_change_signal(db_session, actors):
         principal_delta=1000,
         other_creditor_id=123,
     )
+
+
+def test_process_message_batch(db_session, actors):
+    import dramatiq
+    from swpt_accounts.models import FinalizationRequest, PendingBalanceChange, Account
+
+    def message(actor_name, **kwargs):
+        return dramatiq.Message(queue_name='test', actor_name=actor_name, args=(), kwargs=kwargs, options={})
+
+    ts = datetime.now(tz=timezone.utc).isoformat()
+    finalization_request = dict(
+        debtor_id=D_ID,
+        creditor_id=C_ID,
+        transfer_id=666,
+        coordinator_type='test',
+        coordinator_id=1,
+        coordinator_request_id=2,
+        committed_amount=100,
+        transfer_note_format='',
+        transfer_note='',
+        ts=ts,
+    )
+    results = actors.process_message_batch([
+        message('configure_account', debtor_id=D_ID, creditor_id=C_ID, ts=ts, seqnum=0),
+        message('finalize_transfer', **finalization_request),
+        message('finalize_transfer', **finalization_request),
+        message(
+            'on_pending_balance_change_signal',
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            change_id=1,
+            coordinator_type='direct',
+            transfer_note_format='',
+            transfer_note='',
+            committed_at=ts,
+            principal_delta=1000,
+            other_creditor_id=123,
+        ),
+    ])
+    assert results == [True, True, True, True]
+    assert len(Account.query.all()) == 1
+    assert len(FinalizationRequest.query.all()) == 1
+    assert len(PendingBalanceChange.query.all()) == 1
+
+    results = actors.process_message_batch([
+        message('configure_account', debtor_id=D_ID, creditor_id=C_ID, ts=ts, seqnum=1),
+        message('unknown_actor'),
+        message('prepare_transfer', debtor_id=D_ID),
+    ])
+    assert results == [True, False, False]
+    assert Account.query.one().last_config_seqnum == 1
+
+
+def test_process_message_batch_database_error(db_session, actors, monkeypatch):
+    import dramatiq
+    from sqlalchemy.exc import OperationalError
+    from swpt_accounts.models import Account
+
+    def finalize_transfer(*args, **kwargs):
+        raise OperationalError('SELECT 1', {}, Exception('connection lost'))
+
+    def message(actor_name, **kwargs):
+        return dramatiq.Message(queue_name='test', actor_name=actor_name, args=(), kwargs=kwargs, options={})
+
+    monkeypatch.setattr(p, 'finalize_transfer', finalize_transfer)
+    ts = datetime.now(tz=timezone.utc).isoformat()
+    results = actors.process_message_batch([
+        message('configure_account', debtor_id=D_ID, creditor_id=C_ID, ts=ts, seqnum=0),
+        message(
+            'finalize_transfer',
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            transfer_id=666,
+            coordinator_type='test',
+            coordinator_id=1,
+            coordinator_request_id=2,
+            committed_amount=100,
+            transfer_note_format='',
+            transfer_note='',
+            ts=ts,
+        ),
+        message('unknown_actor'),
+    ])
+    assert results == [True, None, False]
+    assert len(Account.query.all()) == 1
+
+
+def test_process_message_batch_coalesce_configs(db_session, actors):
+    import dramatiq
+    from swpt_accounts.models import Account, AccountUpdateSignal, RejectedConfigSignal
+
+    def configure_account(seqnum, negligible_amount):
+        return dramatiq.Message(queue_name='test', actor_name='configure_account', args=(), kwargs=dict(
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            ts=ts,
+            seqnum=seqnum,
+            negligible_amount=negligible_amount,
+            config_flags=0,
+            config_data='',
+        ), options={})
+
+    ts = datetime.now(tz=timezone.utc).isoformat()
+    results = actors.process_message_batch([
+        configure_account(1, 10.0),
+        configure_account(3, 30.0),
+        configure_account(2, 20.0),
+        configure_account(3, 40.0),
+        configure_account(5, -1.0),
+        configure_account(4, -2.0),
+    ])
+    assert results == [True, True, True, True, True, True]
+    account = Account.query.one()
+    assert account.last_config_seqnum == 3
+    assert account.negligible_amount == 30.0
+    assert len(AccountUpdateSignal.query.all()) == 1
+    rejections = RejectedConfigSignal.query.order_by(RejectedConfigSignal.config_seqnum).all()
+    assert [(r.config_seqnum, r.negligible_amount) for r in rejections] == [(4, -2.0), (5, -1.0)]
+
+
+def test_process_message_batch_initialization_error(db_session, actors, monkeypatch):
+    import dramatiq
+    from swpt_accounts.models import Account
+    from swpt_accounts.schemas import RootConfigData
+
+    change_interest_rate = p.change_interest_rate
+
+    def change_interest_rate_or_fail(*, debtor_id, creditor_id, **kwargs):
+        if creditor_id == C_ID:
+            raise RuntimeError('failed initialization')
+        change_interest_rate(debtor_id=debtor_id, creditor_id=creditor_id, **kwargs)
+
+    def configure_account(creditor_id):
+        return dramatiq.Message(queue_name='test', actor_name='configure_account', args=(), kwargs=dict(
+            debtor_id=D_ID,
+            creditor_id=creditor_id,
+            ts=datetime.now(tz=timezone.utc).isoformat(),
+            seqnum=0,
+        ), options={})
+
+    monkeypatch.setattr(actors, 'get_root_config_data_dict', lambda debtor_ids: {
+        debtor_id: RootConfigData(2.0) for debtor_id in debtor_ids})
+    monkeypatch.setattr(p, 'change_interest_rate', change_interest_rate_or_fail)
+    results = actors.process_message_batch([configure_account(C_ID), configure_account(C_ID + 1)])
+    assert results == [True, True]
+    assert Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID).one().interest_rate == 0.0
+    assert Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID + 1).one().interest_rate == 2.0
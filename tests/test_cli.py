@@ -1,8 +1,13 @@
+import time
+import threading
 from datetime import datetime, timezone
 from sqlalchemy.sql.expression import true
 from swpt_accounts import procedures as p
+from swpt_accounts.extensions import db
+from swpt_accounts.cli import ThreadPoolProcessor, ProcessPoolProcessor, BatchConsumer
 from swpt_accounts.models import RejectedTransferSignal, TransferRequest, FinalizationRequest, \
-    FinalizedTransferSignal, PreparedTransfer, PendingBalanceChangeSignal, RegisteredBalanceChange
+    FinalizedTransferSignal, PreparedTransfer, PendingBalanceChangeSignal, RegisteredBalanceChange, \
+    AccountUpdateSignal
 
 
 def _flush_balance_change_signals():
@@ -39,6 +44,21 @@ def test_process_transfers_pending_balance_changes(app, db_session):
     assert RegisteredBalanceChange.query.filter(RegisteredBalanceChange.is_applied == true()).all()
 
 
+def test_process_transfers_pending_balance_changes_in_chunks(app, db_session):
+    p.make_debtor_payment('test', D_ID, C_ID, 1000)
+    p.make_debtor_payment('test', D_ID, C_ID + 1, 2000)
+    _flush_balance_change_signals()
+    _flush_balance_change_signals()
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=[
+        'swpt_accounts', 'process_balance_changes', '--quit-early', '--wait=0', '--chunk-size=2'])
+    assert result.exit_code == 0
+    assert not result.output
+    assert p.get_available_amount(D_ID, p.ROOT_CREDITOR_ID) == -3000
+    assert p.get_available_amount(D_ID, C_ID) == 1000
+    assert p.get_available_amount(D_ID, C_ID + 1) == 2000
+
+
 def test_process_transfers_transfer_requests(app, db_session):
     current_ts = datetime.now(tz=timezone.utc)
     p.configure_account(D_ID, 1234, current_ts, 0)
@@ -86,3 +106,227 @@ def test_process_transfers_finalization_requests(app, db_session):
     assert not result.output
     assert len(FinalizedTransferSignal.query.all()) == 1
     assert len(FinalizationRequest.query.all()) == 0
+
+
+def test_process_requests(app, db_session):
+    current_ts = datetime.now(tz=timezone.utc)
+    p.configure_account(D_ID, 1234, current_ts, 0)
+    p.make_debtor_payment('test', D_ID, C_ID, 1000)
+    _flush_balance_change_signals()
+    p.prepare_transfer('test', 1, 2, 1, 200, D_ID, C_ID, 1234, current_ts)
+    assert len(TransferRequest.query.all()) == 1
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['swpt_accounts', 'process_requests', '--quit-early', '--wait=0'])
+    assert result.exit_code == 0
+    assert not result.output
+    assert p.get_available_amount(D_ID, p.ROOT_CREDITOR_ID) == -1000
+    assert p.get_available_amount(D_ID, C_ID) == 800
+    assert len(PreparedTransfer.query.all()) == 1
+    assert len(TransferRequest.query.all()) == 0
+
+
+def test_flush_signals(app, db_session, monkeypatch):
+    sent = []
+    monkeypatch.setattr(
+        AccountUpdateSignal, 'send_signalbus_messages', lambda signals: sent.extend(s.creditor_id for s in signals))
+    current_ts = datetime.now(tz=timezone.utc)
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.configure_account(D_ID, C_ID + 1, current_ts, 0)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['swpt_accounts', 'flush_signals', '--quit-early', '--wait=0', 'AccountUpdateSignal'])
+    assert result.exit_code == 0
+    assert not result.output
+    assert sorted(sent) == [C_ID, C_ID + 1]
+    assert len(AccountUpdateSignal.query.all()) == 0
+
+    result = runner.invoke(args=['swpt_accounts', 'flush_signals', '--quit-early', 'InvalidSignal'])
+    assert result.exit_code != 0
+
+
+def test_async_connections_usage(app, monkeypatch):
+    runner = app.test_cli_runner()
+    commands = ['process_balance_changes', 'process_transfer_requests', 'process_finalization_requests']
+
+    monkeypatch.setitem(app.config, 'APP_USE_STORED_PROCEDURES', False)
+    for command in commands:
+        result = runner.invoke(args=['swpt_accounts', command, '--async-connections=2', '--quit-early'])
+        assert result.exit_code == 2
+        assert 'APP_USE_STORED_PROCEDURES' in result.output
+
+    monkeypatch.setitem(app.config, 'APP_USE_STORED_PROCEDURES', True)
+    monkeypatch.setitem(app.config, 'APP_USE_OUTBOX', True)
+    for command in commands:
+        result = runner.invoke(args=['swpt_accounts', command, '--async-connections=2', '--quit-early'])
+        assert result.exit_code == 2
+        assert 'APP_USE_OUTBOX' in result.output
+
+    monkeypatch.setitem(app.config, 'APP_USE_OUTBOX', False)
+    monkeypatch.setitem(app.config, 'APP_ROOT_ACCOUNT_SHARDS', 3)
+    for command in commands:
+        result = runner.invoke(args=['swpt_accounts', command, '--async-connections=2', '--quit-early'])
+        assert result.exit_code == 2
+        assert 'APP_ROOT_ACCOUNT_SHARDS' in result.output
+
+
+def test_root_account_shards_usage(app, monkeypatch):
+    runner = app.test_cli_runner()
+    monkeypatch.setitem(app.config, 'APP_ROOT_ACCOUNT_SHARDS', 3)
+
+    monkeypatch.setitem(app.config, 'APP_USE_STORED_PROCEDURES', True)
+    result = runner.invoke(args=['swpt_accounts', 'process_balance_changes', '--quit-early'])
+    assert result.exit_code == 2
+    assert 'APP_USE_STORED_PROCEDURES' in result.output
+
+    monkeypatch.setitem(app.config, 'APP_USE_STORED_PROCEDURES', False)
+    result = runner.invoke(args=['swpt_accounts', 'process_balance_changes', '--chunk-size=2', '--quit-early'])
+    assert result.exit_code == 2
+    assert '--chunk-size' in result.output
+
+    result = runner.invoke(args=['swpt_accounts', 'process_requests', '--quit-early'])
+    assert result.exit_code == 2
+    assert 'APP_ROOT_ACCOUNT_SHARDS' in result.output
+
+
+def test_thread_pool_processor_wakes_up_on_notification(app):
+    processor = ThreadPoolProcessor(
+        1,
+        get_args_collection=list,
+        process_func=lambda: None,
+        wait_seconds=10.0,
+        listen_channels=['test_wakeup'],
+    )
+    connection = processor._listen()
+    with db.engine.connect() as c:
+        c.execution_options(isolation_level='AUTOCOMMIT').execute('NOTIFY test_wakeup')
+
+    started_at = time.time()
+    processor._wait(connection, 10.0)
+    assert time.time() - started_at < 5.0
+    connection.close()
+
+
+def test_thread_pool_processor_pipelined(app):
+    processed = []
+    processor = ThreadPoolProcessor(
+        2,
+        get_args_collection=lambda: [(1,), (2,), (1,)],
+        process_func=processed.append,
+        wait_seconds=0.0,
+        pipelined=True,
+    )
+    processor.run(quit_early=True)
+    assert sorted(processed) == [1, 2]
+    assert processor.pending == 0
+    assert not processor.in_flight
+
+
+def test_thread_pool_processor_pipelined_backs_off(app):
+    calls = []
+
+    def get_args_collection():
+        # Always returns the same key, as if the row is locked by
+        # another transaction, and can not be processed.
+        calls.append(time.time())
+        if len(calls) >= 5:
+            processor.error_has_occurred = True
+        return [(1,)]
+
+    processor = ThreadPoolProcessor(
+        2,
+        get_args_collection=get_args_collection,
+        process_func=lambda x: None,
+        wait_seconds=0.1,
+        pipelined=True,
+    )
+    processor.run()
+    assert len(calls) == 5
+    assert calls[-1] - calls[0] >= 0.3
+    assert processor.pending == 0
+
+
+def test_thread_pool_processor_affinity(app):
+    processed = []
+    processor = ThreadPoolProcessor(
+        3,
+        get_args_collection=lambda: [(D_ID, creditor_id) for creditor_id in range(20)] * 3,
+        process_func=lambda debtor_id, creditor_id: processed.append((creditor_id, threading.get_ident())),
+        wait_seconds=0.0,
+        affinity=True,
+    )
+    processor.run(quit_early=True)
+    assert len(processed) == 60
+    assert len({creditor_id for creditor_id, _ in processed}) == 20
+    assert len(set(processed)) == 20
+    assert processor.pending == 0
+
+
+def test_thread_pool_processor_affinity_with_buckets(app):
+    processed = []
+    account_pks = [(D_ID, creditor_id) for creditor_id in range(40) if p.is_in_bucket(D_ID, creditor_id, 0, 2)]
+    processor = ThreadPoolProcessor(
+        4,
+        get_args_collection=lambda: account_pks * 3,
+        process_func=lambda debtor_id, creditor_id: processed.append((creditor_id, threading.get_ident())),
+        wait_seconds=0.0,
+        affinity=True,
+        buckets_count=2,
+    )
+    processor.run(quit_early=True)
+    assert len(processed) == 60
+    assert len(set(processed)) == 20
+    assert len({thread_id for _, thread_id in processed}) == 4
+    assert processor.pending == 0
+
+
+def test_process_pool_processor(app):
+    processor = ProcessPoolProcessor(
+        2,
+        get_args_collection=lambda: [(0.0,), (0.01,)],
+        process_func=time.sleep,
+        wait_seconds=0.0,
+    )
+    processor.run(quit_early=True)
+    assert processor.pending == 0
+    assert not processor.error_has_occurred
+
+
+def test_batch_consumer_nacks_failed_messages():
+    import dramatiq
+
+    class Connection:
+        def sleep(self, seconds):
+            calls.append(('sleep', seconds))
+
+    class Channel:
+        connection = Connection()
+
+        def basic_ack(self, delivery_tag, multiple=False):
+            calls.append(('ack', delivery_tag, multiple))
+
+        def basic_nack(self, delivery_tag, requeue):
+            calls.append(('nack', delivery_tag, requeue))
+
+    def body(n):
+        return dramatiq.Message(queue_name='test', actor_name='test', args=(n,), kwargs={}, options={}).encode()
+
+    results = {0: True, 1: False, 2: None}
+    consumer = BatchConsumer(
+        'test',
+        max_count=10,
+        wait_seconds=0.5,
+        process_batch=lambda messages: [results[m.args[0]] for m in messages],
+    )
+
+    calls = []
+    consumer._process_deliveries(Channel(), [(1, body(0)), (2, body(0))])
+    assert calls == [('ack', 2, True)]
+
+    calls = []
+    consumer._process_deliveries(Channel(), [(1, b'INVALID'), (2, body(0)), (3, body(1)), (4, body(2))])
+    assert calls == [
+        ('nack', 1, False),
+        ('ack', 2, False),
+        ('nack', 3, False),
+        ('nack', 4, True),
+        ('sleep', 0.5),
+    ]
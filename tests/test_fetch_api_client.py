@@ -1,7 +1,9 @@
 import json
 import pytest
+from flask import current_app
 from swpt_accounts.schemas import RootConfigData
-from swpt_accounts.fetch_api_client import parse_root_config_data, get_root_config_data_dict
+from swpt_accounts.fetch_api_client import parse_root_config_data, get_root_config_data_dict, \
+    get_reachable_cache_stats, _clear_reachable, _lookup_reachable, _register_reachable
 
 
 def test_parse_root_config_data():
@@ -53,3 +55,32 @@ def test_parse_root_config_data():
 def test_get_root_config_data_dict(app):
     assert get_root_config_data_dict(range(1, 12)) == {i: None for i in range(1, 12)}
     assert get_root_config_data_dict(range(1, 12), cache_seconds=-1e6) == {i: None for i in range(1, 12)}
+
+
+def test_reachable_cache(app):
+    _clear_reachable()
+    config = current_app.config
+    config['APP_FETCH_REACHABLE_CACHE_SIZE'] = 2
+
+    _register_reachable(1, 1, True)
+    _register_reachable(1, 2, False)
+    assert _lookup_reachable(1, 1) is True
+    assert _lookup_reachable(1, 2) is False
+
+    # The least recently used entry gets evicted.
+    _lookup_reachable(1, 1)
+    _register_reachable(1, 3, True)
+    assert _lookup_reachable(1, 1) is True
+    with pytest.raises(KeyError):
+        _lookup_reachable(1, 2)
+
+    # A non-positive TTL disables the caching.
+    config['APP_FETCH_UNREACHABLE_CACHE_SECONDS'] = 0.0
+    _register_reachable(1, 4, False)
+    with pytest.raises(KeyError):
+        _lookup_reachable(1, 4)
+    assert get_reachable_cache_stats()['size'] == 2
+
+    config['APP_FETCH_REACHABLE_CACHE_SIZE'] = 10000
+    config['APP_FETCH_UNREACHABLE_CACHE_SECONDS'] = 10.0
+    _clear_reachable()
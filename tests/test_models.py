@@ -1,3 +1,4 @@
+import pytest
 from datetime import datetime, date, timezone, timedelta
 from swpt_accounts.models import Account
 
@@ -50,3 +51,194 @@ def test_configure_account():
 
     i = account.calc_due_interest(1000, committed_at, committed_at + timedelta(days=1))
     assert abs(i) == 0
+
+    amounts = [
+        (1000, committed_at),
+        (-1000, committed_at),
+        (500, current_ts - timedelta(days=1)),
+        (-70, current_ts + timedelta(days=1)),
+        (1, current_ts),
+    ]
+    assert account.calc_total_due_interest([], current_ts) == 0.0
+    assert account.calc_total_due_interest(amounts, current_ts) == sum(
+        account.calc_due_interest(amount, due_ts, current_ts) for amount, due_ts in amounts)
+
+
+def _create_signals():
+    from swpt_accounts import models as m
+
+    current_ts = datetime.now(tz=timezone.utc)
+    return [
+        m.RejectedTransferSignal(
+            debtor_id=D_ID, sender_creditor_id=C_ID, coordinator_type='test', coordinator_id=1,
+            coordinator_request_id=2, status_code='TEST', total_locked_amount=3, inserted_at=current_ts),
+        m.PreparedTransferSignal(
+            debtor_id=D_ID, sender_creditor_id=C_ID, transfer_id=1, coordinator_type='test', coordinator_id=1,
+            coordinator_request_id=2, locked_amount=3, recipient_creditor_id=-2, prepared_at=current_ts,
+            demurrage_rate=-50.0, deadline=current_ts, min_interest_rate=-100.0, inserted_at=current_ts),
+        m.FinalizedTransferSignal(
+            debtor_id=D_ID, sender_creditor_id=C_ID, transfer_id=1, coordinator_type='test', coordinator_id=1,
+            coordinator_request_id=2, prepared_at=current_ts, finalized_at=current_ts, committed_amount=3,
+            total_locked_amount=0, status_code='OK'),
+        m.AccountTransferSignal(
+            debtor_id=D_ID, creditor_id=C_ID, creation_date=date(1970, 1, 1), transfer_number=1,
+            coordinator_type='test', committed_at=current_ts, acquired_amount=-1, other_creditor_id=-2,
+            transfer_note_format='', transfer_note='Щ', principal=1000, previous_transfer_number=0,
+            inserted_at=current_ts),
+        m.AccountUpdateSignal(
+            debtor_id=D_ID, creditor_id=C_ID, last_change_ts=current_ts, last_change_seqnum=1, principal=1000,
+            interest=12.5, interest_rate=3, last_interest_rate_change_ts=current_ts, last_transfer_number=2,
+            last_transfer_committed_at=current_ts, last_config_ts=current_ts, last_config_seqnum=3,
+            creation_date=date(1970, 1, 1), negligible_amount=0.5, config_data='', config_flags=0,
+            debtor_info_sha256=32 * b' ', inserted_at=current_ts),
+        m.AccountPurgeSignal(debtor_id=D_ID, creditor_id=C_ID, creation_date=date(1970, 1, 1), inserted_at=current_ts),
+        m.RejectedConfigSignal(
+            debtor_id=D_ID, creditor_id=C_ID, config_ts=current_ts, config_seqnum=1, config_flags=0,
+            config_data='', negligible_amount=0.0, rejection_code='TEST', inserted_at=current_ts),
+        m.PendingBalanceChangeSignal(
+            debtor_id=D_ID, other_creditor_id=-2, change_id=1, creditor_id=C_ID, coordinator_type='test',
+            transfer_note_format='', transfer_note='', committed_at=current_ts, principal_delta=1000),
+    ]
+
+
+def test_calc_approx_current_balances():
+    from swpt_accounts.models import calc_current_balance, calc_approx_current_balances, ROOT_CREDITOR_ID, MAX_INT64
+
+    current_ts = datetime.now(tz=timezone.utc)
+    accounts = [
+        (ROOT_CREDITOR_ID, -1000, 500.0, 10.0, current_ts - timedelta(days=1000)),
+        (C_ID, 0, 0.0, 10.0, current_ts),
+        (C_ID, 1000, 0.0, 10.0, current_ts - timedelta(days=365.25)),
+        (C_ID, 1000, -50.5, -5.0, current_ts - timedelta(days=365.25)),
+        (C_ID, -1000, 10.0, 10.0, current_ts - timedelta(days=365.25)),
+        (C_ID, MAX_INT64, -float(MAX_INT64), 10.0, current_ts - timedelta(days=365.25)),
+        (C_ID, MAX_INT64 - 10, 5.0, 100.0, current_ts - timedelta(days=3650)),
+    ]
+    approx_balances = calc_approx_current_balances(accounts, current_ts)
+    assert len(approx_balances) == len(accounts)
+
+    for account, (approx_balance, max_error) in zip(accounts, approx_balances):
+        creditor_id, principal, interest, interest_rate, last_change_ts = account
+        current_balance = calc_current_balance(
+            creditor_id=creditor_id,
+            principal=principal,
+            interest=interest,
+            interest_rate=interest_rate,
+            last_change_ts=last_change_ts,
+            current_ts=current_ts,
+        )
+        assert abs(float(current_balance) - approx_balance) <= max_error + abs(approx_balance) * 1e-15
+
+    assert approx_balances[2][0] == pytest.approx(1100.0)
+    assert approx_balances[5][1] == float('inf')
+
+
+def test_floor_current_balance():
+    import math
+    import random
+    from swpt_accounts.models import calc_current_balance, floor_current_balance, MAX_INT64
+
+    rnd = random.Random(0)
+    current_ts = datetime.now(tz=timezone.utc)
+
+    def generate_params():
+        principal = rnd.choice([
+            0, 1, -1, rnd.randint(-1000, 1000), rnd.randint(-2 ** 53, 2 ** 53),
+            rnd.randint(-MAX_INT64, MAX_INT64), 2 ** 53 + rnd.randint(-5, 5),
+        ])
+        interest = rnd.choice([
+            0.0, rnd.uniform(-1000.0, 1000.0), rnd.uniform(-1e18, 1e18), float(rnd.randint(-100, 100)),
+            float(-principal), -principal + rnd.choice([0.5, -0.5, 1e-9]),
+        ])
+        return dict(
+            creditor_id=rnd.choice([C_ID, C_ID, C_ID, 0]),
+            principal=principal,
+            interest=interest,
+            interest_rate=rnd.choice([0.0, 10.0, -50.0, rnd.uniform(-50.0, 100.0)]),
+            last_change_ts=current_ts - timedelta(seconds=rnd.choice([0, 1, rnd.uniform(0, 1e9)])),
+            current_ts=current_ts,
+        )
+
+    for _ in range(20000):
+        params = generate_params()
+        assert floor_current_balance(**params) == math.floor(calc_current_balance(**params)), params
+
+
+@pytest.mark.slow
+def test_floor_current_balance_performance():
+    import math
+    import timeit
+    from swpt_accounts.models import calc_current_balance, floor_current_balance
+
+    current_ts = datetime.now(tz=timezone.utc)
+    params = dict(
+        creditor_id=C_ID,
+        principal=1500,
+        interest=12.5,
+        interest_rate=5.0,
+        last_change_ts=current_ts - timedelta(days=30),
+        current_ts=current_ts,
+    )
+    decimal_seconds = timeit.timeit(lambda: math.floor(calc_current_balance(**params)), number=20000)
+    float_seconds = timeit.timeit(lambda: floor_current_balance(**params), number=20000)
+    assert float_seconds < decimal_seconds
+
+
+def test_dump_signalbus_message(app):
+    from swpt_accounts.events import Signal, compile_schema_dumper
+
+    signals = _create_signals()
+    assert {type(signal) for signal in signals} == set(Signal.__subclasses__())
+
+    for signal in signals:
+        model = type(signal)
+        schema = model.__marshmallow_schema__
+        assert compile_schema_dumper(schema) != schema.dump
+        assert model.dump_signalbus_message(signal) == schema.dump(signal)
+
+
+def test_compile_schema_dumper_fallback():
+    from types import SimpleNamespace
+    from marshmallow import Schema, fields
+    from swpt_accounts.events import compile_schema_dumper
+
+    class BooleanSchema(Schema):
+        n = fields.Integer()
+        flag = fields.Boolean()
+
+    class ContextFunctionSchema(Schema):
+        n = fields.Integer()
+        m = fields.Function(lambda obj, context: obj.n + 1)
+
+    obj = SimpleNamespace(n=1, flag=True)
+    for schema_class in [BooleanSchema, ContextFunctionSchema]:
+        schema = schema_class()
+        dump = compile_schema_dumper(schema)
+        assert dump == schema.dump
+        assert dump(obj) == schema.dump(obj)
+
+
+def test_create_message(app):
+    from swpt_accounts.extensions import MAIN_EXCHANGE_NAME
+
+    for signal in _create_signals():
+        model = type(signal)
+        queue_name, actor_name, routing_key = signal.get_message_route()
+        message, exchange, key = signal.create_message()
+        assert exchange == MAIN_EXCHANGE_NAME
+        assert key == routing_key
+        assert message.queue_name == queue_name
+        assert message.actor_name == actor_name
+        assert message.args == ()
+        assert message.kwargs == model.dump_signalbus_message(signal)
+
+
+@pytest.mark.slow
+def test_dump_signalbus_message_performance(app):
+    import timeit
+
+    for signal in _create_signals():
+        model = type(signal)
+        schema_seconds = timeit.timeit(lambda: model.__marshmallow_schema__.dump(signal), number=2000)
+        compiled_seconds = timeit.timeit(lambda: model.dump_signalbus_message(signal), number=2000)
+        assert compiled_seconds < schema_seconds
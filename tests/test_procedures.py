@@ -1,11 +1,13 @@
 import pytest
+import threading
 from datetime import datetime, timezone, timedelta
 from swpt_accounts import __version__
 from swpt_accounts import procedures as p
+from swpt_accounts.extensions import db
 from swpt_accounts.models import MAX_INT32, MAX_INT64, INTEREST_RATE_FLOOR, INTEREST_RATE_CEIL, \
     Account, PendingBalanceChangeSignal, RejectedTransferSignal, PreparedTransfer, PreparedTransferSignal, \
     AccountUpdateSignal, AccountTransferSignal, FinalizedTransferSignal, RejectedConfigSignal, \
-    AccountPurgeSignal, FinalizationRequest, ROOT_CREDITOR_ID, \
+    AccountPurgeSignal, FinalizationRequest, RootAccountShard, AccountConfig, OutboxMessage, ROOT_CREDITOR_ID, \
     CT_DIRECT, SC_OK, SC_TIMEOUT, SC_INSUFFICIENT_AVAILABLE_AMOUNT
 
 
@@ -134,18 +136,40 @@ def test_update_debtor_info(db_session, current_ts):
 
     # The account does exist.
     p.configure_account(D_ID, C_ID, current_ts, 0)
+    assert p.get_account(D_ID, C_ID).debtor_info_iri is None
+    assert len(AccountConfig.query.all()) == 0
     p.update_debtor_info(D_ID, C_ID, 'http://example.com', 32 * b'a', 'text/plain', current_ts)
     a = p.get_account(D_ID, C_ID)
     assert a.debtor_info_iri == 'http://example.com'
     assert a.debtor_info_sha256 == 32 * b'a'
     assert a.debtor_info_content_type == 'text/plain'
+    assert a.config_data == ''
     assert len(AccountUpdateSignal.query.all()) == 2
+    ac = AccountConfig.query.one()
+    assert ac.debtor_info_iri == 'http://example.com'
+    assert ac.config_data == ''
 
     # No change.
     p.update_debtor_info(D_ID, C_ID, 'http://example.com', 32 * b'a', 'text/plain', current_ts)
     assert len(AccountUpdateSignal.query.all()) == 2
 
 
+def test_account_config(db_session, current_ts):
+    assert p.get_account_config_data(D_ID, ROOT_CREDITOR_ID) is None
+    p.configure_account(D_ID, ROOT_CREDITOR_ID, current_ts, 0)
+    assert p.get_account_config_data(D_ID, ROOT_CREDITOR_ID) == ''
+    assert len(AccountConfig.query.all()) == 0
+
+    p.configure_account(D_ID, ROOT_CREDITOR_ID, current_ts, 1, config_data='{"rate": 1.0}')
+    assert p.get_account_config_data(D_ID, ROOT_CREDITOR_ID) == '{"rate": 1.0}'
+    assert AccountConfig.query.one().config_data == '{"rate": 1.0}'
+    assert AccountUpdateSignal.query.filter_by(last_config_seqnum=1).one().config_data == '{"rate": 1.0}'
+
+    p.configure_account(D_ID, ROOT_CREDITOR_ID, current_ts, 2, config_data='')
+    assert p.get_account_config_data(D_ID, ROOT_CREDITOR_ID) == ''
+    assert AccountConfig.query.one().config_data == ''
+
+
 def test_set_interest_rate(db_session, current_ts):
     # The account does not exist.
     p.change_interest_rate(D_ID, C_ID, 7.0, current_ts)
@@ -297,10 +321,10 @@ def test_make_debtor_interest_payment(db_session, current_ts, amount):
 def test_process_pending_balance_changes(db_session, current_ts):
     p.configure_account(D_ID, C_ID, current_ts, 0)
     _flush_balance_change_signals()
-    assert len(p.get_accounts_with_pending_balance_changes()) == 0
+    assert len(list(p.get_accounts_with_pending_balance_changes())) == 0
     p.make_debtor_payment('test', D_ID, C_ID, 10000)
     _flush_balance_change_signals()
-    assert len(p.get_accounts_with_pending_balance_changes()) == 1
+    assert len(list(p.get_accounts_with_pending_balance_changes())) == 1
     assert p.get_account(D_ID, p.ROOT_CREDITOR_ID) is None
     _flush_balance_change_signals()
     p.process_pending_balance_changes(D_ID, p.ROOT_CREDITOR_ID)
@@ -311,10 +335,254 @@ def test_process_pending_balance_changes(db_session, current_ts):
         principal=10000,
     ).one_or_none()
     _flush_balance_change_signals()
-    assert len(p.get_accounts_with_pending_balance_changes()) == 0
+    assert len(list(p.get_accounts_with_pending_balance_changes())) == 0
     assert p.get_account(D_ID, p.ROOT_CREDITOR_ID).principal == -10000
 
 
+def test_process_pending_balance_changes_for_accounts(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.make_debtor_payment('test', D_ID, C_ID, 10000)
+    p.make_debtor_payment('test', D_ID, C_ID, 5000)
+    p.make_debtor_payment('test', D_ID, 1234, 2000)
+    _flush_balance_change_signals()
+    p.process_pending_balance_changes_for_accounts([])
+    p.process_pending_balance_changes_for_accounts([(D_ID, 777)])
+    account_pks = list(p.get_accounts_with_pending_balance_changes())
+    assert len(account_pks) == 3
+    p.process_pending_balance_changes_for_accounts(account_pks)
+    assert len(list(p.get_accounts_with_pending_balance_changes())) == 0
+    assert p.get_account(D_ID, C_ID).principal == 15000
+    assert p.get_account(D_ID, C_ID).last_transfer_number == 2
+    assert p.get_account(D_ID, C_ID).pending_account_update
+    assert p.get_account(D_ID, 1234).principal == 2000
+    assert p.get_account(D_ID, p.ROOT_CREDITOR_ID).principal == -17000
+    assert len(AccountTransferSignal.query.filter_by(debtor_id=D_ID, creditor_id=C_ID).all()) == 2
+
+
+def test_write_back_accounts(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.configure_account(D_ID, 1234, current_ts, 0)
+    accounts = Account.query.filter_by(debtor_id=D_ID).order_by(Account.creditor_id).with_for_update().all()
+    for account in accounts:
+        account.principal = account.creditor_id
+        account.last_transfer_committed_at = current_ts
+
+    with db.session.no_autoflush:
+        p._write_back_accounts(accounts)
+    for account in accounts:
+        assert account in db.session
+        assert not db.session.is_modified(account)
+
+    table = Account.__table__
+    rows = db.session.execute(table.select().where(table.c.debtor_id == D_ID)).fetchall()
+    assert sorted((row['creditor_id'], row['principal']) for row in rows) == [(C_ID, C_ID), (1234, 1234)]
+    assert all(row['last_transfer_committed_at'] == current_ts for row in rows)
+
+
+def test_get_accounts_with_pending_balance_changes_in_buckets(db_session, current_ts):
+    creditor_ids = [C_ID, 2, 3, -4, MAX_INT64, -MAX_INT64]
+    for creditor_id in creditor_ids:
+        p.make_debtor_payment('test', D_ID, creditor_id, 1000)
+    _flush_balance_change_signals()
+    all_account_pks = set(p.get_accounts_with_pending_balance_changes())
+    assert len(all_account_pks) == len(creditor_ids) + 1
+
+    bucket_account_pks = [set(p.get_accounts_with_pending_balance_changes(None, i, 3)) for i in range(3)]
+    assert set.union(*bucket_account_pks) == all_account_pks
+    for i, account_pks in enumerate(bucket_account_pks):
+        for debtor_id, creditor_id in account_pks:
+            assert p.is_in_bucket(debtor_id, creditor_id, i, 3)
+
+
+def test_get_accounts_with_requests_in_pages(db_session, current_ts, monkeypatch):
+    monkeypatch.setattr(p, 'STREAM_QUERY_BATCH_SIZE', 2)
+    creditor_ids = [C_ID, 2, 3, -4, MAX_INT64]
+    for creditor_id in creditor_ids:
+        p.make_debtor_payment('test', D_ID, creditor_id, 1000)
+    _flush_balance_change_signals()
+    account_pks = list(p.get_accounts_with_requests())
+    assert account_pks == sorted((D_ID, creditor_id) for creditor_id in creditor_ids + [p.ROOT_CREDITOR_ID])
+    assert list(p.get_accounts_with_pending_balance_changes()) == account_pks
+    assert list(p.get_accounts_with_requests(max_count=3)) == account_pks[:3]
+    assert list(p.get_accounts_with_requests(max_count=4)) == account_pks[:4]
+
+
+def test_process_account_requests(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.configure_account(D_ID, 1234, current_ts, 0)
+    Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID).update({Account.principal: 100})
+    p.prepare_transfer('direct', 1, 1, 1, 200, D_ID, C_ID, 1234, current_ts)
+    p.process_transfer_requests(D_ID, C_ID)
+    pt = PreparedTransfer.query.filter_by(debtor_id=D_ID, sender_creditor_id=C_ID).one()
+    p.finalize_transfer(D_ID, C_ID, pt.transfer_id, 'direct', 1, 1, 40)
+    p.make_debtor_payment('test', D_ID, C_ID, 500)
+    p.prepare_transfer('direct', 1, 2, 500, 500, D_ID, C_ID, 1234, current_ts)
+    _flush_balance_change_signals()
+    assert set(p.get_accounts_with_requests()) == {(D_ID, C_ID), (D_ID, p.ROOT_CREDITOR_ID)}
+
+    p.process_account_requests(D_ID, 777)
+    p.process_account_requests(D_ID, C_ID)
+    assert set(p.get_accounts_with_requests()) == {(D_ID, p.ROOT_CREDITOR_ID)}
+    a = p.get_account(D_ID, C_ID)
+    assert a.principal == 560
+    assert a.total_locked_amount == 500
+    assert a.pending_transfers_count == 1
+    assert len(FinalizedTransferSignal.query.all()) == 1
+    assert len(AccountTransferSignal.query.filter_by(debtor_id=D_ID, creditor_id=C_ID).all()) == 2
+    pt = PreparedTransfer.query.filter_by(debtor_id=D_ID, sender_creditor_id=C_ID).one()
+    assert pt.coordinator_request_id == 2
+    assert pt.locked_amount == 500
+
+    p.process_account_requests(D_ID, p.ROOT_CREDITOR_ID)
+    assert len(list(p.get_accounts_with_requests())) == 0
+    _flush_balance_change_signals()
+    assert set(p.get_accounts_with_requests()) == {(D_ID, 1234)}
+
+
+def test_process_account_requests_interest_delta(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.configure_account(D_ID, 1234, current_ts, 0)
+    Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID).update({
+        Account.principal: 100,
+        Account.interest_rate: -50.0,
+    })
+    p.prepare_transfer('direct', 1, 1, 100, 100, D_ID, C_ID, 1234, current_ts)
+    p.process_transfer_requests(D_ID, C_ID)
+    pt = PreparedTransfer.query.filter_by(debtor_id=D_ID, sender_creditor_id=C_ID).one()
+    p.finalize_transfer(D_ID, C_ID, pt.transfer_id, 'direct', 1, 1, 1000)
+
+    # The received amount has lost about a half of its value, because
+    # it was committed a year ago, so the transfer can not be committed.
+    p.insert_pending_balance_change(
+        debtor_id=D_ID,
+        other_creditor_id=777,
+        change_id=1,
+        creditor_id=C_ID,
+        coordinator_type='direct',
+        transfer_note_format='',
+        transfer_note='',
+        committed_at=current_ts - timedelta(days=365),
+        principal_delta=1000,
+    )
+    p.process_account_requests(D_ID, C_ID)
+    fts = FinalizedTransferSignal.query.one()
+    assert fts.committed_amount == 0
+    assert fts.status_code == SC_INSUFFICIENT_AVAILABLE_AMOUNT
+    a = p.get_account(D_ID, C_ID)
+    assert a.principal == 1100
+    assert 550 < a.calc_current_balance(current_ts) < 650
+
+
+def test_account_cache(db_session, current_ts, monkeypatch):
+    monkeypatch.setattr(p, '_account_cache', threading.local())
+    p.enable_account_cache(10)
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.make_debtor_payment('test', D_ID, C_ID, 1000)
+    _flush_balance_change_signals()
+    p.process_pending_balance_changes(D_ID, C_ID)
+    values = p._account_cache.accounts[(D_ID, C_ID)][1]
+    assert values['principal'] == 1000
+
+    p.prepare_transfer('direct', 1, 1, 200, 200, D_ID, C_ID, p.ROOT_CREDITOR_ID, current_ts)
+    p.process_transfer_requests(D_ID, C_ID)
+    values = p._account_cache.accounts[(D_ID, C_ID)][1]
+    assert values['principal'] == 1000
+    assert values['total_locked_amount'] == 200
+
+    # The account is changed behind the cache's back.
+    Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID).update(
+        {Account.principal: 5000}, synchronize_session=False)
+    db_session.commit()
+    p.prepare_transfer('direct', 1, 2, 3000, 3000, D_ID, C_ID, p.ROOT_CREDITOR_ID, current_ts)
+    p.process_transfer_requests(D_ID, C_ID)
+    assert len(PreparedTransfer.query.filter_by(debtor_id=D_ID, sender_creditor_id=C_ID).all()) == 2
+    values = p._account_cache.accounts[(D_ID, C_ID)][1]
+    assert values['principal'] == 5000
+    assert values['total_locked_amount'] == 3200
+
+    # The account is locked, but not changed, so the second time the
+    # row's `xmin` matches, and the account is taken from the cache.
+    from sqlalchemy.orm import make_transient_to_detached
+    cache_hits = []
+
+    def make_cached_instance(instance):
+        cache_hits.append(instance)
+        make_transient_to_detached(instance)
+
+    monkeypatch.setattr(p, 'make_transient_to_detached', make_cached_instance)
+    p.get_account(D_ID, C_ID, lock=True)
+    assert p.get_account(D_ID, C_ID, lock=True).principal == 5000
+    assert len(cache_hits) >= 1
+
+
+def test_root_account_shards(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.make_debtor_payment('test', D_ID, C_ID, 1000)
+    _flush_balance_change_signals()
+    p.process_pending_balance_changes(D_ID, ROOT_CREDITOR_ID, root_account_shards=3)
+    assert not RootAccountShard.query.all()
+    assert p.get_available_amount(D_ID, ROOT_CREDITOR_ID) == -1000
+
+    p.make_debtor_payment('test', D_ID, C_ID, 2000)
+    p.make_debtor_payment('test', D_ID, C_ID, 3000)
+    _flush_balance_change_signals()
+    p.process_pending_balance_changes(D_ID, ROOT_CREDITOR_ID, root_account_shards=3)
+    assert len(RootAccountShard.query.all()) == 1
+    assert p.get_account(D_ID, ROOT_CREDITOR_ID).principal == -1000
+    assert p.get_available_amount(D_ID, ROOT_CREDITOR_ID) == -6000
+
+    p.apply_root_account_shards([D_ID])
+    assert not RootAccountShard.query.all()
+    root_account = p.get_account(D_ID, ROOT_CREDITOR_ID)
+    assert root_account.principal == -6000
+    assert root_account.pending_account_update
+    assert p.get_available_amount(D_ID, ROOT_CREDITOR_ID) == -6000
+
+
+def test_root_account_shards_applied_before_update_signal(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.make_debtor_payment('test', D_ID, C_ID, 1000)
+    _flush_balance_change_signals()
+    p.process_pending_balance_changes(D_ID, ROOT_CREDITOR_ID, root_account_shards=3)
+    p.make_debtor_payment('test', D_ID, C_ID, 2000)
+    _flush_balance_change_signals()
+    p.process_pending_balance_changes(D_ID, ROOT_CREDITOR_ID, root_account_shards=3)
+    assert len(RootAccountShard.query.all()) == 1
+    assert p.get_account(D_ID, ROOT_CREDITOR_ID, lock=True).principal == -1000
+    assert len(RootAccountShard.query.all()) == 1
+
+    AccountUpdateSignal.query.delete()
+    p.configure_account(D_ID, ROOT_CREDITOR_ID, current_ts, 1)
+    assert not RootAccountShard.query.all()
+    aus = AccountUpdateSignal.query.filter_by(debtor_id=D_ID, creditor_id=ROOT_CREDITOR_ID).one()
+    assert aus.principal == -3000
+    assert aus.last_change_seqnum == p.get_account(D_ID, ROOT_CREDITOR_ID).last_change_seqnum
+
+
+def test_insert_pending_balance_changes(db_session, current_ts):
+    def change(change_id, principal_delta=1000, committed_at=current_ts):
+        return dict(
+            debtor_id=D_ID,
+            other_creditor_id=p.ROOT_CREDITOR_ID,
+            change_id=change_id,
+            creditor_id=C_ID,
+            coordinator_type='test',
+            transfer_note_format='',
+            transfer_note='',
+            committed_at=committed_at,
+            principal_delta=principal_delta,
+        )
+
+    p.insert_pending_balance_changes([])
+    p.insert_pending_balance_changes([change(1), change(1, 5000), change(2, 2000)])
+    p.insert_pending_balance_changes([change(2, 3000), change(3, 3000)])
+    p.insert_pending_balance_changes([change(4)], cutoff_ts=current_ts + timedelta(seconds=1))
+    assert len(list(p.get_accounts_with_pending_balance_changes())) == 1
+    p.process_pending_balance_changes(D_ID, C_ID)
+    assert p.get_account(D_ID, C_ID).principal == 6000
+    assert len(list(p.get_accounts_with_pending_balance_changes())) == 0
+
+
 def test_positive_overflow(db_session, current_ts):
     p.configure_account(D_ID, C_ID, current_ts, 0)
 
@@ -641,6 +909,38 @@ def test_prepare_transfer_too_many_prepared_transfers(db_session, current_ts):
     assert rts.status_code == p.SC_TOO_MANY_TRANSFERS
 
 
+def test_prepare_transfer_deferred_reachability_checks(db_session, current_ts):
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.configure_account(D_ID, 1234, current_ts, 0)
+    q = Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID)
+    q.update({Account.principal: 100})
+    assert p.get_reachable_creditor_ids(D_ID, [C_ID, 1234, 777, p.ROOT_CREDITOR_ID]) == {
+        C_ID, 1234, p.ROOT_CREDITOR_ID}
+    assert p.get_reachable_creditor_ids(D_ID, []) == set()
+
+    for recipient_creditor_id in [1234, 777, 888]:
+        p.prepare_transfer(
+            coordinator_type='test',
+            coordinator_id=1,
+            coordinator_request_id=recipient_creditor_id,
+            min_locked_amount=1,
+            max_locked_amount=10,
+            debtor_id=D_ID,
+            creditor_id=C_ID,
+            recipient_creditor_id=recipient_creditor_id,
+            ts=current_ts,
+        )
+    assert sorted(p.get_transfer_request_recipients(D_ID, C_ID)) == [777, 888, 1234]
+
+    p.process_transfer_requests(D_ID, C_ID, recipients_reachability={1234: True, 777: False})
+    rts = RejectedTransferSignal.query.one()
+    assert rts.coordinator_request_id == 777
+    assert rts.status_code == p.SC_RECIPIENT_IS_UNREACHABLE
+    pts = PreparedTransferSignal.query.one()
+    assert pts.coordinator_request_id == 1234
+    assert p.get_transfer_request_recipients(D_ID, C_ID) == [888]
+
+
 def test_prepare_transfer_invalid_recipient(db_session, current_ts):
     p.configure_account(D_ID, C_ID, current_ts, 0)
     q = Account.query.filter_by(debtor_id=D_ID, creditor_id=C_ID)
@@ -1100,3 +1400,50 @@ def test_account_purge_signal(db_session, current_ts):
     assert aps_obj['creditor_id'] == C_ID
     assert aps_obj['creation_date'] == current_ts.date().isoformat()
     assert isinstance(aps_obj['ts'], str)
+
+
+def test_flush_signals(db_session, current_ts, monkeypatch):
+    sent = []
+    monkeypatch.setattr(
+        AccountUpdateSignal, 'send_signalbus_messages', lambda signals: sent.extend(s.creditor_id for s in signals))
+    assert p.get_table_partitions('account_update_signal') == ['account_update_signal']
+
+    for creditor_id in range(1, 6):
+        p.configure_account(D_ID, creditor_id, current_ts, 0)
+    assert len(AccountUpdateSignal.query.all()) == 5
+
+    assert p.flush_signals(AccountUpdateSignal, 'account_update_signal', 3) == 3
+    assert len(AccountUpdateSignal.query.all()) == 2
+    assert p.flush_signals(AccountUpdateSignal, 'account_update_signal', 3) == 2
+    assert p.flush_signals(AccountUpdateSignal, 'account_update_signal', 3) == 0
+    assert len(AccountUpdateSignal.query.all()) == 0
+    assert sorted(sent) == [1, 2, 3, 4, 5]
+
+
+def test_outbox(app, db_session, current_ts, monkeypatch):
+    import json
+
+    monkeypatch.setitem(app.config, 'APP_USE_OUTBOX', True)
+    sent = []
+    monkeypatch.setattr(OutboxMessage, 'send_messages', lambda messages: sent.extend(messages))
+
+    p.configure_account(D_ID, C_ID, current_ts, 0)
+    p.make_debtor_payment('test', D_ID, C_ID, 1000)
+    assert len(AccountUpdateSignal.query.all()) == 0
+    assert len(PendingBalanceChangeSignal.query.all()) == 0
+
+    messages = OutboxMessage.query.order_by(OutboxMessage.message_id).all()
+    assert len(messages) == 3
+    assert all(m.exchange == 'dramatiq' for m in messages)
+    payloads = [json.loads(m.payload) for m in messages]
+    assert payloads[0]['creditor_id'] == C_ID
+    assert 'last_change_seqnum' in payloads[0]
+    change_ids = [payload['change_id'] for payload in payloads if 'change_id' in payload]
+    assert len(change_ids) == 1
+    assert isinstance(change_ids[0], int)
+
+    assert p.publish_outbox_messages(2) == 2
+    assert p.publish_outbox_messages(2) == 1
+    assert p.publish_outbox_messages(2) == 0
+    assert [m.message_id for m in sent] == [m.message_id for m in messages]
+    assert len(OutboxMessage.query.all()) == 0
@@ -41,6 +41,27 @@ def test_get_reachable(client, account, current_ts):
     assert r.get_data() == b''
 
 
+def test_post_reachable(client, account, current_ts):
+    r = client.get('/accounts/18446744073709551615/reachable')
+    assert r.status_code == 405
+    r = client.post('/accounts/18446744073709551615/reachable', json={'creditorIds': [1, 2, 0]})
+    assert r.status_code == 200
+    assert r.get_json() == {'reachableCreditorIds': [0, 1]}
+    r = client.post('/accounts/18446744073709551614/reachable', json={'creditorIds': [1, 2]})
+    assert r.status_code == 200
+    assert r.get_json() == {'reachableCreditorIds': []}
+    r = client.post('/accounts/18446744073709551615/reachable', json={'creditorIds': []})
+    assert r.status_code == 200
+    assert r.get_json() == {'reachableCreditorIds': []}
+
+    for data in [{}, [], {'creditorIds': ['1']}, {'creditorIds': [True]}, {'creditorIds': [2 ** 63]}]:
+        r = client.post('/accounts/18446744073709551615/reachable', json=data)
+        assert r.status_code == 400
+
+    r = client.post('/accounts/18446744073709551615/reachable', data='NOT JSON')
+    assert r.status_code == 400
+
+
 def test_get_config(client, account, current_ts):
     r = client.post('/accounts/18446744073709551615/1/config', json={})
     assert r.status_code == 405
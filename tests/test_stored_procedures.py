@@ -0,0 +1,198 @@
+import pytest
+from sqlalchemy import text
+from datetime import datetime, timezone, timedelta
+from swpt_accounts import procedures as p
+from swpt_accounts.extensions import db
+from swpt_accounts.models import Account, AccountConfig, TransferRequest, PreparedTransfer, FinalizationRequest, \
+    PendingBalanceChange, RegisteredBalanceChange, RejectedTransferSignal, PreparedTransferSignal, \
+    FinalizedTransferSignal, AccountTransferSignal, AccountUpdateSignal, PendingBalanceChangeSignal, \
+    ROOT_CREDITOR_ID
+
+D_ID1 = -1
+D_ID2 = -2
+C_ID = 1
+RECIPIENT_ID = 1234
+
+MODELS = [
+    Account, AccountConfig, TransferRequest, PreparedTransfer, FinalizationRequest, PendingBalanceChange,
+    RegisteredBalanceChange, RejectedTransferSignal, PreparedTransferSignal, FinalizedTransferSignal,
+    AccountTransferSignal, AccountUpdateSignal, PendingBalanceChangeSignal,
+]
+EXCLUDED_COLUMNS = {'debtor_id', 'signal_id', 'inserted_at', 'transfer_request_id'}
+
+
+@pytest.fixture(scope='function')
+def current_ts(monkeypatch):
+    # The current time is frozen, so that the Python and the stored
+    # procedure implementations can be compared.
+    current_ts = datetime.now(tz=timezone.utc) + timedelta(hours=1)
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return current_ts
+
+    monkeypatch.setattr(p, 'datetime', FrozenDatetime)
+    return current_ts
+
+
+def _snapshot(debtor_id):
+    snapshot = {}
+    for model in MODELS:
+        table = model.__table__
+        excluded_columns = EXCLUDED_COLUMNS | ({'change_id'} if model is PendingBalanceChangeSignal else set())
+        columns = [c for c in table.columns if c.name not in excluded_columns]
+        rows = db.session.execute(table.select().where(table.c.debtor_id == debtor_id)).fetchall()
+        snapshot[table.name] = sorted(
+            (tuple((c.name, row[c.name]) for c in columns) for row in rows),
+            key=repr,
+        )
+
+    return snapshot
+
+
+def _setup_accounts(debtor_id, current_ts):
+    p.configure_account(debtor_id, C_ID, current_ts, 0)
+    p.configure_account(debtor_id, RECIPIENT_ID, current_ts, 0, negligible_amount=50.0)
+    Account.query.filter_by(debtor_id=debtor_id, creditor_id=C_ID).update({Account.principal: 1000})
+
+
+def _prepare_transfer(debtor_id, current_ts, coordinator_request_id, recipient_creditor_id=RECIPIENT_ID, **kw):
+    p.prepare_transfer(**dict(dict(
+        coordinator_type='test',
+        coordinator_id=1,
+        coordinator_request_id=coordinator_request_id,
+        min_locked_amount=100,
+        max_locked_amount=200,
+        debtor_id=debtor_id,
+        creditor_id=C_ID,
+        recipient_creditor_id=recipient_creditor_id,
+        ts=current_ts,
+    ), **kw))
+
+
+def _prepare_transfers(debtor_id, current_ts):
+    _prepare_transfer(debtor_id, current_ts, 1)
+    _prepare_transfer(debtor_id, current_ts, 2, min_locked_amount=5000, max_locked_amount=5000)
+    _prepare_transfer(debtor_id, current_ts, 3, recipient_creditor_id=C_ID)
+    _prepare_transfer(debtor_id, current_ts, 4, min_interest_rate=10.0)
+    _prepare_transfer(debtor_id, current_ts, 5, min_interest_rate=0.0, max_commit_delay=10 * 86400)
+    _prepare_transfer(debtor_id, current_ts, 6, recipient_creditor_id=777)
+    p.prepare_transfer('test', 1, 7, 0, 10, debtor_id, 666, RECIPIENT_ID, current_ts)
+
+
+def test_process_transfer_requests(db_session, current_ts):
+    for debtor_id, process_transfer_requests in [
+            (D_ID1, p.process_transfer_requests),
+            (D_ID2, p.process_transfer_requests_in_db)]:
+        _setup_accounts(debtor_id, current_ts)
+        _prepare_transfers(debtor_id, current_ts)
+        process_transfer_requests(debtor_id, C_ID, 30 * 86400, {RECIPIENT_ID: True, C_ID: True, 777: False})
+        process_transfer_requests(debtor_id, C_ID, 30 * 86400)
+        process_transfer_requests(debtor_id, 666, 30 * 86400)
+
+    assert len(PreparedTransferSignal.query.filter_by(debtor_id=D_ID2).all()) == 2
+    assert len(RejectedTransferSignal.query.filter_by(debtor_id=D_ID2).all()) == 5
+    assert _snapshot(D_ID1) == _snapshot(D_ID2)
+
+
+def test_process_finalization_requests(db_session, current_ts):
+    for debtor_id, process_finalization_requests in [
+            (D_ID1, p.process_finalization_requests),
+            (D_ID2, p.process_finalization_requests_in_db)]:
+        _setup_accounts(debtor_id, current_ts)
+        _prepare_transfers(debtor_id, current_ts)
+        p.process_transfer_requests(debtor_id, C_ID, 30 * 86400)
+        prepared_transfers = PreparedTransfer.query.filter_by(debtor_id=debtor_id).all()
+        committed_amounts = {1: 150, 5: 0, 6: 5000}
+        for pt in prepared_transfers:
+            p.finalize_transfer(
+                debtor_id, C_ID, pt.transfer_id, pt.coordinator_type, pt.coordinator_id,
+                pt.coordinator_request_id, committed_amounts[pt.coordinator_request_id], 'fmt', 'note', current_ts)
+        p.finalize_transfer(debtor_id, C_ID, 999, 'test', 1, 1, 100, '', '', current_ts)
+        process_finalization_requests(debtor_id, C_ID)
+
+    assert len(FinalizedTransferSignal.query.filter_by(debtor_id=D_ID2).all()) == 3
+    assert len(PendingBalanceChangeSignal.query.filter_by(debtor_id=D_ID2).all()) == 1
+    assert _snapshot(D_ID1) == _snapshot(D_ID2)
+
+
+def test_process_pending_balance_changes(db_session, current_ts):
+    def change(debtor_id, creditor_id, change_id, principal_delta):
+        return dict(
+            debtor_id=debtor_id,
+            creditor_id=creditor_id,
+            other_creditor_id=5,
+            change_id=change_id,
+            coordinator_type='test',
+            transfer_note_format='fmt',
+            transfer_note='note',
+            committed_at=current_ts - timedelta(days=1),
+            principal_delta=principal_delta,
+        )
+
+    for debtor_id, process_pending_balance_changes in [
+            (D_ID1, p.process_pending_balance_changes),
+            (D_ID2, p.process_pending_balance_changes_in_db)]:
+        _setup_accounts(debtor_id, current_ts)
+        Account.query.filter_by(debtor_id=debtor_id, creditor_id=RECIPIENT_ID).update({
+            Account.status_flags: Account.STATUS_DELETED_FLAG,
+        })
+        p.insert_pending_balance_changes([
+            change(debtor_id, C_ID, 1, 1000),
+            change(debtor_id, C_ID, 2, -3000),
+            change(debtor_id, RECIPIENT_ID, 3, 10),
+            change(debtor_id, RECIPIENT_ID, 4, 100),
+            change(debtor_id, 5555, 5, 100),
+            change(debtor_id, ROOT_CREDITOR_ID, 6, -100),
+        ])
+        for creditor_id in [C_ID, RECIPIENT_ID, 5555, ROOT_CREDITOR_ID]:
+            process_pending_balance_changes(debtor_id, creditor_id)
+
+    assert len(PendingBalanceChange.query.all()) == 0
+    assert len(Account.query.filter_by(debtor_id=D_ID2).all()) == 4
+    assert _snapshot(D_ID1) == _snapshot(D_ID2)
+
+
+@pytest.mark.parametrize('interest_rate', [-49.99, -7.3, 0.0, 3.3, 13.333, 99.9])
+def test_calc_current_balance_parity(db_session, current_ts, interest_rate):
+    last_change_ts = current_ts - timedelta(days=1234, seconds=5678, microseconds=123457)
+    last_interest_rate_change_ts = current_ts - timedelta(days=17, microseconds=999999)
+    due_ts = current_ts - timedelta(days=40, seconds=1, microseconds=1)
+
+    for debtor_id, process_pending_balance_changes in [
+            (D_ID1, p.process_pending_balance_changes),
+            (D_ID2, p.process_pending_balance_changes_in_db)]:
+        _setup_accounts(debtor_id, current_ts)
+        Account.query.filter_by(debtor_id=debtor_id, creditor_id=C_ID).update({
+            Account.principal: 987654321,
+            Account.interest: 12345.678901234567,
+            Account.interest_rate: interest_rate,
+            Account.previous_interest_rate: -interest_rate / 3.0,
+            Account.last_change_ts: last_change_ts,
+            Account.last_interest_rate_change_ts: last_interest_rate_change_ts,
+        })
+        db.session.commit()
+
+        account = Account.query.filter_by(debtor_id=debtor_id, creditor_id=C_ID).one()
+        sql_balance = db.session.execute(
+            text('SELECT calc_current_balance(a, :current_ts) FROM account a '
+                 'WHERE debtor_id = :debtor_id AND creditor_id = :creditor_id'),
+            {'current_ts': current_ts, 'debtor_id': debtor_id, 'creditor_id': C_ID},
+        ).scalar()
+        assert sql_balance == account.calc_current_balance(current_ts)
+
+        p.insert_pending_balance_changes([dict(
+            debtor_id=debtor_id,
+            creditor_id=C_ID,
+            other_creditor_id=5,
+            change_id=1,
+            coordinator_type='test',
+            transfer_note_format='fmt',
+            transfer_note='note',
+            committed_at=due_ts,
+            principal_delta=76543210,
+        )])
+        process_pending_balance_changes(debtor_id, C_ID)
+
+    assert _snapshot(D_ID1) == _snapshot(D_ID2)
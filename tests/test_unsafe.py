@@ -1,5 +1,6 @@
 import logging
 import time
+import pytest
 import dramatiq
 from datetime import date, datetime, timezone, timedelta
 from flask import current_app
@@ -314,27 +315,37 @@ def test_scan_registered_balance_changes(app_unsafe_session):
 
 def test_get_if_account_is_reachable(app_unsafe_session, caplog):
     from swpt_accounts.models import Account, AccountUpdateSignal
+    from swpt_accounts.fetch_api_client import _clear_reachable, get_reachable_cache_stats
 
     app_fetch_api_url = current_app.config['APP_FETCH_API_URL']
 
     Account.query.delete()
     AccountUpdateSignal.query.delete()
     db.session.commit()
+    _clear_reachable()
 
     current_ts = datetime.now(tz=timezone.utc)
     p.configure_account(D_ID, C_ID, current_ts, 0)
     assert get_if_account_is_reachable(D_ID, C_ID)
     assert not get_if_account_is_reachable(666, C_ID)
+    assert get_reachable_cache_stats() == {'hits': 0, 'misses': 2, 'size': 2}
 
     current_app.config['APP_FETCH_API_URL'] = 'localhost:1111'
+    assert get_if_account_is_reachable(D_ID, C_ID)
+    assert not get_if_account_is_reachable(666, C_ID)
+    assert get_reachable_cache_stats() == {'hits': 2, 'misses': 2, 'size': 2}
+
+    _clear_reachable()
     with caplog.at_level(logging.ERROR):
         assert not get_if_account_is_reachable(D_ID, C_ID)
         assert ["Caught error while making a fetch request."] == [rec.message for rec in caplog.records]
+    assert get_reachable_cache_stats() == {'hits': 0, 'misses': 1, 'size': 0}
     current_app.config['APP_FETCH_API_URL'] = app_fetch_api_url
 
     Account.query.delete()
     AccountUpdateSignal.query.delete()
     db.session.commit()
+    _clear_reachable()
 
 
 def test_get_root_config_data_dict(app_unsafe_session, caplog):
@@ -389,3 +400,71 @@ def test_set_interest_rate_on_new_accounts(app_unsafe_session):
     db.session.commit()
 
     _clear_root_config_data()
+
+
+@pytest.mark.slow
+def test_async_processor_benchmark(app_unsafe_session):
+    from swpt_accounts.models import Account, AccountUpdateSignal, AccountTransferSignal, PendingBalanceChange, \
+        RegisteredBalanceChange
+    from swpt_accounts.cli import ThreadPoolProcessor
+    from swpt_accounts.async_processor import AsyncioProcessor, process_pending_balance_changes_call
+
+    accounts_count = 2000
+    concurrency = 8
+    current_ts = datetime.now(tz=timezone.utc)
+
+    def clear_tables():
+        for model in [Account, AccountUpdateSignal, AccountTransferSignal, PendingBalanceChange,
+                      RegisteredBalanceChange]:
+            model.query.delete()
+        db.session.commit()
+
+    def insert_pending_balance_changes(change_id):
+        p.insert_pending_balance_changes([
+            dict(
+                debtor_id=D_ID,
+                other_creditor_id=p.ROOT_CREDITOR_ID,
+                change_id=change_id,
+                creditor_id=creditor_id,
+                coordinator_type='test',
+                transfer_note_format='',
+                transfer_note='',
+                committed_at=current_ts,
+                principal_delta=1000,
+            ) for creditor_id in range(1, accounts_count + 1)
+        ])
+        db.session.commit()
+
+    def get_args_collection():
+        return p.get_accounts_with_pending_balance_changes()
+
+    clear_tables()
+
+    insert_pending_balance_changes(1)
+    started_at = time.time()
+    ThreadPoolProcessor(
+        concurrency,
+        get_args_collection=get_args_collection,
+        process_func=p.process_pending_balance_changes_in_db,
+        wait_seconds=0.0,
+    ).run(quit_early=True)
+    threads_seconds = time.time() - started_at
+    assert PendingBalanceChange.query.count() == 0
+
+    insert_pending_balance_changes(2)
+    started_at = time.time()
+    AsyncioProcessor(
+        concurrency,
+        get_args_collection=get_args_collection,
+        get_sql_call=process_pending_balance_changes_call,
+        wait_seconds=0.0,
+    ).run(quit_early=True)
+    async_seconds = time.time() - started_at
+    assert PendingBalanceChange.query.count() == 0
+    assert Account.query.filter_by(debtor_id=D_ID, creditor_id=1).one().principal == 2000
+
+    logging.getLogger(__name__).warning(
+        'Processed %i accounts in %.2f seconds with threads, and in %.2f seconds with asyncio.',
+        accounts_count, threads_seconds, async_seconds)
+
+    clear_tables()